@@ -1,6 +1,5 @@
-from flask import jsonify
-
 from core.error import ArcError
+from server.func import json_response
 
 default_error = ArcError('Unknown Error')
 
@@ -38,8 +37,8 @@ CODE_MSG = {
 
 
 def success_return(data: dict = {}, status: int = 200, msg: str = ''):
-    return jsonify({'code': 0, 'data': data, 'msg': msg}), status
+    return json_response({'code': 0, 'data': data, 'msg': msg}), status
 
 
 def error_return(e: 'ArcError' = default_error, status: int = 200):
-    return jsonify({'code': e.api_error_code, 'data': {} if e.extra_data is None else e.extra_data, 'msg': CODE_MSG[e.api_error_code] if e.message is None else e.message}), status
+    return json_response({'code': e.api_error_code, 'data': {} if e.extra_data is None else e.extra_data, 'msg': CODE_MSG[e.api_error_code] if e.message is None else e.message}), status
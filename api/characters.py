@@ -2,7 +2,7 @@ from flask import Blueprint, request
 
 from core.error import InputError, NoData
 from core.item import ItemFactory
-from core.character import Character
+from core.character import Character, CharacterCatalogue
 from core.sql import Connect, Query, Sql
 
 from .api_auth import api_try, request_json_handle, role_required
@@ -88,7 +88,9 @@ def characters_character_put(data, user, character_id: int):
         except ValueError as e:
             raise InputError('Invalid input', api_error_code=-101) from e
         c.update()
-        return success_return(c.to_dict())
+        r = c.to_dict()
+    CharacterCatalogue.clear()
+    return success_return(r)
 
 
 @bp.route('/<int:character_id>/cores', methods=['GET'])
@@ -131,4 +133,6 @@ def characters_character_cores_patch(data, user, character_id: int):
 
         ch.update_items(
             [ItemFactory.from_dict(x, c=c) for x in updates])
-        return success_return(ch.uncap_cores_to_dict())
+        r = ch.uncap_cores_to_dict()
+    CharacterCatalogue.clear()
+    return success_return(r)
@@ -1,5 +1,6 @@
 from flask import Blueprint, request
 
+from core.bgtask import LogWriter
 from core.error import ArcError
 from core.operation import BaseOperation
 
@@ -19,6 +20,17 @@ def operations_get(user):
     return success_return(list(operation_dict.keys()))
 
 
+@bp.route('/operations/<string:operation_name>', methods=['GET'])
+@role_required(request, ['system'])
+@api_try
+def operations_operation_get(user, operation_name: str):
+    '''查询操作的运行进度'''
+    if operation_name not in operation_dict:
+        raise ArcError(
+            f'No such operation: `{operation_name}`', api_error_code=-1, status=404)
+    return success_return(operation_dict[operation_name].get_progress())
+
+
 @bp.route('/operations/<string:operation_name>', methods=['POST'])
 @role_required(request, ['system'])
 @api_try
@@ -30,3 +42,13 @@ def operations_operation_post(user, operation_name: str):
     x.set_params(**request.get_json())
     x.run()
     return success_return()
+
+
+@bp.route('/metrics', methods=['GET'])
+@role_required(request, ['system'])
+@api_try
+def metrics_get(user):
+    '''运行指标'''
+    return success_return({
+        'log_writer': LogWriter.get_metrics(),
+    })
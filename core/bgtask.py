@@ -1,6 +1,13 @@
+import os
 from atexit import register
 from concurrent.futures import ThreadPoolExecutor
+from queue import Empty, Full, Queue
+from sqlite3 import Error as SqliteError
+from threading import Lock, Thread
+from time import perf_counter, sleep
+from traceback import format_exc
 
+from .config_manager import Config
 from .constant import Constant
 from .sql import Connect
 
@@ -24,27 +31,185 @@ class BGTask:
     def shutdown(wait: bool = True):
         BGTask.executor.shutdown(wait)
 
+    @staticmethod
+    def after_fork():
+        '''fork 后子进程中父进程的线程不存在，重新创建线程池'''
+        BGTask.executor = ThreadPoolExecutor(max_workers=1)
+
+
+class LogWriter:
+    '''
+        日志库写入队列，单独的写线程按 SQL 语句分组，合并为一个事务批量写入
+
+        每 LOG_DATABASE_FLUSH_INTERVAL 毫秒或积攒 LOG_DATABASE_FLUSH_ROWS 行时写入一次
+    '''
+    queue: Queue = None
+    thread: Thread = None
+    lock = Lock()
+
+    flush_count = 0
+    flush_rows = 0
+    failed_rows = 0
+    last_flush_time = 0  # ms
+    max_flush_time = 0  # ms
+    total_flush_time = 0  # ms
+
+    @classmethod
+    def start(cls) -> None:
+        with cls.lock:
+            if cls.thread is not None and cls.thread.is_alive():
+                return
+            if cls.queue is None:
+                cls.queue = Queue(Config.LOG_DATABASE_WRITE_QUEUE_SIZE)
+            cls.thread = Thread(target=cls.run, name='LogWriter', daemon=True)
+            cls.thread.start()
+
+    @classmethod
+    def put(cls, sql: str, rows: list) -> None:
+        if cls.thread is None or not cls.thread.is_alive():
+            cls.start()
+        cls.queue.put((sql, rows))
+
+    @classmethod
+    def run(cls) -> None:
+        interval = Config.LOG_DATABASE_FLUSH_INTERVAL / 1000
+        while True:
+            x = cls.queue.get()
+            if x is None:
+                cls.queue.task_done()
+                return
+            batch = {}
+            rows_num = 0
+            n = 0
+            stop = False
+            deadline = perf_counter() + interval
+            while x is not None:
+                batch.setdefault(x[0], []).extend(x[1])
+                rows_num += len(x[1])
+                n += 1
+                if rows_num >= Config.LOG_DATABASE_FLUSH_ROWS:
+                    break
+                timeout = deadline - perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    x = cls.queue.get(timeout=timeout)
+                except Empty:
+                    break
+                if x is None:
+                    stop = True
+                    n += 1
+            cls.flush(batch, rows_num)
+            for _ in range(n):
+                cls.queue.task_done()
+            if stop:
+                return
+
+    @classmethod
+    def write(cls, batch: dict) -> 'int | None':
+        '''一次事务写入，某组失败时逐行重试，只丢弃出错的行；返回出错的行数，事务提交失败时返回 None'''
+        failed = 0
+        written = False
+        try:
+            # Connect 会记录并吞掉非 ArcError 的异常，提交失败时在 __exit__ 中抛出
+            with Connect(Constant.SQLITE_LOG_DATABASE_PATH) as c:
+                c.execute('begin')
+                for sql, rows in batch.items():
+                    c.execute('savepoint log_writer')
+                    try:
+                        c.executemany(sql, rows)
+                    except SqliteError:
+                        c.execute('rollback to log_writer')
+                        for row in rows:
+                            try:
+                                c.execute(sql, row)
+                            except SqliteError:
+                                failed += 1
+                                if Connect.logger is not None:
+                                    Connect.logger.error(format_exc())
+                    c.execute('release log_writer')
+                written = True
+        except Exception:
+            if Connect.logger is not None:
+                Connect.logger.error(format_exc())
+            return None
+        return failed if written else None
+
+    @classmethod
+    def flush(cls, batch: dict, rows_num: int) -> None:
+        '''写入一批数据，整个事务失败（如 database is locked）时重试，仍失败才计为丢弃'''
+        t = perf_counter()
+        for i in range(Config.LOG_DATABASE_FLUSH_RETRIES + 1):
+            if i > 0:
+                sleep(0.1 * i)
+            failed = cls.write(batch)
+            if failed is not None:
+                break
+        else:
+            failed = rows_num
+        t = (perf_counter() - t) * 1000
+        cls.flush_count += 1
+        cls.flush_rows += rows_num - failed
+        cls.failed_rows += failed
+        cls.last_flush_time = t
+        cls.total_flush_time += t
+        if t > cls.max_flush_time:
+            cls.max_flush_time = t
+
+    @classmethod
+    def shutdown(cls, timeout: float = 10) -> None:
+        '''写入剩余的数据并结束写线程'''
+        if cls.thread is None or not cls.thread.is_alive():
+            return
+        try:
+            cls.queue.put(None, timeout=timeout)
+        except Full:
+            return
+        cls.thread.join(timeout)
+
+    @classmethod
+    def after_fork(cls) -> None:
+        '''fork 后子进程中写线程不存在，丢弃继承的队列和计数'''
+        cls.queue = None
+        cls.thread = None
+        cls.lock = Lock()
+        cls.flush_count = 0
+        cls.flush_rows = 0
+        cls.failed_rows = 0
+        cls.last_flush_time = 0
+        cls.max_flush_time = 0
+        cls.total_flush_time = 0
+
+    @classmethod
+    def get_metrics(cls) -> dict:
+        return {
+            'queue_depth': cls.queue.qsize() if cls.queue is not None else 0,
+            'queue_size': Config.LOG_DATABASE_WRITE_QUEUE_SIZE,
+            'flush_count': cls.flush_count,
+            'flush_rows': cls.flush_rows,
+            'failed_rows': cls.failed_rows,
+            'last_flush_time': round(cls.last_flush_time, 3),
+            'max_flush_time': round(cls.max_flush_time, 3),
+            'avg_flush_time': round(cls.total_flush_time / cls.flush_count, 3) if cls.flush_count else 0,
+        }
+
 
 @register
 def atexit():
     BGTask.shutdown()
+    LogWriter.shutdown()
 
 
-def logdb_execute_func(sql, *args, **kwargs):
-    with Connect(Constant.SQLITE_LOG_DATABASE_PATH) as c:
-        c.execute(sql, *args, **kwargs)
-
-
-def logdb_execute_many_func(sql, *args, **kwargs):
-    with Connect(Constant.SQLITE_LOG_DATABASE_PATH) as c:
-        c.executemany(sql, *args, **kwargs)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=BGTask.after_fork)
+    os.register_at_fork(after_in_child=LogWriter.after_fork)
 
 
-def logdb_execute(sql: str, *args, **kwargs):
+def logdb_execute(sql: str, parameters=()):
     '''异步执行SQL，日志库写入，注意不会直接返回结果'''
-    return BGTask(logdb_execute_func, sql, *args, **kwargs)
+    LogWriter.put(sql, [parameters])
 
 
-def logdb_execute_many(sql: str, *args, **kwargs):
+def logdb_execute_many(sql: str, seq_of_parameters):
     '''异步批量执行SQL，日志库写入，注意不会直接返回结果'''
-    return BGTask(logdb_execute_many_func, sql, *args, **kwargs)
+    LogWriter.put(sql, list(seq_of_parameters))
@@ -9,6 +9,7 @@ from .config_manager import Config
 from .constant import Constant
 from .error import NoAccess, NoData, RateLimit
 from .limiter import ArcLimiter
+from .snapshot import FileSnapshot
 
 
 class ContentBundle:
@@ -93,7 +94,15 @@ class BundleParser:
         self.get_bundles.cache_clear()
         self.parse()
 
+    @staticmethod
+    def parse_one(json_path: str) -> dict:
+        '''只保留需要的字段，bundle 的 json 文件可能很大'''
+        with open(json_path, 'rb') as f:
+            data = json.load(f)
+        return {k: data[k] for k in ('versionNumber', 'previousVersionNumber', 'applicationVersionNumber', 'uuid')}
+
     def parse(self) -> None:
+        snapshot = FileSnapshot('content_bundle')
         for root, dirs, files in os.walk(Constant.CONTENT_BUNDLE_FOLDER_PATH):
             for file in files:
                 if not file.endswith('.json'):
@@ -102,10 +111,8 @@ class BundleParser:
                 json_path = os.path.join(root, file)
                 bundle_path = os.path.join(root, f'{file[:-5]}.cb')
 
-                with open(json_path, 'rb') as f:
-                    data = json.load(f)
-
-                x = ContentBundle.from_json(data)
+                x = ContentBundle.from_json(
+                    snapshot.get(json_path, self.parse_one))
 
                 x.json_path = os.path.relpath(
                     json_path, Constant.CONTENT_BUNDLE_FOLDER_PATH)
@@ -125,6 +132,7 @@ class BundleParser:
                 self.version_tuple_bundles[(x.version, x.prev_version)] = x
                 self.next_versions.setdefault(
                     x.prev_version, []).append(x.version)
+        snapshot.save()
 
         # sort by version
         for k, v in self.bundles.items():
@@ -1,3 +1,5 @@
+from threading import Lock
+
 from .config_manager import Config
 from .constant import Constant
 from .error import ArcError, InputError, ItemNotEnough, NoData
@@ -95,6 +97,51 @@ class CharacterValue:
         return 0
 
 
+class CharacterCatalogue:
+    '''
+        角色静态数据缓存，包括 character 表和 char_item 表中的觉醒核心，懒加载
+        {character_id: (character 表的一行, ((core_type, amount), ...))}
+
+        只读共享，修改角色数据的事务提交后需调用`clear`
+    '''
+    lock = Lock()
+    characters: 'dict[int, tuple]' = None
+    version = 0
+
+    @classmethod
+    def get_all(cls, c) -> 'dict[int, tuple]':
+        x = cls.characters
+        if x is not None:
+            return x
+
+        version = cls.version
+        c.execute('''select * from character''')
+        rows = c.fetchall()
+        c.execute(
+            '''select character_id, item_id, amount from char_item where type="core" order by character_id, item_id''')
+        cores = {}
+        for i in c.fetchall():
+            cores.setdefault(i[0], []).append((i[1], i[2]))
+        x = {i[0]: (i, tuple(cores.get(i[0], ()))) for i in rows}
+
+        with cls.lock:
+            # 构建期间被清除则不保存
+            if version == cls.version:
+                cls.characters = x
+        return x
+
+    @classmethod
+    def get(cls, c, character_id: int) -> tuple:
+        '''没有此角色返回None'''
+        return cls.get_all(c).get(character_id)
+
+    @classmethod
+    def clear(cls) -> None:
+        with cls.lock:
+            cls.version += 1
+            cls.characters = None
+
+
 class Character(CollectionItemMixin):
     database_table_name = None
 
@@ -272,13 +319,26 @@ class UserCharacter(Character):
         # 获取所给用户此角色信息
         if user:
             self.user = user
-        self.c.execute(f'''select * from {self.database_table_name} a,character b where a.user_id=? and a.character_id=b.character_id and a.character_id=?''',
+        self.c.execute(f'''select * from {self.database_table_name} where user_id=? and character_id=?''',
                        (self.user.user_id, self.character_id))
 
         y = self.c.fetchone()
-        if y is None:
+        x = CharacterCatalogue.get(self.c, self.character_id)
+        if y is None or x is None:
             raise NoData('The character of the user does not exist.')
 
+        self.set_character_info(y + x[0])
+        self.set_character_core(x[1])
+        if self.character_id == 72:
+            self.update_insight_state()
+
+    def set_character_core(self, cores: tuple) -> None:
+        '''cores: ((core_type, amount), ...)'''
+        if cores:
+            self.uncap_cores = [ItemCore(self.c, i[0], i[1]) for i in cores]
+
+    def set_character_info(self, y: tuple) -> None:
+        '''从 user_char 和 character 表连接查询的一行设置角色信息'''
         self.name = y[8]
         self.char_type = y[23]
         self.is_uncapped = y[4] == 1
@@ -315,10 +375,6 @@ class UserCharacter(Character):
             self.prog.addition = addition
             self.overdrive.addition = addition
 
-        self.select_character_core()
-        if self.character_id == 72:
-            self.update_insight_state()
-
     def to_dict(self) -> dict:
         if self.char_type is None:
             self.select_character_info(self.user)
@@ -497,5 +553,21 @@ class UserCharacterList:
                 self.characters.append(UserCharacter(self.c, i[0], self.user))
 
     def select_characters_info(self):
+        '''一次查询用户所有角色，静态数据来自角色缓存'''
+        if not self.characters:
+            return
+        self.c.execute(
+            f'''select * from {self.database_table_name} where user_id=?''', (self.user.user_id,))
+        rows = {i[1]: i for i in self.c.fetchall()}
+        catalogue = CharacterCatalogue.get_all(self.c)
+
         for i in self.characters:
-            i.select_character_info(self.user)
+            y = rows.get(i.character_id)
+            x = catalogue.get(i.character_id)
+            if y is None or x is None:
+                raise NoData('The character of the user does not exist.')
+            i.user = self.user
+            i.set_character_info(y + x[0])
+            i.set_character_core(x[1])
+            if i.character_id == 72:
+                i.update_insight_state()
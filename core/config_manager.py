@@ -7,10 +7,21 @@ class Config:
     PORT = 80
 
     DEPLOY_MODE = 'flask_multithread'
+    # 'prefork' (Unix only): worker processes forked from a warmed-up master
+    # `kill -HUP <master pid>` reloads song / bundle / map files and replaces workers
+    PREFORK_WORKERS = 0  # 0 means the number of CPUs
+    PREFORK_MAX_REQUESTS = 0  # recycle a worker after this many requests, 0 means never
+    PREFORK_GRACEFUL_TIMEOUT = 30  # seconds to finish in-flight requests
     USE_PROXY_FIX = False
     USE_CORS = False
+    # JSON encoder of responses: 'auto' | 'orjson' | 'ujson' | 'json'
+    # 'auto' uses the first installed one in this order
+    RESPONSE_JSON_ENCODER = 'auto'
 
     SONG_FILE_HASH_PRE_CALCULATE = True
+    SONG_FILE_HASH_THREADS = 0  # 0 means chosen by Python
+    # Reuse parsed map / bundle / songlist data and song file hashes of unchanged files on startup
+    USE_CACHE_SNAPSHOT = True
 
     GAME_API_PREFIX = ['/coldwind/35', '/']  # str | list[str]
     OLD_GAME_API_PREFIX = []  # str | list[str]
@@ -27,6 +38,9 @@ class Config:
     LINKPLAY_AUTHENTICATION = 'my_link_play_server'
     LINKPLAY_DISPLAY_HOST = ''
     LINKPLAY_TCP_SECRET_KEY = '1145141919810'
+    # Persistent multiplexed connections from each process to the link play server
+    LINKPLAY_TCP_POOL_SIZE = 2  # 0 means a new connection for every request
+    LINKPLAY_TCP_USE_MSGPACK = False  # needs `msgpack` on both sides
 
     SSL_CERT = ''
     SSL_KEY = ''
@@ -101,6 +115,10 @@ class Config:
 
     MAX_FRIEND_COUNT = 50
 
+    # In-memory leaderboard index, only for single process deployment
+    USE_RANK_INDEX = False
+    RANK_INDEX_MAX_CHARTS = 2000
+
     LOG_FOLDER_PATH = "./log"
     WORLD_MAP_FOLDER_PATH = './database/map/'
     WORLD_MAP_LEPHON_NELL_FOLDER_PATH = './database/map_lephon_nell'
@@ -112,6 +130,30 @@ class Config:
     DATABASE_INIT_PATH = './database/init/'
     SQLITE_LOG_DATABASE_PATH = './database/arcaea_log.db'
     SQLITE_DATABASE_DELETED_PATH = './database/arcaea_database_deleted.db'
+    # Replaces the in-memory database when DEPLOY_MODE is 'prefork'
+    SQLITE_MEMORY_DATABASE_PATH = './database/arcaea_memory.db'
+    CACHE_SNAPSHOT_FOLDER_PATH = './database/cache/'
+
+    # Keep SQLite connections open and reuse them across requests
+    DATABASE_CONNECTION_POOL = True
+    DATABASE_CONNECTION_POOL_SIZE = 16  # idle connections kept per database file
+    DATABASE_STATEMENT_CACHE_SIZE = 256  # prepared statements cached per connection
+
+    # PRAGMA profile for main and log database connections
+    # 'durable' | 'balanced' | 'throughput'
+    DATABASE_PRAGMA_PROFILE = 'balanced'
+    DATABASE_PRAGMA = {}  # override single values, e.g. {'synchronous': 'FULL'}
+
+    # Log database writes are queued and flushed in batches
+    LOG_DATABASE_WRITE_QUEUE_SIZE = 10000
+    LOG_DATABASE_FLUSH_INTERVAL = 200  # ms
+    LOG_DATABASE_FLUSH_ROWS = 500
+    LOG_DATABASE_FLUSH_RETRIES = 3  # 整个批次写入失败时的重试次数
+
+    # Rate limit counters, 'memory://' is per process
+    # 'sqlite:///./database/arcaea_limiter.db' is shared by all processes on the host
+    # other storage URIs of `limits` (e.g. 'redis://host:port') can also be used
+    RATE_LIMIT_STORAGE_URI = 'memory://'
 
     GAME_LOGIN_RATE_LIMIT = '30/5 minutes'
     API_LOGIN_RATE_LIMIT = '10/5 minutes'
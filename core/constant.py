@@ -2,7 +2,7 @@ from .config_manager import Config
 
 ARCAEA_SERVER_VERSION = 'v2.12.1'
 ARCAEA_DATABASE_VERSION = 'v2.12.1'
-ARCAEA_LOG_DATBASE_VERSION = 'v1.1'
+ARCAEA_LOG_DATBASE_VERSION = 'v1.2'
 
 
 class Constant:
@@ -67,6 +67,9 @@ class Constant:
     LINKPLAY_AUTHENTICATION = Config.LINKPLAY_AUTHENTICATION
     LINKPLAY_TCP_SECRET_KEY = Config.LINKPLAY_TCP_SECRET_KEY
     LINKPLAY_TCP_MAX_LENGTH = 0x0FFFFFFF
+    LINKPLAY_TCP_POOL_SIZE = Config.LINKPLAY_TCP_POOL_SIZE
+    LINKPLAY_TCP_USE_MSGPACK = Config.LINKPLAY_TCP_USE_MSGPACK
+    LINKPLAY_TCP_RETRY_INTERVAL = 60  # Units: seconds, when persistent connections are not supported
 
     LINKPLAY_MATCH_GET_ROOMS_INTERVAL = 4  # Units: seconds
     LINKPLAY_MATCH_PTT_ABS = [5, 20, 50, 100, 200, 500, 1000, 2000]
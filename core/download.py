@@ -1,24 +1,126 @@
+import hmac
 import os
+import stat
 from functools import lru_cache
 from json import loads
+from threading import Lock
 from time import time
+from urllib.parse import quote
 
 from flask import url_for
 
+from .bgtask import logdb_execute
 from .config_manager import Config
 from .constant import Constant
-from .error import NoAccess
+from .error import ArcError, NoAccess
 from .limiter import ArcLimiter
+from .snapshot import FileSnapshot
+from .sql import Connect
 from .user import User
-from .util import get_file_md5, md5
+from .util import get_file_md5, get_files_md5
 
 
-@lru_cache(maxsize=8192)
 def get_song_file_md5(song_id: str, file_name: str) -> str:
-    path = os.path.join(Constant.SONG_FILE_FOLDER_PATH, song_id, file_name)
-    if not os.path.isfile(path):
-        return None
-    return get_file_md5(path)
+    return SongFileHash.get(song_id, file_name)
+
+
+class SongFileHash:
+    '''
+        歌曲文件md5存储，保存在日志数据库的`song_file_hash`表中
+        以 (path, size, mtime_ns) 判断文件是否变化，path 为相对于歌曲文件夹的路径
+
+        进程内缓存不限制数量，`refresh`只重新计算变化的文件
+    '''
+    hashes: 'dict[str, str]' = {}  # {path: md5}
+    lock = Lock()
+
+    @staticmethod
+    def get_file_key(path: str) -> tuple:
+        '''返回 (size, mtime_ns)，不是文件返回None'''
+        try:
+            x = os.stat(path)
+        except OSError:
+            return None
+        if not stat.S_ISREG(x.st_mode):
+            return None
+        return (x.st_size, x.st_mtime_ns)
+
+    @classmethod
+    def get(cls, song_id: str, file_name: str) -> str:
+        path = f'{song_id}/{file_name}'
+        x = cls.hashes.get(path)
+        if x is not None:
+            return x
+        file_path = os.path.join(
+            Constant.SONG_FILE_FOLDER_PATH, song_id, file_name)
+        key = cls.get_file_key(file_path)
+        if key is None:
+            return None
+
+        with Connect(Constant.SQLITE_LOG_DATABASE_PATH) as c:
+            y = c.execute('''select md5 from song_file_hash where path = ? and size = ? and mtime_ns = ?''',
+                          (path, *key)).fetchone()
+        if y is not None:
+            x = y[0]
+        else:
+            x = get_file_md5(file_path)
+            logdb_execute('''insert or replace into song_file_hash values(?,?,?,?)''',
+                          (path, *key, x))
+        cls.hashes[path] = x
+        return x
+
+    @classmethod
+    def refresh(cls, full: bool = False) -> dict:
+        '''
+            扫描歌曲文件夹，只重新计算新增或变化的文件，`full`为True时全部重新计算
+            返回统计数据
+        '''
+        files = {}  # {path: (size, mtime_ns)}
+        for song_id in DownloadList.get_all_song_ids():
+            for file_name in DownloadList.get_one_song_file_names(song_id):
+                path = f'{song_id}/{file_name}'
+                key = cls.get_file_key(os.path.join(
+                    Constant.SONG_FILE_FOLDER_PATH, song_id, file_name))
+                if key is not None:
+                    files[path] = key
+
+        with Connect(Constant.SQLITE_LOG_DATABASE_PATH) as c:
+            stored = {i[0]: (i[1], i[2], i[3]) for i in c.execute(
+                '''select path, size, mtime_ns, md5 from song_file_hash''')}
+
+        hashes = {}
+        changed = []
+        for path, key in files.items():
+            x = stored.get(path)
+            if full or x is None or x[:2] != key:
+                changed.append(path)
+            else:
+                hashes[path] = x[2]
+
+        r = get_files_md5([os.path.join(Constant.SONG_FILE_FOLDER_PATH, i)
+                           for i in changed], Config.SONG_FILE_HASH_THREADS or None)
+        hashes.update(zip(changed, r))
+
+        removed = [i for i in stored if i not in files]
+        flag = False
+        with Connect(Constant.SQLITE_LOG_DATABASE_PATH) as c:
+            c.executemany('''insert or replace into song_file_hash values(?,?,?,?)''',
+                          ((i, *files[i], hashes[i]) for i in changed))
+            c.executemany('''delete from song_file_hash where path = ?''',
+                          ((i,) for i in removed))
+            flag = True
+        if not flag:
+            # Connect 会吞掉非 ArcError 的异常
+            raise ArcError('Failed to save song file hashes.')
+
+        with cls.lock:
+            cls.hashes = hashes
+        return {'total': len(files), 'changed': len(changed), 'removed': len(removed)}
+
+    @classmethod
+    def clear(cls) -> None:
+        '''只清除进程内缓存'''
+        cls.hashes = {}
 
 
 class SonglistParser:
@@ -121,12 +223,18 @@ class SonglistParser:
 
         x.pack_info.setdefault(song['set'], set()).add(song['id'])
 
+    @staticmethod
+    def load_file(path: str) -> list:
+        with open(path, 'rb') as f:
+            return loads(f.read()).get('songs', [])
+
     def parse(self) -> None:
         '''解析songlist文件'''
         if not os.path.isfile(self.path):
             return
-        with open(self.path, 'rb') as f:
-            self.data = loads(f.read()).get('songs', [])
+        snapshot = FileSnapshot('songlist')
+        self.data = snapshot.get(self.path, self.load_file)
+        snapshot.save()
         self.has_songlist = True
         for x in self.data:
             self.songs.update(self.parse_one(x))
@@ -143,8 +251,12 @@ class UserDownload:
     limiter = ArcLimiter(
         str(Constant.DOWNLOAD_TIMES_LIMIT) + '/day', 'download')
 
-    def __init__(self, c_m=None, user=None) -> None:
-        self.c_m = c_m
+    DEFAULT_SECRET_KEY = '1145141919810'  # config.example.py 中公开的默认值
+    TOKEN_KEY_CONFIG_ID = 'download_token_key'
+    token_key: bytes = None
+    token_key_lock = Lock()
+
+    def __init__(self, user=None) -> None:
         self.user = user
 
         self.song_id: str = None
@@ -172,35 +284,63 @@ class UserDownload:
         '''下载次数+1，返回成功与否bool值'''
         return self.limiter.hit(str(self.user.user_id))
 
-    def select_for_check(self) -> None:
-        '''利用token、song_id、file_name查询其它信息'''
-        self.c_m.execute('''select user_id, time from download_token where song_id=? and file_name=? and token = ? limit 1;''',
-                         (self.song_id, self.file_name, self.token))
+    @classmethod
+    def get_token_key(cls) -> bytes:
+        '''
+            签名密钥，SECRET_KEY 为公开的默认值或为空时不使用，
+            改用数据库 config 表中随机生成的密钥，多进程共享
+        '''
+        if cls.token_key is not None:
+            return cls.token_key
+        with cls.token_key_lock:
+            if cls.token_key is not None:
+                return cls.token_key
+            if Config.SECRET_KEY and Config.SECRET_KEY != cls.DEFAULT_SECRET_KEY:
+                cls.token_key = Config.SECRET_KEY.encode()
+                return cls.token_key
+            x = None
+            with Connect() as c:
+                c.execute('''insert or ignore into config values(?, ?)''',
+                          (cls.TOKEN_KEY_CONFIG_ID, os.urandom(32).hex()))
+                x = c.execute('''select value from config where id = ?''',
+                              (cls.TOKEN_KEY_CONFIG_ID,)).fetchone()
+            if x is None:
+                raise ArcError('Failed to load the download token key.')
+            cls.token_key = bytes.fromhex(x[0])
+            return cls.token_key
 
-        x = self.c_m.fetchone()
-        if not x:
+    @classmethod
+    def get_token_sign(cls, user_id: int, song_id: str, file_name: str, token_time: int) -> str:
+        return hmac.digest(cls.get_token_key(), f'download:{user_id}/{token_time}/{song_id}/{file_name}'.encode(), 'sha256')[:16].hex()
+
+    def select_for_check(self) -> None:
+        '''校验token签名并取出user_id和时间，不查询数据库'''
+        try:
+            user_id, token_time, sign = self.token.split('.')
+            user_id = int(user_id)
+            token_time = int(token_time)
+        except (AttributeError, ValueError):
+            raise NoAccess('The token `%s` is not valid.' %
+                           self.token, status=403)
+        # compare_digest 不接受含非 ASCII 字符的 str，按 bytes 比较
+        if not hmac.compare_digest(sign.encode(errors='replace'), self.get_token_sign(user_id, self.song_id, self.file_name, token_time).encode()):
             raise NoAccess('The token `%s` is not valid.' %
                            self.token, status=403)
         self.user = User()
-        self.user.user_id = x[0]
-        self.token_time = x[1]
+        self.user.user_id = user_id
+        self.token_time = token_time
 
     def generate_token(self) -> None:
-        self.token_time = int(time())
-        self.token = md5(str(self.user.user_id) + self.song_id +
-                         self.file_name + str(self.token_time) + str(os.urandom(8)))
-
-    def insert_download_token(self) -> None:
-        '''将数据插入数据库，让这个下载链接可用'''
-        self.c_m.execute('''insert or replace into download_token values(:a,:b,:c,:d,:e)''', {
-            'a': self.user.user_id, 'b': self.song_id, 'c': self.file_name, 'd': self.token, 'e': self.token_time})
+        '''token: user_id.time.sign，签名包含歌曲和文件名'''
+        if self.token_time is None:
+            self.token_time = int(time())
+        self.token = f'{self.user.user_id}.{self.token_time}.{self.get_token_sign(self.user.user_id, self.song_id, self.file_name, self.token_time)}'
 
     @property
     def url(self) -> str:
         '''生成下载链接'''
         if self.token is None:
             self.generate_token()
-            # self.insert_download_token() # 循环插入速度慢，改为executemany
         if Constant.DOWNLOAD_LINK_PREFIX:
             prefix = Constant.DOWNLOAD_LINK_PREFIX
             if prefix[-1] != '/':
@@ -213,35 +353,69 @@ class UserDownload:
         return get_song_file_md5(self.song_id, self.file_name)
 
 
+class SongFileManifest:
+    '''
+        歌曲文件清单，每首歌为不可变的 tuple，元素为 (file_name, checksum, url_path)
+
+        预先计算开启时由`DownloadList.initialize_cache`一次建好，否则按需建立
+    '''
+    songs: 'dict[str, tuple]' = {}
+    lock = Lock()
+
+    @staticmethod
+    def build_one(song_id: str) -> tuple:
+        return tuple((i, get_song_file_md5(song_id, i), quote(f'{song_id}/{i}', safe="!$&'()*+,/:;=@")) for i in DownloadList.get_one_song_file_names(song_id))
+
+    @classmethod
+    def get(cls, song_id: str) -> tuple:
+        x = cls.songs.get(song_id)
+        if x is None:
+            x = cls.build_one(song_id)
+            with cls.lock:
+                cls.songs = {**cls.songs, song_id: x}
+        return x
+
+    @classmethod
+    def build(cls) -> None:
+        cls.songs = {i: cls.build_one(i)
+                     for i in DownloadList.get_all_song_ids()}
+
+    @classmethod
+    def clear(cls) -> None:
+        cls.songs = {}
+
+
 class DownloadList(UserDownload):
     '''
         下载列表类
         properties: `user` - `User`类或子类的实例
     '''
 
-    def __init__(self, c_m=None, user=None) -> None:
-        super().__init__(c_m, user)
+    def __init__(self, user=None) -> None:
+        super().__init__(user)
 
         self.song_ids: list = None
         self.url_flag: bool = None
 
-        self.downloads: list = []
         self.urls: dict = {}
+        self.url_prefix: str = None
 
     @classmethod
-    def initialize_cache(cls) -> None:
-        '''初始化歌曲数据缓存，包括md5、文件目录遍历、解析songlist'''
+    def initialize_cache(cls, full_hash: bool = False) -> None:
+        '''
+            初始化歌曲数据缓存，包括md5、文件目录遍历、解析songlist
+            md5 只计算变化的文件，`full_hash`为True时全部重新计算
+        '''
         SonglistParser()
         if Config.SONG_FILE_HASH_PRE_CALCULATE:
-            x = cls()
-            x.url_flag = False
-            x.add_songs()
-            del x
+            SongFileHash.refresh(full_hash)
+            SongFileManifest.build()
 
     @staticmethod
     def clear_all_cache() -> None:
         '''清除所有歌曲文件有关缓存'''
-        get_song_file_md5.cache_clear()
+        SongFileHash.clear()
+        SongFileManifest.clear()
         DownloadList.get_one_song_file_names.cache_clear()
         DownloadList.get_all_song_ids.cache_clear()
         SonglistParser.songs = {}
@@ -250,16 +424,6 @@ class DownloadList(UserDownload):
         SonglistParser.world_songs = set()
         SonglistParser.has_songlist = False
 
-    def clear_download_token(self) -> None:
-        '''清除过期下载链接'''
-        self.c_m.execute('''delete from download_token where time<?''',
-                         (int(time()) - Constant.DOWNLOAD_TIME_GAP_LIMIT,))
-
-    def insert_download_tokens(self) -> None:
-        '''插入所有下载链接'''
-        self.c_m.executemany('''insert or replace into download_token values(?,?,?,?,?)''', [(
-            self.user.user_id, x.song_id, x.file_name, x.token, x.token_time) for x in self.downloads])
-
     @staticmethod
     @lru_cache(maxsize=2048)
     def get_one_song_file_names(song_id: str) -> list:
@@ -271,48 +435,62 @@ class DownloadList(UserDownload):
                 r.append(file_name)
         return r
 
+    def get_url_prefix(self) -> str:
+        '''下载链接前缀，每次请求计算一次'''
+        if Constant.DOWNLOAD_LINK_PREFIX:
+            prefix = Constant.DOWNLOAD_LINK_PREFIX
+            if prefix[-1] != '/':
+                prefix += '/'
+            return prefix
+        return url_for('download', file_path='_', _external=True)[:-1]
+
+    def get_one_url(self, song_id: str, file_name: str, url_path: str) -> str:
+        token = f'{self.user.user_id}.{self.token_time}.{self.get_token_sign(self.user.user_id, song_id, file_name, self.token_time)}'
+        if Constant.DOWNLOAD_LINK_PREFIX:
+            return f'{self.url_prefix}{song_id}/{file_name}?t={token}'
+        return f'{self.url_prefix}{url_path}?t={token}'
+
     def add_one_song(self, song_id: str) -> None:
 
         re = {}
-        for i in self.get_one_song_file_names(song_id):
-            x = UserDownload(self.c_m, self.user)
-            self.downloads.append(x)
-            x.song_id = song_id
-            x.file_name = i
+        for i, checksum, url_path in SongFileManifest.get(song_id):
             if i == 'base.ogg':
                 if 'audio' not in re:
                     re['audio'] = {}
 
-                re['audio']["checksum"] = x.hash
+                re['audio']["checksum"] = checksum
                 if self.url_flag:
-                    re['audio']["url"] = x.url
+                    re['audio']["url"] = self.get_one_url(
+                        song_id, i, url_path)
             elif i == '3.ogg':
                 if 'audio' not in re:
                     re['audio'] = {}
 
                 if self.url_flag:
-                    re['audio']['3'] = {"checksum": x.hash, "url": x.url}
+                    re['audio']['3'] = {"checksum": checksum,
+                                        "url": self.get_one_url(song_id, i, url_path)}
                 else:
-                    re['audio']['3'] = {"checksum": x.hash}
+                    re['audio']['3'] = {"checksum": checksum}
             elif i in ('video.mp4', 'video_audio.ogg', 'video_720.mp4', 'video_1080.mp4'):
                 if 'additional_files' not in re:
                     re['additional_files'] = []
 
                 if self.url_flag:
                     re['additional_files'].append(
-                        {"checksum": x.hash, "url": x.url, 'file_name': i})
+                        {"checksum": checksum, "url": self.get_one_url(song_id, i, url_path), 'file_name': i})
                 else:
                     re['additional_files'].append(
-                        {"checksum": x.hash, 'file_name': i})
+                        {"checksum": checksum, 'file_name': i})
                 # 有参数 requirement 作用未知
             else:
                 if 'chart' not in re:
                     re['chart'] = {}
 
                 if self.url_flag:
-                    re['chart'][i[0]] = {"checksum": x.hash, "url": x.url}
+                    re['chart'][i[0]] = {"checksum": checksum,
+                                         "url": self.get_one_url(song_id, i, url_path)}
                 else:
-                    re['chart'][i[0]] = {"checksum": x.hash}
+                    re['chart'][i[0]] = {"checksum": checksum}
 
         self.urls.update({song_id: re})
 
@@ -326,6 +504,9 @@ class DownloadList(UserDownload):
         '''添加一个或多个歌曲到下载列表，若`song_ids`为空，则添加所有歌曲'''
         if song_ids is not None:
             self.song_ids = song_ids
+        if self.url_flag:
+            self.token_time = int(time())
+            self.url_prefix = self.get_url_prefix()
 
         if not self.song_ids:
             self.song_ids = self.get_all_song_ids()
@@ -343,9 +524,5 @@ class DownloadList(UserDownload):
                     self.user) & set(self.song_ids))
 
             for i in self.song_ids:
-                if os.path.isdir(os.path.join(Constant.SONG_FILE_FOLDER_PATH, i)):
+                if i in SongFileManifest.songs or os.path.isdir(os.path.join(Constant.SONG_FILE_FOLDER_PATH, i)):
                     self.add_one_song(i)
-
-        if self.url_flag:
-            self.clear_download_token()
-            self.insert_download_tokens()
@@ -7,13 +7,15 @@ from time import time
 from traceback import format_exc
 
 from core.bundle import BundleParser
+from core.character import CharacterCatalogue
 from core.config_manager import Config
 from core.constant import ARCAEA_DATABASE_VERSION, ARCAEA_LOG_DATBASE_VERSION
 from core.course import Course
 from core.download import DownloadList
 from core.purchase import Purchase
-from core.sql import (Connect, DatabaseMigrator, LogDatabaseMigrator,
-                      MemoryDatabase)
+from core.snapshot import FileSnapshot
+from core.sql import (Connect, ConnectionPool, DatabaseMigrator,
+                      DatabasePragma, LogDatabaseMigrator, MemoryDatabase)
 from core.user import UserRegister
 from core.util import try_rename
 from core.world import MapParser
@@ -46,6 +48,8 @@ class DatabaseInit:
         '''初始化数据库结构'''
         with open(self.sql_path, 'r', encoding='utf-8') as f:
             self.c.executescript(f.read())
+        # 初始化脚本中的 PRAGMA 会覆盖连接设置
+        DatabasePragma.apply(self.c.connection, self.db_path)
         self.c.execute('''insert into config values("version", :a);''', {
             'a': ARCAEA_DATABASE_VERSION})
 
@@ -174,6 +178,8 @@ class LogDatabaseInit:
         '''初始化数据库结构'''
         with open(self.sql_path, 'r') as f:
             self.c.executescript(f.read())
+        # 初始化脚本中的 PRAGMA 会覆盖连接设置
+        DatabasePragma.apply(self.c.connection, self.db_path)
         self.c.execute(
             '''insert into cache values("version", :a, -1);''', {'a': ARCAEA_LOG_DATBASE_VERSION})
 
@@ -280,6 +286,7 @@ class FileChecker:
                     if not os.path.isdir(Config.SQLITE_DATABASE_BACKUP_FOLDER_PATH):
                         os.makedirs(Config.SQLITE_DATABASE_BACKUP_FOLDER_PATH)
 
+                    ConnectionPool.close_all(db_path)
                     backup_path = try_rename(db_path, os.path.join(
                         Config.SQLITE_DATABASE_BACKUP_FOLDER_PATH, os.path.split(db_path)[-1] + '.bak'))
 
@@ -305,6 +312,11 @@ class FileChecker:
                     self.logger.error(format_exc())
                     self.logger.warning(
                         f'Fail to update the file `{db_path}`.')
+            else:
+                # 后加的索引不改变数据库版本，启动时补建
+                with Connect(db_path) as c:
+                    c.execute(
+                        '''create index if not exists user_world_rank_score on user (world_rank_score)''')
 
         return True
 
@@ -316,6 +328,9 @@ class FileChecker:
         '''更新数据库，并删除旧文件'''
         if os.path.isfile(old_path) and os.path.isfile(new_path):
             DatabaseMigrator(old_path, new_path).update_database()
+            ConnectionPool.close_all(old_path)
+            ConnectionPool.close_all(new_path)
+            CharacterCatalogue.clear()
             os.remove(old_path)
 
     @staticmethod
@@ -362,7 +377,23 @@ class FileChecker:
             f = False
         return f
 
+    def check_database_pragma(self) -> bool:
+        '''检查并记录数据库连接实际生效的 PRAGMA 设置'''
+        try:
+            for path in (Config.SQLITE_DATABASE_PATH, Config.SQLITE_LOG_DATABASE_PATH):
+                with Connect(path) as c:
+                    x = DatabasePragma.get_effective(c)
+                self.logger.info(
+                    f'Database `{path}` pragma profile `{Config.DATABASE_PRAGMA_PROFILE}`: ' + ', '.join(f'{k}={v}' for k, v in x.items()))
+        except Exception as e:
+            self.logger.error(format_exc())
+            self.logger.warning('Database pragma check error!')
+            return False
+        return True
+
     def check_before_run(self) -> bool:
         '''运行前检查，返回布尔值'''
         MemoryDatabase()  # 初始化内存数据库
-        return self.check_song_file() and self.check_content_bundle() and self.check_update_database() and self.check_world_map()
+        FileSnapshot.logger = self.logger
+        # 歌曲文件 hash 保存在日志数据库中，需要先检查数据库
+        return self.check_update_database() and self.check_database_pragma() and self.check_song_file() and self.check_content_bundle() and self.check_world_map()
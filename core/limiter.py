@@ -1,9 +1,118 @@
+import os
+import sqlite3
+from threading import Lock
+from time import time
+
 from limits import parse_many, strategies
-from limits.storage import storage_from_string
+from limits.storage import Storage, storage_from_string
+
+from .config_manager import Config
+
+
+class SQLiteStorage(Storage):
+    '''
+        基于 SQLite 文件的限流计数存储，多进程共享，不需要外部服务
+
+        uri: `sqlite:///相对路径` 或 `sqlite:////绝对路径`
+        固定窗口计数，单条语句原子自增，过期行每 EXPIRE_INTERVAL 秒批量删除
+    '''
+    STORAGE_SCHEME = ['sqlite']
+
+    EXPIRE_INTERVAL = 60
+
+    def __init__(self, uri: str = None, wrap_exceptions: bool = False, **options) -> None:
+        self.path = uri[len('sqlite:///'):]
+        self.lock = Lock()
+        self.conn: sqlite3.Connection = None
+        self.pid: int = None
+        self.next_expire_time = 0
+        self.use_returning = sqlite3.sqlite_version_info >= (3, 35, 0)
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+
+    @property
+    def base_exceptions(self):
+        return sqlite3.Error
+
+    def get_conn(self) -> sqlite3.Connection:
+        '''每个进程一个连接，fork 后重新连接'''
+        if self.conn is None or self.pid != os.getpid():
+            conn = sqlite3.connect(
+                self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.execute('''PRAGMA journal_mode = WAL''')
+            conn.execute('''PRAGMA synchronous = OFF''')
+            conn.execute('''create table if not exists limiter(key text primary key,
+                         value int, expire_at real)''')
+            self.conn = conn
+            self.pid = os.getpid()
+        return self.conn
+
+    def expire(self, conn: sqlite3.Connection, now: float) -> None:
+        if now < self.next_expire_time:
+            return
+        self.next_expire_time = now + self.EXPIRE_INTERVAL
+        conn.execute('''delete from limiter where expire_at <= ?''', (now,))
+
+    def incr(self, key: str, expiry: int, elastic_expiry: bool = False, amount: int = 1) -> int:
+        now = time()
+        with self.lock:
+            conn = self.get_conn()
+            self.expire(conn, now)
+            if self.use_returning:
+                return conn.execute('''insert into limiter values(:k, :a, :e) on conflict(key) do update set
+                    value = case when expire_at <= :t then :a else value + :a end,
+                    expire_at = case when expire_at <= :t then :e else expire_at end returning value''', {
+                    'k': key, 'a': amount, 'e': now + expiry, 't': now}).fetchone()[0]
+
+            conn.execute('''begin immediate''')
+            try:
+                x = conn.execute(
+                    '''select value, expire_at from limiter where key = ?''', (key,)).fetchone()
+                if x is None or x[1] <= now:
+                    value = amount
+                    conn.execute('''insert or replace into limiter values(?, ?, ?)''',
+                                 (key, value, now + expiry))
+                else:
+                    value = x[0] + amount
+                    conn.execute(
+                        '''update limiter set value = ? where key = ?''', (value, key))
+                conn.execute('''commit''')
+            except BaseException:
+                conn.execute('''rollback''')
+                raise
+            return value
+
+    def get(self, key: str) -> int:
+        with self.lock:
+            x = self.get_conn().execute(
+                '''select value from limiter where key = ? and expire_at > ?''', (key, time())).fetchone()
+        return x[0] if x else 0
+
+    def get_expiry(self, key: str) -> float:
+        with self.lock:
+            x = self.get_conn().execute(
+                '''select expire_at from limiter where key = ?''', (key,)).fetchone()
+        return x[0] if x else time()
+
+    def check(self) -> bool:
+        try:
+            with self.lock:
+                self.get_conn().execute('''select 1''')
+            return True
+        except sqlite3.Error:
+            return False
+
+    def reset(self) -> int:
+        with self.lock:
+            return self.get_conn().execute('''delete from limiter''').rowcount
+
+    def clear(self, key: str) -> None:
+        with self.lock:
+            self.get_conn().execute(
+                '''delete from limiter where key = ?''', (key,))
 
 
 class ArcLimiter:
-    storage = storage_from_string("memory://")
+    storage = storage_from_string(Config.RATE_LIMIT_STORAGE_URI)
     strategy = strategies.FixedWindowRateLimiter(storage)
 
     def __init__(self, limit_str: str = None, namespace: str = None):
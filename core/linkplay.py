@@ -1,17 +1,50 @@
+import os
 import socket
+import struct
 from base64 import b64decode, b64encode
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from itertools import count
 from json import dumps, loads
-from threading import RLock
+from threading import Event, Lock, RLock, Thread
 from time import time
 
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
 from core.error import ArcError, Timeout
 
 from .constant import Constant
 from .user import UserInfo
 from .util import aes_gcm_128_decrypt, aes_gcm_128_encrypt
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 socket.setdefaulttimeout(Constant.LINKPLAY_TIMEOUT)
 
+TCP_AES_KEY = Constant.LINKPLAY_TCP_SECRET_KEY.encode(
+    'utf-8').ljust(16, b'\x00')[:16]
+
+# 长度字段为此值时切换为长连接，旧版服务器会返回 `Body too long`
+MUX_MAGIC = b'\xff' * 8
+MUX_ACK_PREFIX = b'ARCMUX\x01'  # 后接 1 byte，bit 0 为服务器是否支持 msgpack
+FRAME_HEADER = struct.Struct('<IIB')  # payload length, request id, flags
+
+
+def recv_exactly(sock: socket.socket, n: int) -> bytearray:
+    '''读取 n bytes，处理不完整的 recv'''
+    buf = bytearray(n)
+    view = memoryview(buf)
+    i = 0
+    while i < n:
+        k = sock.recv_into(view[i:])
+        if k == 0:
+            raise ConnectionError('Connection closed by link play server')
+        i += k
+    return buf
+
 
 def get_song_unlock(client_song_map: 'dict[str, list]') -> bytes:
     '''处理可用歌曲bit，返回bytes'''
@@ -92,9 +125,214 @@ class Room:
         }
 
 
+class LinkPlayConnection:
+    '''
+        与 Link Play 服务器的一条 TCP 长连接
+
+        帧：payload length (4) | request id (4) | flags (1) | payload，payload 为 iv (12) + ciphertext + tag
+        request id 和 flags 为 AES-GCM 的附加数据，flags 的 bit 0 表示 body 为 msgpack，否则为 JSON
+        请求可以连续发送不等待响应，读取线程按 request id 把响应交给对应的 Future
+    '''
+
+    def __init__(self, aead: AESGCM) -> None:
+        self.aead = aead
+        self.sock: socket.socket = None
+        self.server_msgpack = False
+
+        self.send_lock = Lock()
+        self.pending: 'dict[int, Future]' = {}
+        self.request_ids = count(1)
+        self.closed = False
+        self.used = False
+
+    def connect(self) -> bool:
+        '''握手，服务器不支持长连接或无法连接时返回 False'''
+        try:
+            self.sock = socket.create_connection(
+                (Constant.LINKPLAY_HOST, Constant.LINKPLAY_TCP_PORT), timeout=Constant.LINKPLAY_TIMEOUT)
+        except OSError:
+            return False
+        try:
+            self.sock.sendall(
+                Constant.LINKPLAY_AUTHENTICATION.encode('utf-8') + MUX_MAGIC)
+            ack = recv_exactly(self.sock, len(MUX_ACK_PREFIX) + 1)
+        except (OSError, ConnectionError):
+            self.sock.close()
+            return False
+        if ack[:-1] != MUX_ACK_PREFIX:
+            self.sock.close()
+            return False
+
+        self.server_msgpack = bool(ack[-1] & 1)
+        self.sock.settimeout(None)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        Thread(target=self.read_loop, daemon=True).start()
+        return True
+
+    def read_loop(self) -> None:
+        try:
+            while True:
+                header = recv_exactly(self.sock, FRAME_HEADER.size)
+                length, request_id, flags = FRAME_HEADER.unpack(header)
+                if length > Constant.LINKPLAY_TCP_MAX_LENGTH:
+                    raise ConnectionError(
+                        'Too long body from link play server')
+                payload = recv_exactly(self.sock, length)
+                future = self.pending.pop(request_id, None)
+                if future is None:
+                    # 已超时
+                    continue
+                try:
+                    body = self.aead.decrypt(
+                        payload[:12], payload[12:], bytes(header[4:]))
+                    future.set_result(
+                        msgpack.unpackb(body) if flags & 1 else loads(body))
+                except Exception as e:
+                    future.set_exception(e)
+        except BaseException as e:
+            self.close(e)
+
+    def request(self, data: dict, use_msgpack: bool = False) -> Future:
+        if self.closed:
+            raise ConnectionError('Connection is closed')
+        self.used = True
+        request_id = next(self.request_ids) & 0xFFFFFFFF
+        flags = 1 if use_msgpack else 0
+        body = msgpack.packb(data) if use_msgpack else dumps(
+            data).encode('utf-8')
+        header_tail = struct.pack('<IB', request_id, flags)
+        iv = os.urandom(12)
+        payload = iv + self.aead.encrypt(iv, body, header_tail)
+
+        future = Future()
+        self.pending[request_id] = future
+        try:
+            with self.send_lock:
+                self.sock.sendall(struct.pack(
+                    '<I', len(payload)) + header_tail + payload)
+        except OSError as e:
+            self.close(e)
+            raise ConnectionError(str(e)) from e
+        return future
+
+    def cancel(self, future: Future) -> None:
+        for k, v in list(self.pending.items()):
+            if v is future:
+                self.pending.pop(k, None)
+
+    def close(self, e: BaseException = None) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+        pending = self.pending
+        self.pending = {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError(
+                    f'Connection to link play server is lost: {e}'))
+
+
+class LinkPlayChannel:
+    '''
+        每个进程到 Link Play 服务器的长连接池，`LINKPLAY_TCP_POOL_SIZE`条连接轮流使用
+        连接断开后下次请求时重连，复用的连接失败时换新连接重试一次
+        服务器不支持长连接或无法连接时，`LINKPLAY_TCP_RETRY_INTERVAL`秒内不再尝试，每次请求新建连接
+    '''
+    aead = AESGCM(TCP_AES_KEY)
+
+    lock = Lock()
+    connections: 'list[LinkPlayConnection]' = []
+    connecting: 'dict[int, Event]' = {}  # 正在建立连接的槽
+    counter = count()
+    unsupported_until = 0
+
+    @classmethod
+    def get_connection(cls) -> 'LinkPlayConnection | None':
+        i = next(cls.counter) % Constant.LINKPLAY_TCP_POOL_SIZE
+        while True:
+            if time() < cls.unsupported_until:
+                return None
+            with cls.lock:
+                if len(cls.connections) < Constant.LINKPLAY_TCP_POOL_SIZE:
+                    cls.connections.extend(
+                        [None] * (Constant.LINKPLAY_TCP_POOL_SIZE - len(cls.connections)))
+                x = cls.connections[i]
+                if x is not None and not x.closed:
+                    return x
+                event = cls.connecting.get(i)
+                if event is None:
+                    event = cls.connecting[i] = Event()
+                    break
+            # 其它线程正在连接这个槽，等待结果
+            event.wait(Constant.LINKPLAY_TIMEOUT)
+
+        # 连接和握手不持有锁，不阻塞其它槽
+        x = LinkPlayConnection(cls.aead)
+        ok = False
+        try:
+            ok = x.connect()
+        finally:
+            with cls.lock:
+                if cls.connecting.get(i) is event:
+                    del cls.connecting[i]
+                if not ok:
+                    cls.unsupported_until = time() + Constant.LINKPLAY_TCP_RETRY_INTERVAL
+                elif i < len(cls.connections):
+                    cls.connections[i] = x
+                else:
+                    # 连接期间执行了 close_all
+                    x.close()
+                    ok = False
+            event.set()
+        return x if ok else None
+
+    @classmethod
+    def request(cls, data: dict) -> 'dict | None':
+        '''返回解码后的响应，服务器不支持长连接时返回 None'''
+        for _ in range(2):
+            conn = cls.get_connection()
+            if conn is None:
+                return None
+            reused = conn.used
+            use_msgpack = Constant.LINKPLAY_TCP_USE_MSGPACK and msgpack is not None and conn.server_msgpack
+            try:
+                future = conn.request(data, use_msgpack)
+                return future.result(timeout=Constant.LINKPLAY_TIMEOUT)
+            except FutureTimeoutError as e:
+                conn.cancel(future)
+                raise Timeout(
+                    'Timeout when waiting for data from link play server.', status=400) from e
+            except ConnectionError as e:
+                if not reused:
+                    raise ArcError(str(e), status=400) from e
+        raise ArcError('Cannot connect to link play server.', status=400)
+
+    @classmethod
+    def close_all(cls) -> None:
+        with cls.lock:
+            for x in cls.connections:
+                if x is not None:
+                    x.close()
+            cls.connections = []
+
+    @classmethod
+    def after_fork(cls) -> None:
+        # 读取线程不会被 fork，子进程重新连接
+        cls.lock = Lock()
+        cls.connections = []
+        cls.connecting = {}
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=LinkPlayChannel.after_fork)
+
+
 class RemoteMultiPlayer:
-    TCP_AES_KEY = Constant.LINKPLAY_TCP_SECRET_KEY.encode(
-        'utf-8').ljust(16, b'\x00')[:16]
+    TCP_AES_KEY = TCP_AES_KEY
 
     def __init__(self) -> None:
         self.user: 'Player' = None
@@ -113,13 +351,14 @@ class RemoteMultiPlayer:
 
             sock.sendall(data)
             try:
-                cipher_len = int.from_bytes(sock.recv(8), byteorder='little')
+                cipher_len = int.from_bytes(
+                    recv_exactly(sock, 8), byteorder='little')
                 if cipher_len > Constant.LINKPLAY_TCP_MAX_LENGTH:
                     raise ArcError(
                         'Too long body from link play server', status=400)
-                iv = sock.recv(12)
-                tag = sock.recv(16)
-                ciphertext = sock.recv(cipher_len)
+                iv = bytes(recv_exactly(sock, 12))
+                tag = bytes(recv_exactly(sock, 16))
+                ciphertext = bytes(recv_exactly(sock, cipher_len))
                 received = aes_gcm_128_decrypt(
                     RemoteMultiPlayer.TCP_AES_KEY, b'', iv, ciphertext, tag)
             except socket.timeout as e:
@@ -129,13 +368,17 @@ class RemoteMultiPlayer:
             return received
 
     def data_swap(self, data: dict) -> dict:
-
-        iv, ciphertext, tag = aes_gcm_128_encrypt(
-            self.TCP_AES_KEY, dumps(data).encode('utf-8'), b'')
-        send_data = Constant.LINKPLAY_AUTHENTICATION.encode(
-            'utf-8') + len(ciphertext).to_bytes(8, byteorder='little') + iv + tag + ciphertext
-        recv_data = self.tcp(send_data)
-        self.data_recv = loads(recv_data)
+        self.data_recv = None
+        if Constant.LINKPLAY_TCP_POOL_SIZE > 0:
+            self.data_recv = LinkPlayChannel.request(data)
+
+        if self.data_recv is None:
+            iv, ciphertext, tag = aes_gcm_128_encrypt(
+                self.TCP_AES_KEY, dumps(data).encode('utf-8'), b'')
+            send_data = Constant.LINKPLAY_AUTHENTICATION.encode(
+                'utf-8') + len(ciphertext).to_bytes(8, byteorder='little') + iv + tag + ciphertext
+            recv_data = self.tcp(send_data)
+            self.data_recv = loads(recv_data)
 
         code = self.data_recv['code']
         if code != 0:
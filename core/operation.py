@@ -1,20 +1,37 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from json import loads
+from time import time
+
 from .bundle import BundleParser
 from .constant import Constant
 from .download import DownloadList
-from .error import NoData
+from .error import ArcError, NoData
+from .rank_index import RankIndex, WorldRankIndex
 from .save import SaveData
-from .score import Score
-from .sql import Connect, Sql
-from .user import User
+from .score import Potential, Score
+from .sql import Connect
+from .user import User, UserInfo
 from .world import MapParser
 
 
 class BaseOperation:
     _name: str = None
+    _progress: dict = None
 
     def __init__(self, *args, **kwargs):
         pass
 
+    def set_progress(self, **kwargs) -> None:
+        '''记录运行进度，可以通过 api 查询'''
+        x = dict(type(self)._progress or {})
+        x.update(kwargs)
+        type(self)._progress = x
+
+    @classmethod
+    def get_progress(cls) -> dict:
+        return cls._progress or {}
+
     def __call__(self, *args, **kwargs) -> None:
         return self.run(*args, **kwargs)
 
@@ -29,74 +46,90 @@ class RefreshAllScoreRating(BaseOperation):
     '''
         刷新所有成绩的评分
         包括 score_v2
+
+        按 rowid 顺序分块读取 best_score 和 recent30，批量计算后分块写回，
+        每块一个事务，避免长时间占用写锁
     '''
     _name = 'refresh_all_score_rating'
 
-    def run(self):
-        # 追求效率，不用Song类，尽量不用对象
-        # 但其实还是很慢
-        with Connect() as c:
-            c.execute(
-                '''select song_id, rating_pst, rating_prs, rating_ftr, rating_byn, rating_etr from chart''')
-            x = c.fetchall()
+    CHUNK_SIZE = 10000
 
-            songs = [i[0] for i in x]
-            c.execute(
-                f'''update best_score set rating=0 where song_id not in ({','.join(['?']*len(songs))})''', songs)
-
-            for i in x:
-                for j in range(0, 5):
-                    defnum = -10  # 没在库里的全部当做定数 -10
-                    if i[j+1] is not None and i[j+1] > 0:
-                        defnum = float(i[j+1]) / 10
-
-                    c.execute('''select user_id, score, shiny_perfect_count, perfect_count, near_count, miss_count from best_score where song_id=:a and difficulty=:b''', {
-                              'a': i[0], 'b': j})
-                    y = c.fetchall()
-                    values = []
-                    where_values = []
-                    for k in y:
-                        ptt = Score.calculate_rating(defnum, k[1])
-                        ptt = max(ptt, 0)
-                        score_v2 = Score.calculate_score_v2(
-                            defnum, k[2], k[3], k[4], k[5])
-                        values.append((ptt, score_v2,))
-                        where_values.append((k[0], i[0], j))
-                    if values:
-                        Sql(c).update_many('best_score', ['rating', 'score_v2'], values, [
-                            'user_id', 'song_id', 'difficulty'], where_values)
-
-            # 更新 recent30
-            song_defum: 'dict[str, list[int]]' = {}
-            for i in x:
-                song_defum[i[0]] = []
-                for j in range(0, 5):
-                    defnum = -10
-                    if i[j+1] is not None and i[j+1] > 0:
-                        defnum = float(i[j+1]) / 10
-                    song_defum[i[0]].append(defnum)
-
-            users = c.execute('''select user_id from user''').fetchall()
-            for i in users:
-                values = []
-                where_values = []
-                user_id = i[0]
+    def run(self):
+        self.set_progress(state='running', stage='best_score', done=0,
+                          total=0, start_time=int(time() * 1000), end_time=None)
+        try:
+            with Connect() as c:
                 c.execute(
-                    '''select r_index, song_id, difficulty, score from recent30 where user_id = ?''', (user_id,))
-                for j in c.fetchall():
-                    if j[1] in song_defum:
-                        defnum = song_defum[j[1]][j[2]]
-                    else:
-                        defnum = -10
-                    ptt = Score.calculate_rating(defnum, j[3])
-                    ptt = max(ptt, 0)
-
-                    values.append((ptt,))
-                    where_values.append((user_id, j[0]))
-
-                if values:
-                    Sql(c).update_many('recent30', ['rating'], values, [
-                        'user_id', 'r_index'], where_values)
+                    '''select song_id, rating_pst, rating_prs, rating_ftr, rating_byn, rating_etr from chart''')
+                # 没在库里的全部当做定数 -10
+                song_defnum: 'dict[str, list[float]]' = {i[0]: [
+                    float(j) / 10 if j is not None and j > 0 else -10 for j in i[1:]] for i in c.fetchall()}
+                best_total = c.execute(
+                    '''select count(*) from best_score''').fetchone()[0]
+                recent_total = c.execute(
+                    '''select count(*) from recent30''').fetchone()[0]
+
+            self.set_progress(total=best_total + recent_total)
+            self._refresh_best_score(song_defnum)
+            with Connect() as c:
+                Potential.clear_best_cache(c)
+                UserInfo.refresh_world_rank_score(c)
+            WorldRankIndex.clear()
+
+            self.set_progress(stage='recent30')
+            self._refresh_recent30(song_defnum)
+        except BaseException:
+            self.set_progress(state='failed', end_time=int(time() * 1000))
+            raise
+        self.set_progress(state='done', end_time=int(time() * 1000))
+
+    def _refresh_best_score(self, song_defnum: dict) -> None:
+        last_rowid = 0
+        while True:
+            x = None
+            with Connect() as c:
+                c.execute('''select rowid, song_id, difficulty, score, shiny_perfect_count, perfect_count, near_count, miss_count, score_v2 from best_score where rowid > ? order by rowid limit ?''',
+                          (last_rowid, self.CHUNK_SIZE))
+                x = c.fetchall()
+                if not x:
+                    break
+
+                defnums = [song_defnum[i[1]][i[2]]
+                           if i[1] in song_defnum else -10 for i in x]
+                ratings = Score.calculate_rating_many(
+                    defnums, [i[3] for i in x])
+                score_v2s = Score.calculate_score_v2_many(
+                    defnums, [i[4] for i in x], [i[5] for i in x], [i[6] for i in x], [i[7] for i in x])
+
+                # 不在库里的谱面只清空 rating，score_v2 不变
+                c.executemany('''update best_score set rating = ?, score_v2 = ? where rowid = ?''', [
+                              (max(r, 0), v if i[1] in song_defnum else i[8], i[0]) for i, r, v in zip(x, ratings, score_v2s)])
+                last_rowid = x[-1][0]
+            if x is None or last_rowid != x[-1][0]:
+                # Connect 吞掉了异常，已经记录日志
+                raise ArcError('Failed to refresh the ratings of `best_score`.')
+            self.set_progress(done=self.get_progress()['done'] + len(x))
+
+    def _refresh_recent30(self, song_defnum: dict) -> None:
+        last_rowid = 0
+        while True:
+            x = None
+            with Connect() as c:
+                c.execute('''select rowid, song_id, difficulty, score from recent30 where rowid > ? order by rowid limit ?''',
+                          (last_rowid, self.CHUNK_SIZE))
+                x = c.fetchall()
+                if not x:
+                    break
+
+                ratings = Score.calculate_rating_many([song_defnum[i[1]][i[2]] if i[1] in song_defnum else -10 for i in x], [
+                                                      i[3] for i in x])
+                c.executemany('''update recent30 set rating = ? where rowid = ?''', [
+                              (max(r, 0), i[0]) for i, r in zip(x, ratings)])
+                last_rowid = x[-1][0]
+            if x is None or last_rowid != x[-1][0]:
+                # Connect 吞掉了异常，已经记录日志
+                raise ArcError('Failed to refresh the ratings of `recent30`.')
+            self.set_progress(done=self.get_progress()['done'] + len(x))
 
 
 class RefreshSongFileCache(BaseOperation):
@@ -106,6 +139,17 @@ class RefreshSongFileCache(BaseOperation):
     '''
     _name = 'refresh_song_file_cache'
 
+    def run(self):
+        DownloadList.clear_all_cache()
+        DownloadList.initialize_cache(full_hash=True)
+
+
+class RefreshChangedSongFileCache(BaseOperation):
+    '''
+        刷新歌曲文件缓存，文件hash只重新计算新增或大小、修改时间变化的文件
+    '''
+    _name = 'refresh_changed_song_file_cache'
+
     def run(self):
         DownloadList.clear_all_cache()
         DownloadList.initialize_cache()
@@ -131,20 +175,89 @@ class RefreshWorldMapCache(BaseOperation):
         MapParser().re_init()
 
 
+class RefreshRankIndex(BaseOperation):
+    '''
+        重建谱面排行和世界排名索引，清空后按需重新加载
+        同时重新求和所有用户的 world_rank_score，修正增量更新的累积误差
+    '''
+    _name = 'refresh_rank_index'
+
+    def run(self):
+        with Connect() as c:
+            UserInfo.refresh_world_rank_score(c)
+        RankIndex.clear()
+        WorldRankIndex.clear()
+
+
+_song_chart_const: 'dict[str, list]' = None
+
+
+def _init_save_update_score_worker(song_chart_const: dict) -> None:
+    global _song_chart_const
+    _song_chart_const = song_chart_const
+
+
+def _get_save_best_scores(user_id: int, scores_data: list, clearlamps_data: list, song_chart_const: dict) -> list:
+    '''由云存档的成绩计算 best_score 的行'''
+    clear_state = {f'{i["song_id"]}{i["difficulty"]}': i['clear_type']
+                   for i in clearlamps_data}
+
+    new_scores = []
+    for i in scores_data:
+        rating = 0
+        score_v2 = 0
+        if i['song_id'] in song_chart_const:
+            defnum = song_chart_const[i['song_id']][i['difficulty']] / 10
+            rating = Score.calculate_rating(defnum, i['score'])
+            rating = max(rating, 0)
+
+            score_v2 = Score.calculate_score_v2(
+                defnum, i['shiny_perfect_count'], i['perfect_count'], i['near_count'], i['miss_count'])
+
+        y = f'{i["song_id"]}{i["difficulty"]}'
+        if y in clear_state:
+            clear_type = clear_state[y]
+        else:
+            clear_type = 0
+
+        new_scores.append((user_id, i['song_id'], i['difficulty'], i['score'], i['shiny_perfect_count'], i['perfect_count'],
+                           i['near_count'], i['miss_count'], i['health'], i['modifier'], i['time_played'], clear_type, clear_type, rating, score_v2))
+    return new_scores
+
+
+def _decode_save_best_scores(row: tuple) -> list:
+    '''子进程中解析云存档，row: (user_id, scores_data, clearlamps_data)'''
+    return _get_save_best_scores(row[0], loads(row[1])[""], loads(row[2])[""], _song_chart_const)
+
+
 class SaveUpdateScore(BaseOperation):
     '''
         云存档更新成绩，是覆盖式更新
         提供user参数时，只更新该用户的成绩，否则更新所有用户的成绩
+
+        更新所有用户时，分批读取 user_save 解析，单连接每 COMMIT_USERS 个用户提交一次，
+        并记录检查点，中断后再次运行会从检查点继续
+        默认在当前进程中解析；`processes` > 1 时使用进程池，0 为 CPU 核数，
+        进程池会 fork 当前进程，只应在命令行等独立进程中使用，不要在 web 请求中开启
     '''
     _name = 'save_update_score'
 
+    READ_BATCH_SIZE = 200
+    COMMIT_USERS = 1000
+    CHECKPOINT_KEY = 'save_update_score_checkpoint'
+
     def __init__(self, user=None):
         self.user = user
+        self.resume = True
+        self.processes = 1
 
-    def set_params(self, user_id: int = None, *args, **kwargs):
+    def set_params(self, user_id: int = None, resume: bool = True, processes: int = None, *args, **kwargs):
         if user_id is not None:
             self.user = User()
             self.user.user_id = int(user_id)
+        self.resume = bool(resume)
+        if processes is not None:
+            self.processes = int(processes)
 
     def run(self, user=None):
         '''
@@ -157,15 +270,14 @@ class SaveUpdateScore(BaseOperation):
             self._one_user_update()
         else:
             self._all_update()
+        RankIndex.clear()
+        WorldRankIndex.clear()
 
     def _one_user_update(self):
         with Connect() as c:
             save = SaveData(c)
             save.select_scores(self.user)
 
-            clear_state = {f'{i["song_id"]}{i["difficulty"]}': i['clear_type']
-                           for i in save.clearlamps_data}
-
             song_id_1 = [i['song_id'] for i in save.scores_data]
             song_id_2 = [i['song_id'] for i in save.clearlamps_data]
             song_id = list(set(song_id_1 + song_id_2))
@@ -176,30 +288,13 @@ class SaveUpdateScore(BaseOperation):
             song_chart_const = {i[0]: [i[1], i[2], i[3], i[4], i[5]]
                                 for i in x}  # chart const * 10
 
-            new_scores = []
-            for i in save.scores_data:
-                rating = 0
-                score_v2 = 0
-                if i['song_id'] in song_chart_const:
-                    defnum = song_chart_const[i['song_id']
-                                              ][i['difficulty']] / 10
-                    rating = Score.calculate_rating(defnum, i['score'])
-                    rating = max(rating, 0)
-
-                    score_v2 = Score.calculate_score_v2(
-                        defnum, i['shiny_perfect_count'], i['perfect_count'], i['near_count'], i['miss_count'])
-
-                y = f'{i["song_id"]}{i["difficulty"]}'
-                if y in clear_state:
-                    clear_type = clear_state[y]
-                else:
-                    clear_type = 0
-
-                new_scores.append((self.user.user_id, i['song_id'], i['difficulty'], i['score'], i['shiny_perfect_count'], i['perfect_count'],
-                                   i['near_count'], i['miss_count'], i['health'], i['modifier'], i['time_played'], clear_type, clear_type, rating, score_v2))
+            new_scores = _get_save_best_scores(
+                self.user.user_id, save.scores_data, save.clearlamps_data, song_chart_const)
 
             c.executemany(
                 '''insert or replace into best_score values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', new_scores)
+            Potential.clear_best_cache(c, self.user.user_id)
+            UserInfo.refresh_world_rank_score(c, self.user.user_id)
 
     def _all_update(self):
         with Connect() as c:
@@ -207,40 +302,80 @@ class SaveUpdateScore(BaseOperation):
                 '''select song_id, rating_pst, rating_prs, rating_ftr, rating_byn, rating_etr from chart''')
             song_chart_const = {i[0]: [i[1], i[2], i[3], i[4], i[5]]
                                 for i in c.fetchall()}  # chart const * 10
-            c.execute('''select user_id from user_save''')
-            for y in c.fetchall():
-                user = User()
-                user.user_id = y[0]
-                save = SaveData(c)
-                save.select_scores(user)
-
-                clear_state = {f'{i["song_id"]}{i["difficulty"]}': i['clear_type']
-                               for i in save.clearlamps_data}
-
-                new_scores = []
-                for i in save.scores_data:
-                    rating = 0
-                    score_v2 = 0
-                    if i['song_id'] in song_chart_const:
-                        defnum = song_chart_const[i['song_id']
-                                                  ][i['difficulty']] / 10
-                        rating = Score.calculate_rating(defnum, i['score'])
-                        rating = max(rating, 0)
-
-                        score_v2 = Score.calculate_score_v2(
-                            defnum, i['shiny_perfect_count'], i['perfect_count'], i['near_count'], i['miss_count'])
-
-                    y = f'{i["song_id"]}{i["difficulty"]}'
-                    if y in clear_state:
-                        clear_type = clear_state[y]
-                    else:
-                        clear_type = 0
-
-                    new_scores.append((user.user_id, i['song_id'], i['difficulty'], i['score'], i['shiny_perfect_count'], i['perfect_count'],
-                                       i['near_count'], i['miss_count'], i['health'], i['modifier'], i['time_played'], clear_type, clear_type, rating, score_v2))
 
+            last_user_id = -1
+            if self.resume:
+                x = c.execute('''select value from config where id = ?''',
+                              (self.CHECKPOINT_KEY,)).fetchone()
+                if x is not None:
+                    last_user_id = int(x[0])
+            total = c.execute('''select count(*) from user_save where user_id > ?''',
+                              (last_user_id,)).fetchone()[0]
+
+        start_time = time()
+        self.set_progress(state='running', done=0, total=total, users_per_second=0,
+                          checkpoint=last_user_id, start_time=int(start_time * 1000), end_time=None)
+
+        processes = self.processes if self.processes > 0 else os.cpu_count()
+        try:
+            if processes and processes > 1:
+                with ProcessPoolExecutor(processes, initializer=_init_save_update_score_worker, initargs=(song_chart_const,)) as executor:
+                    self._all_update_pipeline(
+                        last_user_id, start_time, lambda rows: executor.map(_decode_save_best_scores, rows, chunksize=16))
+            else:
+                _init_save_update_score_worker(song_chart_const)
+                self._all_update_pipeline(
+                    last_user_id, start_time, lambda rows: map(_decode_save_best_scores, rows))
+        except BaseException:
+            self.set_progress(state='failed', end_time=int(time() * 1000))
+            raise
+
+        with Connect() as c:
+            c.execute('''delete from config where id = ?''',
+                      (self.CHECKPOINT_KEY,))
+            Potential.clear_best_cache(c)
+            UserInfo.refresh_world_rank_score(c)
+        self.set_progress(state='done', end_time=int(time() * 1000))
+
+    def _read_user_save(self, last_user_id: int) -> list:
+        with Connect() as c:
+            c.execute('''select user_id, scores_data, clearlamps_data from user_save where user_id > ? order by user_id limit ?''',
+                      (last_user_id, self.READ_BATCH_SIZE))
+            return c.fetchall()
+
+    def _all_update_pipeline(self, last_user_id: int, start_time: float, decode) -> None:
+        '''读取下一批的同时，解析当前批，写入由当前线程完成'''
+        rows = self._read_user_save(last_user_id)
+        pending = []  # [(user_id, new_scores)]
+        done = 0
+        while rows:
+            results = decode(rows)
+            user_ids = [i[0] for i in rows]
+            next_rows = self._read_user_save(user_ids[-1])
+            pending.extend(zip(user_ids, results))
+            rows = next_rows
+
+            if len(pending) >= self.COMMIT_USERS or not rows:
+                self._write_best_scores(pending)
+                done += len(pending)
+                self.set_progress(done=done, checkpoint=pending[-1][0],
+                                  users_per_second=round(done / max(time() - start_time, 1e-6), 2))
+                pending = []
+
+    def _write_best_scores(self, pending: list) -> None:
+        '''一个事务写入多个用户的成绩和检查点'''
+        flag = False
+        with Connect() as c:
+            for _, new_scores in pending:
                 c.executemany(
                     '''insert or replace into best_score values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', new_scores)
+            c.execute('''insert or replace into config values(?, ?)''',
+                      (self.CHECKPOINT_KEY, str(pending[-1][0])))
+            flag = True
+        if not flag:
+            # Connect 吞掉了异常，已经记录日志
+            raise ArcError(
+                f'Failed to update the scores of users before `{pending[-1][0]}`.')
 
 
 class UnlockUserItem(BaseOperation):
@@ -343,6 +478,10 @@ class DeleteUserScore(BaseOperation):
                       (Constant.SQLITE_DATABASE_DELETED_PATH,))
             _delete_one_table(c, 'best_score', self.user.user_id)
             _delete_one_table(c, 'recent30', self.user.user_id)
+            Potential.clear_best_cache(c, self.user.user_id)
+            UserInfo.refresh_world_rank_score(c, self.user.user_id)
+        RankIndex.clear()
+        WorldRankIndex.clear()
 
 
 class DeleteOneUser(BaseOperation):
@@ -371,6 +510,9 @@ class DeleteOneUser(BaseOperation):
 
             self._clear_login(c)
             self._data_save(c)
+            Potential.clear_best_cache(c, self.user.user_id)
+        RankIndex.clear()
+        WorldRankIndex.clear()
 
     def _data_save(self, c):
         c.execute(
@@ -1,4 +1,5 @@
 from .constant import Constant
+from .rank_index import RankIndex
 from .score import UserScore
 from .song import Chart
 from .sql import Query, Sql
@@ -12,6 +13,7 @@ class RankList:
 
         property: `user` - `User`类或者子类的实例
     '''
+    SELECT_CHUNK_SIZE = 900
 
     def __init__(self, c=None) -> None:
         self.c = c
@@ -23,18 +25,33 @@ class RankList:
     def to_dict_list(self) -> list:
         return [x.to_dict() for x in self.list]
 
+    def select_by_user_ids(self, user_ids: list) -> list:
+        '''按给定的 user_id 顺序查询本谱面成绩'''
+        x = {}
+        # 分批查询，避免超过 SQLite 的参数数量限制（旧版本为 999）
+        for j in range(0, len(user_ids), self.SELECT_CHUNK_SIZE):
+            ids = user_ids[j:j + self.SELECT_CHUNK_SIZE]
+            self.c.execute(f'''select * from best_score where song_id = ? and difficulty = ? and user_id in ({','.join(['?'] * len(ids))})''', [
+                           self.song.song_id, self.song.difficulty] + ids)
+            x.update((i[0], i) for i in self.c.fetchall())
+        return [x[i] for i in user_ids if i in x]
+
     def select_top(self) -> None:
         '''
             得到top分数表
         '''
-        if self.limit >= 0:
+        index = RankIndex.get(self.c, self.song.song_id, self.song.difficulty)
+        if index is not None:
+            x = self.select_by_user_ids(index.slice(0, self.limit))
+        elif self.limit >= 0:
             self.c.execute('''select * from best_score where song_id = :song_id and difficulty = :difficulty order by score DESC, time_played DESC limit :limit''', {
                 'song_id': self.song.song_id, 'difficulty': self.song.difficulty, 'limit': self.limit})
         else:
             self.c.execute('''select * from best_score where song_id = :song_id and difficulty = :difficulty order by score DESC, time_played DESC''', {
                 'song_id': self.song.song_id, 'difficulty': self.song.difficulty})
 
-        x = self.c.fetchall()
+        if index is None:
+            x = self.c.fetchall()
         if not x:
             return None
 
@@ -118,23 +135,32 @@ class RankList:
         '''
         if user:
             self.user = user
-        self.c.execute('''select score, time_played from best_score where user_id = :user_id and song_id = :song_id and difficulty = :difficulty''', {
-            'user_id': self.user.user_id, 'song_id': self.song.song_id, 'difficulty': self.song.difficulty})
-        x = self.c.fetchone()
-        if not x:
-            return None
-
-        self.c.execute('''select count(*) from best_score where song_id = :song_id and difficulty = :difficulty and ( score > :score or (score = :score and time_played > :time_played) )''', {
-            'user_id': self.user.user_id, 'song_id': self.song.song_id, 'difficulty': self.song.difficulty, 'score': x[0], 'time_played': x[1]})
-        my_rank = int(self.c.fetchone()[0]) + 1
-        self.c.execute('''select count(*) from best_score where song_id=:a and difficulty=:b''',
-                       {'a': self.song.song_id, 'b': self.song.difficulty})
-
-        sql_limit, sql_offset, need_myself = self.get_my_rank_parameter(
-            my_rank, int(self.c.fetchone()[0]), self.limit)
-        self.c.execute('''select * from best_score where song_id = :song_id and difficulty = :difficulty order by score DESC, time_played DESC limit :limit offset :offset''', {
-            'song_id': self.song.song_id, 'difficulty': self.song.difficulty, 'limit': sql_limit, 'offset': sql_offset})
-        x = self.c.fetchall()
+        index = RankIndex.get(self.c, self.song.song_id, self.song.difficulty)
+        if index is not None:
+            my_rank = index.rank(self.user.user_id)
+            if my_rank is None:
+                return None
+            sql_limit, sql_offset, need_myself = self.get_my_rank_parameter(
+                my_rank, index.amount, self.limit)
+            x = self.select_by_user_ids(index.slice(sql_offset, sql_limit))
+        else:
+            self.c.execute('''select score, time_played from best_score where user_id = :user_id and song_id = :song_id and difficulty = :difficulty''', {
+                'user_id': self.user.user_id, 'song_id': self.song.song_id, 'difficulty': self.song.difficulty})
+            x = self.c.fetchone()
+            if not x:
+                return None
+
+            self.c.execute('''select count(*) from best_score where song_id = :song_id and difficulty = :difficulty and ( score > :score or (score = :score and time_played > :time_played) )''', {
+                'user_id': self.user.user_id, 'song_id': self.song.song_id, 'difficulty': self.song.difficulty, 'score': x[0], 'time_played': x[1]})
+            my_rank = int(self.c.fetchone()[0]) + 1
+            self.c.execute('''select count(*) from best_score where song_id=:a and difficulty=:b''',
+                           {'a': self.song.song_id, 'b': self.song.difficulty})
+
+            sql_limit, sql_offset, need_myself = self.get_my_rank_parameter(
+                my_rank, int(self.c.fetchone()[0]), self.limit)
+            self.c.execute('''select * from best_score where song_id = :song_id and difficulty = :difficulty order by score DESC, time_played DESC limit :limit offset :offset''', {
+                'song_id': self.song.song_id, 'difficulty': self.song.difficulty, 'limit': sql_limit, 'offset': sql_offset})
+            x = self.c.fetchall()
 
         if x:
             user_info_list = Sql(self.c).select('user', ['user_id', 'name', 'character_id', 'is_skill_sealed', 'is_char_uncapped',
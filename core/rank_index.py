@@ -0,0 +1,181 @@
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict
+from threading import Event, RLock
+
+from .config_manager import Config
+
+
+class ChartRankIndex:
+    '''
+        单谱面排行索引，按 (score DESC, time_played DESC) 排序
+
+        keys 为升序列表，元素为 (-score, -time_played, user_id)
+    '''
+
+    def __init__(self, rows: list = None) -> None:
+        self.users: 'dict[int, tuple]' = {}
+        self.keys: list = []
+        if rows:
+            for user_id, score, time_played in rows:
+                self.users[user_id] = (-score, -time_played, user_id)
+            self.keys = sorted(self.users.values())
+
+    @property
+    def amount(self) -> int:
+        return len(self.keys)
+
+    def upsert(self, user_id: int, score: int, time_played: int) -> None:
+        self.remove(user_id)
+        key = (-score, -time_played, user_id)
+        self.users[user_id] = key
+        insort(self.keys, key)
+
+    def remove(self, user_id: int) -> None:
+        key = self.users.pop(user_id, None)
+        if key is not None:
+            i = bisect_left(self.keys, key)
+            if i < len(self.keys) and self.keys[i] == key:
+                del self.keys[i]
+
+    def rank(self, user_id: int) -> int:
+        '''返回排名，分数和时间都相同的并列，无成绩返回None'''
+        key = self.users.get(user_id)
+        if key is None:
+            return None
+        return bisect_left(self.keys, key[:2]) + 1
+
+    def slice(self, offset: int = 0, limit: int = -1) -> 'list[int]':
+        '''返回 user_id 列表，limit<0认为是all'''
+        offset = max(offset, 0)
+        x = self.keys[offset:] if limit < 0 else self.keys[offset:offset + limit]
+        return [i[2] for i in x]
+
+
+class RankIndex:
+    '''
+        内存排行索引，按谱面懒加载，数据库仍为唯一数据源
+
+        只适用于单进程部署，多进程时各进程的索引会不一致
+    '''
+    lock = RLock()
+    charts: 'OrderedDict[tuple, ChartRankIndex]' = OrderedDict()
+    # 构建中的谱面: (完成事件, 构建期间的更新)，更新在构建后重放
+    building: 'dict[tuple, tuple[Event, list]]' = {}
+
+    @classmethod
+    def get(cls, c, song_id: str, difficulty: int) -> ChartRankIndex:
+        '''获取谱面索引，未开启时返回None；同一谱面只由一个线程构建，其余等待'''
+        if not Config.USE_RANK_INDEX:
+            return None
+        k = (song_id, difficulty)
+        while True:
+            with cls.lock:
+                x = cls.charts.get(k)
+                if x is not None:
+                    cls.charts.move_to_end(k)
+                    return x
+                b = cls.building.get(k)
+                if b is None:
+                    b = cls.building[k] = (Event(), [])
+                    break
+            b[0].wait()
+
+        x = None
+        try:
+            c.execute('''select user_id, score, time_played from best_score where song_id = :a and difficulty = :b''', {
+                      'a': song_id, 'b': difficulty})
+            x = ChartRankIndex(c.fetchall())
+        finally:
+            with cls.lock:
+                if x is not None:
+                    for i in b[1]:
+                        x.upsert(*i)
+                # 构建期间被 clear 时数据可能已过期，只用于本次查询，不保存
+                if cls.building.get(k) is b:
+                    del cls.building[k]
+                    if x is not None:
+                        cls.charts[k] = x
+                        while len(cls.charts) > Config.RANK_INDEX_MAX_CHARTS:
+                            cls.charts.popitem(last=False)
+                b[0].set()
+        return x
+
+    @classmethod
+    def update(cls, song_id: str, difficulty: int, user_id: int, score: int, time_played: int) -> None:
+        '''成绩更新，未加载的谱面忽略'''
+        if not Config.USE_RANK_INDEX:
+            return
+        k = (song_id, difficulty)
+        with cls.lock:
+            x = cls.charts.get(k)
+            if x is not None:
+                x.upsert(user_id, score, time_played)
+            elif k in cls.building:
+                cls.building[k][1].append((user_id, score, time_played))
+
+    @classmethod
+    def clear(cls) -> None:
+        '''清空索引，之后按需重建'''
+        with cls.lock:
+            cls.charts.clear()
+            cls.building.clear()
+
+
+class WorldRankIndex:
+    '''
+        世界排名索引，按 world_rank_score 升序保存所有分数大于0的用户，懒加载
+
+        只适用于单进程部署，多进程时各进程的索引会不一致
+    '''
+    lock = RLock()
+    users: 'dict[int, float]' = None
+    scores: list = None
+
+    @classmethod
+    def build(cls, c) -> list:
+        c.execute(
+            '''select user_id, world_rank_score from user where world_rank_score > 0''')
+        users = {i[0]: i[1] for i in c.fetchall()}
+        scores = sorted(users.values())
+        with cls.lock:
+            cls.users = users
+            cls.scores = scores
+        return scores
+
+    @classmethod
+    def get_rank(cls, c, world_rank_score: float) -> int:
+        '''
+            返回排名，超过 WORLD_RANK_MAX 返回0
+            未开启时返回None
+        '''
+        if not Config.USE_RANK_INDEX:
+            return None
+        scores = cls.scores
+        if scores is None:
+            scores = cls.build(c)
+        with cls.lock:
+            r = len(scores) - bisect_right(scores, world_rank_score) + 1
+        return r if r <= Config.WORLD_RANK_MAX else 0
+
+    @classmethod
+    def update(cls, user_id: int, world_rank_score: float) -> None:
+        if not Config.USE_RANK_INDEX:
+            return
+        with cls.lock:
+            if cls.scores is None:
+                return
+            old = cls.users.pop(user_id, None)
+            if old is not None:
+                i = bisect_left(cls.scores, old)
+                if i < len(cls.scores) and cls.scores[i] == old:
+                    del cls.scores[i]
+            if world_rank_score and world_rank_score > 0:
+                cls.users[user_id] = world_rank_score
+                insort(cls.scores, world_rank_score)
+
+    @classmethod
+    def clear(cls) -> None:
+        '''清空索引，之后按需重建'''
+        with cls.lock:
+            cls.users = None
+            cls.scores = None
@@ -1,19 +1,28 @@
 from base64 import b64encode
+from bisect import insort
+from heapq import nlargest
+from json import dumps, loads
 from os import urandom
 from random import choices
 from time import time
 
-from .bgtask import BGTask, logdb_execute
+from .bgtask import logdb_execute
 from .config_manager import Config
 from .constant import Constant
 from .course import CoursePlay
 from .error import NoData, StaminaNotEnough
 from .item import ItemCore
+from .rank_index import RankIndex
 from .song import Chart
-from .sql import Connect, Query, Sql
+from .sql import Connect, Query, Sql, UserKVTable
 from .util import get_today_timestamp, md5
 from .world import BeyondWorldPlay, BreachedWorldPlay, WorldPlay
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 
 class Score:
     def __init__(self) -> None:
@@ -143,6 +152,39 @@ class Score:
         score_rating = max(0, min(score_ratio - 0.99, 0.01)) * 75
         return defnum * (acc_rating + score_rating)
 
+    @staticmethod
+    def calculate_rating_many(defnums: list, scores: list) -> list:
+        '''批量计算rating，结果与`calculate_rating`一致，有NumPy时向量化计算'''
+        if np is None or not defnums:
+            return [Score.calculate_rating(d, s) for d, s in zip(defnums, scores)]
+
+        d = np.asarray(defnums, dtype=np.float64)
+        s = np.asarray(scores, dtype=np.float64)
+        ptt = np.where(s >= 10000000, d + 2, np.where(s < 9800000, np.maximum(
+            d + (s - 9500000) / 300000, 0), d + 1 + (s - 9800000) / 200000))
+        return np.where(d > 0, ptt, -1).tolist()
+
+    @staticmethod
+    def calculate_score_v2_many(defnums: list, shiny_perfect_counts: list, perfect_counts: list, near_counts: list, miss_counts: list) -> list:
+        '''批量计算score_v2，结果与`calculate_score_v2`一致，有NumPy时向量化计算'''
+        if np is None or not defnums:
+            return [Score.calculate_score_v2(*x) for x in zip(defnums, shiny_perfect_counts, perfect_counts, near_counts, miss_counts)]
+
+        d = np.asarray(defnums, dtype=np.float64)
+        sp = np.asarray(shiny_perfect_counts, dtype=np.float64)
+        p = np.asarray(perfect_counts, dtype=np.float64)
+        n = np.asarray(near_counts, dtype=np.float64)
+        all_note = p + n + np.asarray(miss_counts, dtype=np.float64)
+        valid = (d > 0) & (all_note != 0)
+        all_note = np.where(all_note == 0, 1, all_note)
+        shiny_ratio = sp / all_note
+        score_ratio = (p + n / 2) / all_note + sp / 10000000
+        acc_rating = np.maximum(
+            0, np.minimum(shiny_ratio - 0.9, 0.095)) / 9.5 * 25
+        score_rating = np.maximum(
+            0, np.minimum(score_ratio - 0.99, 0.01)) * 75
+        return np.where(valid, d * (acc_rating + score_rating), 0).tolist()
+
     def get_rating_by_calc(self) -> float:
         # 通过计算得到本成绩的 rating & score_v2
         if not self.song.defnum:
@@ -451,15 +493,8 @@ class UserPlay(UserScore):
 
     def record_rating_ptt(self, user_rating_ptt: float) -> None:
         '''向log数据库记录用户ptt变化'''
-        today_timestamp = get_today_timestamp()
-        with Connect(Config.SQLITE_LOG_DATABASE_PATH) as c2:
-            old_ptt = c2.execute('''select rating_ptt from user_rating where user_id=? and time=?''', (
-                self.user.user_id, today_timestamp)).fetchone()
-
-            old_ptt = 0 if old_ptt is None else old_ptt[0]
-            if old_ptt != user_rating_ptt:
-                c2.execute('''insert or replace into user_rating values(?,?,?)''',
-                           (self.user.user_id, today_timestamp, user_rating_ptt))
+        logdb_execute('''insert or replace into user_rating select :a, :b, :c where :c != coalesce((select rating_ptt from user_rating where user_id = :a and time = :b), 0)''', {
+                      'a': self.user.user_id, 'b': get_today_timestamp(), 'c': user_rating_ptt})
 
     def upload_score(self) -> None:
         '''上传分数，包括user的recent更新，best更新，recent30更新，世界模式计算'''
@@ -481,7 +516,8 @@ class UserPlay(UserScore):
             'a': self.user.user_id, 'b': self.song.song_id, 'c': self.song.difficulty, 'd': self.score, 'e': self.shiny_perfect_count, 'f': self.perfect_count, 'g': self.near_count, 'h': self.miss_count, 'i': self.health, 'j': self.modifier, 'k': self.clear_type, 'l': self.rating, 'm': self.time_played * 1000})
 
         # 成绩录入
-        self.c.execute('''select score, best_clear_type from best_score where user_id = :a and song_id = :b and difficulty = :c''', {
+        self.ptt = Potential(self.c, self.user)
+        self.c.execute('''select score, best_clear_type, score_v2, rating from best_score where user_id = :a and song_id = :b and difficulty = :c''', {
             'a': self.user.user_id, 'b': self.song.song_id, 'c': self.song.difficulty})
         x = self.c.fetchone()
         if not x:
@@ -489,7 +525,10 @@ class UserPlay(UserScore):
             self.c.execute('''insert into best_score values(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
                            (self.user.user_id, self.song.song_id, self.song.difficulty, self.score, self.shiny_perfect_count, self.perfect_count, self.near_count, self.miss_count,
                             self.health, self.modifier, self.time_played, self.clear_type, self.clear_type, self.rating, self.score_v2))
-            self.user.update_global_rank()
+            Connect.after_commit(self.c, RankIndex.update, self.song.song_id, self.song.difficulty,
+                                 self.user.user_id, self.score, self.time_played)
+            self.user.update_global_rank(self.song, 0, self.score_v2)
+            self.ptt.update_best(self.song, None, self.rating)
         else:
             self.new_best_protect_flag = False
             if self.song_state > self.get_song_state(int(x[1])):  # best状态更新
@@ -499,16 +538,19 @@ class UserPlay(UserScore):
                 self.new_best_protect_flag = True
                 self.c.execute('''update best_score set score = :d, shiny_perfect_count = :e, perfect_count = :f, near_count = :g, miss_count = :h, health = :i, modifier = :j, clear_type = :k, rating = :l, time_played = :m, score_v2 = :n  where user_id = :a and song_id = :b and difficulty = :c ''', {
                     'a': self.user.user_id, 'b': self.song.song_id, 'c': self.song.difficulty, 'd': self.score, 'e': self.shiny_perfect_count, 'f': self.perfect_count, 'g': self.near_count, 'h': self.miss_count, 'i': self.health, 'j': self.modifier, 'k': self.clear_type, 'l': self.rating, 'm': self.time_played, 'n': self.score_v2})
-                self.user.update_global_rank()
+                Connect.after_commit(self.c, RankIndex.update, self.song.song_id, self.song.difficulty,
+                                     self.user.user_id, self.score, self.time_played)
+                self.user.update_global_rank(
+                    self.song, x[2], self.score_v2)
+                self.ptt.update_best(self.song, x[3], self.rating)
 
-        self.ptt = Potential(self.c, self.user)
         if not self.unrank_flag:
             self.ptt.r30_push_score(self)
 
         # 总PTT更新
         user_rating_ptt = self.ptt.value
         self.user.rating_ptt = int(user_rating_ptt * 100)
-        BGTask(self.record_rating_ptt, user_rating_ptt)  # 记录总PTT变换
+        self.record_rating_ptt(user_rating_ptt)  # 记录总PTT变换
         self.c.execute('''update user set rating_ptt = :a where user_id = :b''', {
             'a': self.user.rating_ptt, 'b': self.user.user_id})
 
@@ -558,9 +600,81 @@ class Potential:
         return total
 
     def best_n(self, n) -> float:
-        self.c.execute(f'''select rating from best_score where user_id = :a order by rating DESC limit {n}''', {
+        x = self.select_best_cache(n)
+        if x is None:
+            x = self.update_best_cache(n)
+        return -sum(i[0] for i in x['items'])
+
+    def select_best_cache(self, n) -> dict:
+        '''获取缓存的 best n 状态，不存在返回None'''
+        x = UserKVTable(self.c, self.user.user_id, 'potential').get('best', n)
+        return loads(x) if x else None
+
+    def update_best_cache(self, n) -> dict:
+        '''
+            从 best_score 重建 best n 状态
+
+            `items`: 前n个成绩 [-rating, song_id, difficulty]，升序
+            `threshold`: 第n+1个成绩的 rating，不足n+1个时为0
+        '''
+        self.c.execute(f'''select rating, song_id, difficulty from best_score where user_id = :a order by rating DESC limit {n + 1}''', {
             'a': self.user.user_id})
-        return sum(x[0] for x in self.c.fetchall())
+        x = self.c.fetchall()
+        r = {
+            'items': sorted([-i[0], i[1], i[2]] for i in x[:n]),
+            'threshold': x[n][0] if len(x) > n else 0
+        }
+        UserKVTable(self.c, self.user.user_id,
+                    'potential').set('best', dumps(r), n)
+        return r
+
+    def update_best(self, chart: 'Chart', old_rating: float, new_rating: float) -> None:
+        '''best 成绩的 rating 改变，更新 best n 缓存，无法确定结果时删除缓存'''
+        for kind, n, _ in Constant.PTT_FORMULA:
+            if kind != 'best':
+                continue
+            x = self.select_best_cache(n)
+            if x is None:
+                continue
+            items = x['items']
+            pos = None
+            for i, y in enumerate(items):
+                if y[1] == chart.song_id and y[2] == chart.difficulty:
+                    pos = i
+                    break
+
+            new_item = [-new_rating, chart.song_id, chart.difficulty]
+            if pos is not None:
+                if len(items) == n and new_rating < x['threshold']:
+                    x = None  # 第n+1个成绩会进入前n，但不知道是哪个
+                else:
+                    del items[pos]
+                    insort(items, new_item)
+            elif len(items) < n:
+                insort(items, new_item)
+            elif old_rating is not None and old_rating >= x['threshold'] and new_rating < old_rating:
+                x = None  # 第n+1个成绩可能就是它自己
+            elif new_rating > -items[-1][0]:
+                x['threshold'] = max(x['threshold'], -items.pop()[0])
+                insort(items, new_item)
+            else:
+                x['threshold'] = max(x['threshold'], new_rating)
+
+            if x is None:
+                self.clear_best_cache(self.c, self.user.user_id)
+            else:
+                UserKVTable(self.c, self.user.user_id,
+                            'potential').set('best', dumps(x), n)
+
+    @staticmethod
+    def clear_best_cache(c, user_id: int = None) -> None:
+        '''删除 best n 缓存，不给 user_id 则删除所有用户的'''
+        if user_id is None:
+            c.execute(
+                '''delete from user_kvdata where class = ? and key = ?''', ('potential', 'best'))
+        else:
+            c.execute('''delete from user_kvdata where user_id = ? and class = ? and key = ?''',
+                      (user_id, 'potential', 'best'))
 
     def select_recent_30_tuple(self) -> None:
         '''获取用户recent30数据'''
@@ -593,8 +707,7 @@ class Potential:
             if (x[1], x[2]) not in max_dict or max_dict[(x[1], x[2])] < x[3]:
                 max_dict[(x[1], x[2])] = x[3]
 
-        top_n_rating = sorted(max_dict.values(), reverse=True)[:amount]
-        return sum(top_n_rating)
+        return sum(nlargest(amount, max_dict.values()))
 
     def recent_30_to_dict_list(self) -> list:
         if self.r30 is None:
@@ -0,0 +1,84 @@
+import os
+import pickle
+from traceback import format_exc
+
+from .config_manager import Config
+from .constant import ARCAEA_SERVER_VERSION
+
+
+class FileSnapshot:
+    '''
+        启动缓存快照，按文件路径保存解析结果，以 (mtime_ns, size) 判断文件是否变化
+
+        下次启动时未变化的文件直接使用快照中的结果，只重新解析变化的文件
+        快照格式或解析结果的结构改变时需要增加 VERSION
+    '''
+    VERSION = 1
+
+    logger = None
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.path = os.path.join(
+            Config.CACHE_SNAPSHOT_FOLDER_PATH, f'{name}.pickle')
+        self.enabled = Config.USE_CACHE_SNAPSHOT
+
+        self.old: 'dict[str, tuple]' = {}  # {path: ((mtime_ns, size), value)}
+        self.new: 'dict[str, tuple]' = {}
+
+        self.hits = 0
+        self.misses = 0
+
+        if self.enabled:
+            self.load()
+
+    @property
+    def version(self) -> tuple:
+        return (self.VERSION, ARCAEA_SERVER_VERSION, self.name)
+
+    def load(self) -> None:
+        if not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path, 'rb') as f:
+                x = pickle.load(f)
+            if x.get('version') == self.version:
+                self.old = x['files']
+        except Exception:
+            # 快照损坏时视为没有快照
+            self.old = {}
+            if self.logger is not None:
+                self.logger.warning(format_exc())
+
+    @staticmethod
+    def get_file_key(path: str) -> tuple:
+        x = os.stat(path)
+        return (x.st_mtime_ns, x.st_size)
+
+    def get(self, path: str, func):
+        '''返回 `func(path)`，文件未变化时使用快照中的结果'''
+        key = self.get_file_key(path)
+        x = self.old.get(path)
+        if x is not None and x[0] == key:
+            self.hits += 1
+            value = x[1]
+        else:
+            self.misses += 1
+            value = func(path)
+        self.new[path] = (key, value)
+        return value
+
+    def save(self) -> None:
+        '''只保存本次用到的文件，删除的文件随之移除'''
+        if not self.enabled or (self.misses == 0 and self.new.keys() == self.old.keys()):
+            return
+        try:
+            os.makedirs(Config.CACHE_SNAPSHOT_FOLDER_PATH, exist_ok=True)
+            tmp_path = f'{self.path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                pickle.dump({'version': self.version, 'files': self.new},
+                            f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.path)
+        except Exception:
+            if self.logger is not None:
+                self.logger.warning(format_exc())
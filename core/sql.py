@@ -1,17 +1,209 @@
+import logging
 import os
 import sqlite3
 import traceback
 from atexit import register
+from threading import Lock
 
 from .config_manager import Config
 from .constant import ARCAEA_LOG_DATBASE_VERSION, Constant
 from .error import ArcError, InputError
 from .util import parse_version
 
+MEMORY_DATABASE_URI = 'file:arc_tmp?mode=memory&cache=shared'
+if Config.DEPLOY_MODE == 'prefork':
+    # 多进程部署时内存数据库无法共享，改用临时数据库文件
+    MEMORY_DATABASE_URI = 'file:' + Config.SQLITE_MEMORY_DATABASE_PATH
+
+
+class DatabasePragma:
+    '''
+        主数据库和日志数据库连接的 PRAGMA 设置
+
+        durable: 每次提交都同步到磁盘
+        balanced: WAL 下提交不立即同步，断电可能丢失最后的事务，但数据库不会损坏
+        throughput: 不同步，适合可以接受丢失数据的场景
+    '''
+    PRESETS = {
+        'durable': {
+            'synchronous': 'FULL',
+            'cache_size': -8000,
+            'mmap_size': 0,
+            'temp_store': 'DEFAULT',
+            'busy_timeout': 10000,
+        },
+        'balanced': {
+            'synchronous': 'NORMAL',
+            'cache_size': -32000,
+            'mmap_size': 128 * 1024 * 1024,
+            'temp_store': 'MEMORY',
+            'busy_timeout': 10000,
+        },
+        'throughput': {
+            'synchronous': 'OFF',
+            'cache_size': -128000,
+            'mmap_size': 512 * 1024 * 1024,
+            'temp_store': 'MEMORY',
+            'busy_timeout': 5000,
+        },
+    }
+    KEYS = ('synchronous', 'cache_size', 'mmap_size',
+            'temp_store', 'busy_timeout')
+
+    @classmethod
+    def get_profile(cls) -> dict:
+        if Config.DATABASE_PRAGMA_PROFILE not in cls.PRESETS:
+            raise InputError(
+                f'Unknown database pragma profile `{Config.DATABASE_PRAGMA_PROFILE}`')
+        r = dict(cls.PRESETS[Config.DATABASE_PRAGMA_PROFILE])
+        for k, v in Config.DATABASE_PRAGMA.items():
+            if k not in cls.KEYS:
+                raise InputError(f'Unsupported database pragma `{k}`')
+            r[k] = v
+        return r
+
+    @staticmethod
+    def is_target(file_path: str) -> bool:
+        '''只对主数据库和日志数据库生效'''
+        return os.path.abspath(file_path) in (os.path.abspath(Constant.SQLITE_DATABASE_PATH), os.path.abspath(Constant.SQLITE_LOG_DATABASE_PATH))
+
+    @classmethod
+    def apply(cls, conn: sqlite3.Connection, file_path: str) -> None:
+        if not cls.is_target(file_path):
+            return
+        for k, v in cls.get_profile().items():
+            if not isinstance(v, int) and not str(v).isalnum():
+                raise InputError(f'Invalid value of database pragma `{k}`')
+            conn.execute(f'pragma {k} = {v}')
+
+    @classmethod
+    def get_effective(cls, c: sqlite3.Cursor) -> dict:
+        '''读取当前连接实际生效的设置'''
+        return {k: c.execute(f'pragma {k}').fetchone()[0] for k in ('journal_mode',) + cls.KEYS}
+
+
+class PooledConnection(sqlite3.Connection):
+    '''连接池中的连接，记录打开时数据库文件的标识，用于发现文件被替换'''
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.file_id: tuple = None
+
+
+class ConnectionPool:
+    '''
+        SQLite 长连接池，按数据库文件保存空闲连接，线程 / 协程间共享
+
+        连接归还时会回滚未结束的事务并分离 attach 的数据库，
+        取出时会检查连接是否可用以及数据库文件是否被替换
+    '''
+    lock = Lock()
+    idle: 'dict[str, list[PooledConnection]]' = {}
+
+    @staticmethod
+    def get_key(file_path: str, in_memory: bool = False) -> str:
+        return MEMORY_DATABASE_URI if in_memory else os.path.abspath(file_path)
+
+    @staticmethod
+    def get_file_id(key: str) -> tuple:
+        if key == MEMORY_DATABASE_URI:
+            return None
+        try:
+            x = os.stat(key)
+        except OSError:
+            return None
+        return (x.st_dev, x.st_ino)
+
+    @classmethod
+    def new_connection(cls, key: str) -> PooledConnection:
+        conn = sqlite3.connect(key, uri=key == MEMORY_DATABASE_URI, timeout=10, check_same_thread=False,
+                               cached_statements=Config.DATABASE_STATEMENT_CACHE_SIZE, factory=PooledConnection)
+        conn.file_id = cls.get_file_id(key)
+        if key != MEMORY_DATABASE_URI:
+            try:
+                DatabasePragma.apply(conn, key)
+            except BaseException:
+                conn.close()
+                raise
+        return conn
+
+    @classmethod
+    def is_healthy(cls, key: str, conn: PooledConnection) -> bool:
+        '''健康检查，数据库文件被替换或连接不可用时返回False'''
+        if conn.file_id is not None and conn.file_id != cls.get_file_id(key):
+            return False
+        try:
+            conn.execute('select 1').fetchone()
+        except sqlite3.Error:
+            return False
+        return True
+
+    @staticmethod
+    def reset(conn: PooledConnection) -> None:
+        '''重置连接状态，以便下次复用'''
+        if conn.in_transaction:
+            conn.rollback()
+        for x in conn.execute('pragma database_list').fetchall():
+            if x[1] not in ('main', 'temp'):
+                conn.execute(f'detach database "{x[1]}"')
+
+    @staticmethod
+    def close(conn: sqlite3.Connection) -> None:
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    @classmethod
+    def acquire(cls, key: str) -> PooledConnection:
+        while True:
+            with cls.lock:
+                conns = cls.idle.get(key)
+                conn = conns.pop() if conns else None
+            if conn is None:
+                return cls.new_connection(key)
+            if cls.is_healthy(key, conn):
+                return conn
+            cls.close(conn)
+
+    @classmethod
+    def release(cls, key: str, conn: PooledConnection) -> None:
+        try:
+            cls.reset(conn)
+        except sqlite3.Error:
+            cls.close(conn)
+            return
+        with cls.lock:
+            conns = cls.idle.setdefault(key, [])
+            if len(conns) < Config.DATABASE_CONNECTION_POOL_SIZE:
+                conns.append(conn)
+                return
+        cls.close(conn)
+
+    @classmethod
+    def close_all(cls, file_path: str = None, in_memory: bool = False) -> None:
+        '''关闭空闲连接，不给参数则关闭全部，数据库文件替换或删除前应调用'''
+        with cls.lock:
+            if file_path is None and not in_memory:
+                conns = [x for v in cls.idle.values() for x in v]
+                cls.idle.clear()
+            else:
+                conns = cls.idle.pop(cls.get_key(file_path, in_memory), [])
+        for conn in conns:
+            cls.close(conn)
+
+    @classmethod
+    def after_fork(cls) -> None:
+        '''fork 后子进程中重建锁，继承的连接不能使用也不能关闭，直接丢弃'''
+        cls.lock = Lock()
+        cls.idle = {}
+
 
 class Connect:
     # 数据库连接类，上下文管理
     logger = None
+    # 连接: 提交成功后执行的回调，见 after_commit
+    commit_callbacks: 'dict[sqlite3.Connection, list]' = {}
 
     def __init__(self, file_path: str = Constant.SQLITE_DATABASE_PATH, in_memory: bool = False, logger=None) -> None:
         """
@@ -26,33 +218,97 @@ class Connect:
 
         self.conn: sqlite3.Connection = None
         self.c: sqlite3.Cursor = None
+        self.pool_key: str = None
 
     def __enter__(self) -> sqlite3.Cursor:
-        if self.in_memory:
+        if Config.DATABASE_CONNECTION_POOL:
+            self.pool_key = ConnectionPool.get_key(
+                self.file_path, self.in_memory)
+            self.conn = ConnectionPool.acquire(self.pool_key)
+        elif self.in_memory:
             self.conn = sqlite3.connect(
-                'file:arc_tmp?mode=memory&cache=shared', uri=True, timeout=10)
+                MEMORY_DATABASE_URI, uri=True, timeout=10)
         else:
             self.conn = sqlite3.connect(self.file_path, timeout=10)
+            DatabasePragma.apply(self.conn, self.file_path)
         self.c = self.conn.cursor()
+        self.commit_callbacks[self.conn] = []
         return self.c
 
+    @classmethod
+    def after_commit(cls, c: sqlite3.Cursor, func, *args) -> None:
+        '''
+            事务提交成功后调用`func(*args)`，回滚时丢弃，用于更新内存中的索引和缓存
+            `c`不是由 Connect 管理的连接时立即调用
+        '''
+        x = cls.commit_callbacks.get(c.connection)
+        if x is None:
+            func(*args)
+        else:
+            x.append((func, args))
+
     def __exit__(self, exc_type, exc_val, exc_tb) -> bool:
         flag = True
+        callbacks = self.commit_callbacks.pop(self.conn, [])
         if exc_type is not None:
             if issubclass(exc_type, ArcError):
                 flag = False
             else:
                 self.conn.rollback()
+                callbacks = []
 
                 self.logger.error(
                     traceback.format_exception(exc_type, exc_val, exc_tb))
 
-        self.conn.commit()
-        self.conn.close()
+        try:
+            self.conn.commit()
+        except BaseException:
+            ConnectionPool.close(self.conn)
+            raise
+
+        for func, args in callbacks:
+            try:
+                func(*args)
+            except Exception:
+                if self.logger is not None:
+                    self.logger.error(traceback.format_exc())
+
+        self.c.close()
+        if self.pool_key is not None:
+            ConnectionPool.release(self.pool_key, self.conn)
+        else:
+            self.conn.close()
 
         return flag
 
 
+class QueryCounter:
+    '''
+        统计一个连接上执行的 SQL 语句数，结束时写入 debug 日志
+        日志等级不是 debug 时不统计
+    '''
+
+    def __init__(self, c: sqlite3.Cursor, name: str = '') -> None:
+        self.conn = c.connection
+        self.name = name
+        self.count = 0
+        self.enabled = Connect.logger is not None and Connect.logger.isEnabledFor(
+            logging.DEBUG)
+
+    def callback(self, statement: str) -> None:
+        self.count += 1
+
+    def __enter__(self) -> 'QueryCounter':
+        if self.enabled:
+            self.conn.set_trace_callback(self.callback)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        if self.enabled:
+            self.conn.set_trace_callback(None)
+            Connect.logger.debug(f'{self.name}: {self.count} queries')
+
+
 class Query:
     '''查询参数类'''
 
@@ -498,18 +754,20 @@ class LogDatabaseMigrator:
 
 
 class MemoryDatabase:
-    conn = sqlite3.connect('file:arc_tmp?mode=memory&cache=shared', uri=True)
+    conn: sqlite3.Connection = None
 
     def __init__(self):
+        if MemoryDatabase.conn is None:
+            MemoryDatabase.conn = sqlite3.connect(
+                MEMORY_DATABASE_URI, uri=True)
         self.c = self.conn.cursor()
-        self.c.execute('''PRAGMA journal_mode = OFF''')
+        if Config.DEPLOY_MODE == 'prefork':
+            self.c.execute('''PRAGMA journal_mode = WAL''')
+        else:
+            self.c.execute('''PRAGMA journal_mode = OFF''')
         self.c.execute('''PRAGMA synchronous = 0''')
-        self.c.execute('''create table if not exists download_token(user_id int,
-        song_id text,file_name text,token text,time int,primary key(user_id, song_id, file_name));''')
         self.c.execute('''create table if not exists bundle_download_token(token text primary key,
                        file_path text, time int, device_id text);''')
-        self.c.execute(
-            '''create index if not exists download_token_1 on download_token (song_id, file_name);''')
         self.c.execute('''
             create table if not exists notification(
                 user_id int, id int,
@@ -519,12 +777,24 @@ class MemoryDatabase:
                 primary key(user_id, id)
             )
         ''')
+        if Config.DEPLOY_MODE == 'prefork':
+            # 临时数据库文件中可能残留上次运行的数据
+            self.c.execute('''delete from bundle_download_token''')
+            self.c.execute('''delete from notification''')
         self.conn.commit()
 
 
 @register
 def atexit():
-    MemoryDatabase.conn.close()
+    ConnectionPool.close_all()
+    if MemoryDatabase.conn is not None:
+        MemoryDatabase.conn.close()
+
+
+if hasattr(os, 'register_at_fork'):
+    # SQLite 连接不能跨 fork 使用，fork 前关闭空闲连接
+    os.register_at_fork(before=ConnectionPool.close_all,
+                        after_in_child=ConnectionPool.after_fork)
 
 
 class UserKVTable:
@@ -12,8 +12,9 @@ from .error import (ArcError, DataExist, FriendError, InputError, NoAccess,
 from .item import UserItemList
 from .limiter import ArcLimiter
 from .mission import UserMissionList
+from .rank_index import WorldRankIndex
 from .score import Score
-from .sql import Query, Sql, UserKVTable
+from .sql import Connect, Query, Sql, UserKVTable
 from .world import Map, MapParser, UserMap, UserStamina
 
 
@@ -338,6 +339,7 @@ class UserInfo(User):
         self.__world_songs: list = None
         self.curr_available_maps: list = None
         self.__course_banners: list = None
+        self.__pick_ticket: int = None
 
     @property
     def is_insight_enabled(self) -> bool:
@@ -372,6 +374,8 @@ class UserInfo(User):
 
     @property
     def pick_ticket(self) -> int:
+        if self.__pick_ticket is not None:
+            return self.__pick_ticket
         x = UserItemList(self.c, self).select_from_type('pick_ticket')
         if not x.items:
             return 0
@@ -404,6 +408,35 @@ class UserInfo(User):
 
         return self.__course_banners
 
+    def select_user_items(self) -> None:
+        '''一次查询 /user/me 需要的所有 item 并按类型分组，结果与各属性单独查询相同'''
+        item_types = ['core', 'single', 'pack', 'world_unlock',
+                      'world_song', 'course_banner', 'pick_ticket']
+        full_unlock_types = []
+        if Config.WORLD_SONG_FULL_UNLOCK:
+            full_unlock_types.append('world_song')
+        if Config.WORLD_SCENERY_FULL_UNLOCK:
+            full_unlock_types.append('world_unlock')
+        user_types = [i for i in item_types if i not in full_unlock_types]
+
+        sql = f'''select type, item_id, amount from user_item where user_id = ? and type in ({','.join(['?'] * len(user_types))})'''
+        if full_unlock_types:
+            sql += f''' union all select type, item_id, 1 from item where type in ({','.join(['?'] * len(full_unlock_types))})'''
+        self.c.execute(sql, [self.user_id, *user_types, *full_unlock_types])
+
+        x = {i: [] for i in item_types}
+        for i in self.c.fetchall():
+            x[i[0]].append((i[1], i[2] if i[2] is not None else 1))
+
+        self.__cores = [{'core_type': i[0], 'amount': i[1]}
+                        for i in x['core']]
+        self.__singles = [i[0] for i in x['single']]
+        self.__packs = [i[0] for i in x['pack']]
+        self.__world_unlocks = [i[0] for i in x['world_unlock']]
+        self.__world_songs = [i[0] for i in x['world_song']]
+        self.__course_banners = [i[0] for i in x['course_banner']]
+        self.__pick_ticket = x['pick_ticket'][0][1] if x['pick_ticket'] else 0
+
     def select_characters(self) -> None:
         self.characters = UserCharacterList(self.c, self)
         self.characters.select_user_characters()
@@ -433,38 +466,86 @@ class UserInfo(User):
     def friends(self) -> list:
         # 得到用户的朋友列表
         if self.__friends is None:
-            s = []
-            for i in self.friend_ids:
-                self.c.execute('''select exists(select * from friend where user_id_me = :x and user_id_other = :y)''',
-                               {'x': i[0], 'y': self.user_id})
-
-                is_mutual = self.c.fetchone() == (1,)
-
-                you = UserOnline(self.c, i[0])
-                you.select_user()
-                character = you.character if you.favorite_character is None else you.favorite_character
-                character.select_character_uncap_condition(you)
-
-                rating = you.rating_ptt if not you.is_hide_rating else -1
-
-                s.append({
-                    "is_mutual": is_mutual,
-                    "is_char_uncapped_override": character.is_uncapped_override,
-                    "is_char_uncapped": character.is_uncapped,
-                    "is_skill_sealed": you.is_skill_sealed,
-                    "rating": rating,
-                    "join_date": you.join_date,
-                    "character": character.character_id,
-                    "recent_score": you.recent_score_list,
-                    "name": you.name,
-                    "user_id": you.user_id
-                })
-            s.sort(key=lambda item: item["recent_score"][0]["time_played"] if len(
-                item["recent_score"]) > 0 else 0, reverse=True)
-            self.__friends = s
+            self.select_friends()
 
         return self.__friends
 
+    def select_friends(self) -> None:
+        '''批量查询朋友列表，每种数据一次查询'''
+        self.c.execute('''select a.user_id_other, b.user_id_me is not null from friend a left join friend b
+            on b.user_id_me = a.user_id_other and b.user_id_other = a.user_id_me
+            where a.user_id_me = ? order by a.user_id_other''', (self.user_id,))
+        mutual = dict(self.c.fetchall())
+        if not mutual:
+            self.__friends = []
+            return
+
+        users = {}
+        for ids in self.chunks(list(mutual), 500):
+            self.c.execute(
+                f'''select * from user where user_id in ({','.join(['?'] * len(ids))})''', ids)
+            for x in self.c.fetchall():
+                users[x[0]] = UserOnline(self.c, x[0]).from_list(x)
+        if len(users) != len(mutual):
+            raise NoData('No user.', 108, -3)
+
+        characters = {}  # {user_id: character}
+        for you in users.values():
+            characters[you.user_id] = you.character if you.favorite_character is None else you.favorite_character
+        uncap = {}  # {(user_id, character_id): (is_uncapped, is_uncapped_override)}
+        for keys in self.chunks([(k, v.character_id) for k, v in characters.items()], 300):
+            self.c.execute(f'''select user_id, character_id, is_uncapped, is_uncapped_override from {UserCharacter.database_table_name}
+                where (user_id, character_id) in (values {','.join(['(?,?)'] * len(keys))})''', [j for i in keys for j in i])
+            for x in self.c.fetchall():
+                uncap[(x[0], x[1])] = (x[2] == 1, x[3] == 1)
+
+        best_clear_types = {}  # {(user_id, song_id, difficulty): best_clear_type}
+        recent_keys = [(k, v.recent_score.song.song_id, v.recent_score.song.difficulty)
+                       for k, v in users.items() if v.recent_score.song.song_id is not None]
+        for keys in self.chunks(recent_keys, 300):
+            self.c.execute(f'''select user_id, song_id, difficulty, best_clear_type from best_score
+                where (user_id, song_id, difficulty) in (values {','.join(['(?,?,?)'] * len(keys))})''', [j for i in keys for j in i])
+            for x in self.c.fetchall():
+                best_clear_types[(x[0], x[1], x[2])] = x[3]
+
+        s = []
+        for user_id, is_mutual in mutual.items():
+            you = users[user_id]
+            character = characters[user_id]
+            character.is_uncapped, character.is_uncapped_override = uncap.get(
+                (user_id, character.character_id), (False, False))
+
+            rating = you.rating_ptt if not you.is_hide_rating else -1
+
+            recent_score = []
+            if you.recent_score.song.song_id is not None:
+                r = you.recent_score.to_dict()
+                r["best_clear_type"] = best_clear_types.get(
+                    (user_id, you.recent_score.song.song_id, you.recent_score.song.difficulty), you.recent_score.clear_type)
+                recent_score.append(r)
+
+            s.append({
+                "is_mutual": is_mutual == 1,
+                "is_char_uncapped_override": character.is_uncapped_override,
+                "is_char_uncapped": character.is_uncapped,
+                "is_skill_sealed": you.is_skill_sealed,
+                "rating": rating,
+                "join_date": you.join_date,
+                "character": character.character_id,
+                "recent_score": recent_score,
+                "name": you.name,
+                "user_id": you.user_id
+            })
+        s.sort(key=lambda item: item["recent_score"][0]["time_played"] if len(
+            item["recent_score"]) > 0 else 0, reverse=True)
+        self.__friends = s
+
+    @staticmethod
+    def chunks(x: list, n: int):
+        '''分批，SQLite 一条语句的参数个数有限制'''
+        for i in range(0, len(x), n):
+            yield x[i:i + n]
+
     @property
     def recent_score_list(self) -> list:
         # 用户最近一次成绩，是列表
@@ -499,6 +580,11 @@ class UserInfo(User):
         if self.name is None:
             self.select_user()
 
+        self.select_user_items()
+        if self.characters is None:
+            self.select_characters()
+        self.characters.select_characters_info()
+
         # 这是考虑有可能favourite_character设置了用户未拥有的角色，同时提前计算角色列表
         character_list = self.characters_list
         if self.favorite_character and self.favorite_character.character_id in character_list:
@@ -720,6 +806,10 @@ class UserInfo(User):
         if not self.world_rank_score:
             return 0
 
+        r = WorldRankIndex.get_rank(self.c, self.world_rank_score)
+        if r is not None:
+            return r
+
         self.c.execute(
             '''select count(*) from user where world_rank_score > ?''', (self.world_rank_score,))
         y = self.c.fetchone()
@@ -728,31 +818,45 @@ class UserInfo(User):
 
         return 0
 
-    def update_global_rank(self) -> None:
-        '''用户世界排名计算，有新增成绩则要更新'''
+    def update_global_rank(self, chart=None, old_score_v2: float = None, new_score_v2: float = None) -> None:
+        '''
+            用户世界排名计算，有新增成绩则要更新
 
-        self.c.execute(
-            '''
-            with user_scores as (
-            select song_id, difficulty, score_v2 from best_score where user_id = ? and difficulty in (2, 3, 4)
-            )
-            select sum(a) from(
-            select sum(score_v2) as a from user_scores where difficulty = 2 and song_id in (select song_id from chart where rating_ftr > 0)
-            union
-            select sum(score_v2) as a from user_scores where difficulty = 3 and song_id in (select song_id from chart where rating_byn > 0)
-            union
-            select sum(score_v2) as a from user_scores where difficulty = 4 and song_id in (select song_id from chart where rating_etr > 0)
-            )
-            ''',
-            (self.user_id,)
-        )
-        x = self.c.fetchone()
-        if x[0] is None:
-            return
+            给出变化的谱面和其新旧 score_v2 时增量更新，否则重新求和
+        '''
+        if chart is not None and new_score_v2 is not None and old_score_v2 is not None:
+            if chart.difficulty not in (2, 3, 4) or chart.defnum is None or chart.defnum <= 0:
+                return
+            if self.world_rank_score is None:
+                self.select_user_one_column('world_rank_score', 0)
+            if self.world_rank_score:
+                self.world_rank_score += new_score_v2 - old_score_v2
+                self.c.execute(
+                    '''update user set world_rank_score = ? where user_id = ?''', (self.world_rank_score, self.user_id))
+                Connect.after_commit(
+                    self.c, WorldRankIndex.update, self.user_id, self.world_rank_score)
+                return
+
+        self.refresh_world_rank_score(self.c, self.user_id)
+        self.select_user_one_column('world_rank_score', 0)
+        Connect.after_commit(
+            self.c, WorldRankIndex.update, self.user_id, self.world_rank_score)
+
+    @staticmethod
+    def refresh_world_rank_score(c, user_id: int = None) -> None:
+        '''
+            从 best_score 重新求和 world_rank_score，不给 user_id 则刷新所有用户
 
-        self.c.execute(
-            '''update user set world_rank_score = ? where user_id = ?''', (x[0], self.user_id))
-        self.world_rank_score = x[0]
+            批量修改或删除 best_score 后需调用，之后清空 WorldRankIndex
+        '''
+        sql = '''update user set world_rank_score = coalesce((
+            select sum(b.score_v2) from best_score b, chart ch where b.user_id = user.user_id and b.song_id = ch.song_id and (
+            b.difficulty = 2 and ch.rating_ftr > 0 or b.difficulty = 3 and ch.rating_byn > 0 or b.difficulty = 4 and ch.rating_etr > 0)
+            ), 0)'''
+        if user_id is None:
+            c.execute(sql)
+        else:
+            c.execute(sql + ' where user_id = ?', (user_id,))
 
     def update_user_world_complete_info(self) -> None:
         '''
@@ -1,5 +1,7 @@
 import hashlib
+import mmap
 import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
 from time import mktime
 
@@ -36,19 +38,46 @@ def md5(code: str) -> str:
     return codes
 
 
+FILE_MD5_SMALL_SIZE = 1 << 20  # 小于此大小一次读入
+FILE_MD5_MMAP_SIZE = 16 << 20  # 大于此大小使用 mmap
+FILE_MD5_BUFFER_SIZE = 1 << 20
+
+
 def get_file_md5(file_path: str) -> str:
-    '''计算文件MD5，假设是文件'''
-    myhash = hashlib.md5()
+    '''计算文件MD5，假设是文件，按文件大小选择读取方式'''
     with open(file_path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size <= FILE_MD5_SMALL_SIZE:
+            return hashlib.md5(f.read()).hexdigest()
+
+        if size >= FILE_MD5_MMAP_SIZE:
+            try:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    return hashlib.md5(m).hexdigest()
+            except (OSError, ValueError):
+                # 某些文件系统不支持 mmap
+                f.seek(0)
+
+        myhash = hashlib.md5()
+        buf = bytearray(FILE_MD5_BUFFER_SIZE)
+        view = memoryview(buf)
         while True:
-            b = f.read(8192)
-            if not b:
+            n = f.readinto(buf)
+            if not n:
                 break
-            myhash.update(b)
+            myhash.update(view[:n])
 
     return myhash.hexdigest()
 
 
+def get_files_md5(file_paths: list, max_workers: int = None) -> list:
+    '''多线程计算多个文件的MD5，hashlib 计算时会释放 GIL，返回顺序与参数相同'''
+    if len(file_paths) <= 1:
+        return [get_file_md5(i) for i in file_paths]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(get_file_md5, file_paths))
+
+
 def try_rename(path: str, new_path: str) -> str:
     '''尝试重命名文件，并尝试避免命名冲突（在后面加自增数字），返回最终路径'''
     final_path = new_path
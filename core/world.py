@@ -9,6 +9,7 @@ from .config_manager import Config
 from .constant import Constant
 from .error import InputError, MapLocked, NoData
 from .item import ItemFactory
+from .snapshot import FileSnapshot
 from .sql import UserKVTable
 
 
@@ -22,11 +23,15 @@ class MapParser:
     # 章节包含的地图（不包含可重复地图）
     chapter_info_without_repeatable: 'dict[int, list[str]]' = {}
 
+    # {(map_id, lephon_nell_phase): 地图与用户无关的部分}
+    map_payloads: 'dict[tuple, dict]' = {}
+
     def __init__(self) -> None:
         if not self.map_id_path:
             self.parse()
 
     def parse(self) -> None:
+        snapshot = FileSnapshot('world_map')
         for root, dirs, files in os.walk(Constant.WORLD_MAP_FOLDER_PATH):
             for file in files:
                 if not file.endswith(".json"):
@@ -36,33 +41,43 @@ class MapParser:
                 map_id = file[:-5]
                 self.map_id_path[file[:-5]] = path
 
-                map_data = self.get_world_info(map_id)
-                chapter = map_data.get('chapter', None)
-                if chapter is None:
+                x = snapshot.get(path, self.parse_one)
+                if x is None:
                     continue
-                self.chapter_info.setdefault(chapter, []).append(map_id)
-                is_repeatable = map_data.get('is_repeatable', False)
-                if not is_repeatable:
+                self.chapter_info.setdefault(x['chapter'], []).append(map_id)
+                if not x['is_repeatable']:
                     self.chapter_info_without_repeatable.setdefault(
-                        chapter, []).append(map_id)
-                self.world_info[map_id] = {
-                    'chapter': chapter,
-                    'is_repeatable': is_repeatable,
-                    'is_beyond': map_data.get('is_beyond', False),
-                    'is_legacy': map_data.get('is_legacy', False),
-                    'step_count': len(map_data.get('steps', [])),
-                }
+                        x['chapter'], []).append(map_id)
+                self.world_info[map_id] = x
+        snapshot.save()
 
         for i in range(4):
             self.map_lephon_nell_phases[i] = os.path.join(
                 Config.WORLD_MAP_LEPHON_NELL_FOLDER_PATH, f"{i+1}.json"
             )
 
+    @staticmethod
+    def parse_one(path: str) -> dict:
+        '''读取地图文件的简要信息，不属于任何章节返回None'''
+        with open(path, "rb") as f:
+            map_data = load(f)
+        chapter = map_data.get('chapter', None)
+        if chapter is None:
+            return None
+        return {
+            'chapter': chapter,
+            'is_repeatable': map_data.get('is_repeatable', False),
+            'is_beyond': map_data.get('is_beyond', False),
+            'is_legacy': map_data.get('is_legacy', False),
+            'step_count': len(map_data.get('steps', [])),
+        }
+
     def re_init(self) -> None:
         self.map_id_path.clear()
         self.world_info.clear()
         self.chapter_info.clear()
         self.chapter_info_without_repeatable.clear()
+        self.map_payloads.clear()
         self.get_world_info.cache_clear()
         self.parse()
 
@@ -85,6 +100,31 @@ class MapParser:
         """
         return [UserMap(c, map_id, user) for map_id in MapParser.map_id_path.keys()]
     
+    @staticmethod
+    def get_map_payload(map_id: str, phase: int = None) -> dict:
+        """
+        地图列表中与用户无关的部分，即`UserMap.to_dict(has_map_info=True, has_rewards=True)`去掉用户数据
+        只读，使用时需复制，`phase`为 lephon_nell 的阶段
+        """
+        k = (map_id, phase)
+        x = MapParser.map_payloads.get(k)
+        if x is not None:
+            return x
+        m = Map(map_id)
+        if phase is not None:
+            m.overwrite_steps = [Step().from_dict(s)
+                                 for s in MapParser.get_lephon_nell_phase(phase)]
+        m.select_map_info()
+        x = m.to_dict()
+        x["curr_position"] = None
+        x["curr_capture"] = None
+        x["is_locked"] = None
+        x["user_id"] = None
+        del x["steps"]
+        x["rewards"] = m.rewards
+        MapParser.map_payloads[k] = x
+        return x
+
     @staticmethod
     @lru_cache(maxsize=128)
     def get_lephon_nell_phase(phase: int) -> list:
@@ -422,6 +462,48 @@ class UserMap(Map):
 
         self.select_map_info()  # Update with overwrite_steps
 
+    @staticmethod
+    def get_user_all_to_dict(c, user) -> list:
+        """
+        用户所有地图的信息，即 /world/map/me，与逐个`select`和`to_dict(has_map_info=True, has_rewards=True)`结果相同
+        用户数据一次查询，与静态部分合并
+        """
+        c.execute(
+            """select map_id, curr_position, curr_capture, is_locked from user_world where user_id = ?""",
+            (user.user_id,),
+        )
+        user_maps = {i[0]: i[1:] for i in c.fetchall()}
+        lephon_nell_state = user.lephon_nell_state
+        lephon_final = lephon_nell_state == 3
+
+        r = []
+        new_maps = []
+        for map_id in MapParser.map_id_path:
+            if map_id == "lephon_nell" and lephon_nell_state == 4:
+                continue
+            x = user_maps.get(map_id)
+            if x is None:
+                x = (0, 0, 1)
+                new_maps.append((user.user_id, map_id))
+            if map_id == "lephon_nell":
+                y = MapParser.get_map_payload(
+                    map_id, lephon_nell_state if lephon_nell_state <= 3 else None)
+            else:
+                y = MapParser.get_map_payload(map_id)
+
+            y = y.copy()
+            y["lephon_active"] = lephon_final
+            y["lephon_final"] = lephon_final
+            y["curr_position"] = x[0]
+            y["curr_capture"] = x[1]
+            y["is_locked"] = x[2] == 1
+            y["user_id"] = user.user_id
+            r.append(y)
+
+        if new_maps:
+            c.executemany("""insert into user_world values(?,?,0,0,1)""", new_maps)
+        return r
+
     def change_user_current_map(self):
         """改变用户当前地图为此地图"""
         self.user.current_map = self
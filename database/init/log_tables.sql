@@ -22,6 +22,11 @@ time int,
 rating_ptt real,
 primary key(user_id, time)
 );
+create table if not exists song_file_hash(path text primary key,
+size int,
+mtime_ns int,
+md5 text
+);
 
 create index if not exists user_score_1 on user_score (song_id, difficulty);
 create index if not exists user_score_2 on user_score (time_played);
@@ -296,6 +296,7 @@ primary key(user_id, class, key, idx)
 
 
 create index if not exists best_score_1 on best_score (song_id, difficulty);
+create index if not exists user_world_rank_score on user (world_rank_score);
 
 PRAGMA journal_mode = WAL;
 PRAGMA default_cache_size = 8000;
\ No newline at end of file
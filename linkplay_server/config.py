@@ -29,6 +29,9 @@ class Config:
 
     LINK_PLAY_UNLOCK_LENGTH = 512
 
+    # 房间命令队列保留的命令数，落后更多的客户端直接同步完整房间信息
+    COMMAND_QUEUE_CAPACITY = 256
+
     COUNTDOWN_SONG_READY = 4 * 1000000
     COUNTDOWN_SONG_START = 6 * 1000000
 
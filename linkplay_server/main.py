@@ -1,44 +1,66 @@
+import asyncio
 import binascii
 import logging
-import socketserver
-import threading
+import struct
 from json import dumps, loads
+from os import urandom
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 
 from .aes import decrypt, encrypt
 from .config import Config
-from .store import Store, TCPRouter, clear_player, clear_room
+from .store import Store, TCPRouter, clear_player, clear_room, schedule_room
 from .udp_class import bi
 from .udp_parser import CommandParser
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 logging.basicConfig(format='[%(asctime)s] %(levelname)s in %(module)s: %(message)s',
                     level=logging.INFO)
 
 
-class UDP_handler(socketserver.BaseRequestHandler):
-    def handle(self):
-        client_msg, server = self.request
+class UDP_handler(asyncio.DatagramProtocol):
+    '''UDP 数据包在事件循环中处理，`Store`只由事件循环访问'''
+
+    def __init__(self) -> None:
+        self.transport: asyncio.DatagramTransport = None
+
+    def connection_made(self, transport) -> None:
+        self.transport = transport
+
+    def error_received(self, exc) -> None:
+        logging.error(exc)
+
+    def datagram_received(self, client_msg: bytes, client_address) -> None:
         # print(client_msg)
         try:
             token = client_msg[:8]
-            iv = client_msg[8:20]
-            tag = client_msg[20:36]
-            ciphertext = client_msg[36:]
 
             user = Store.link_play_data.get(bi(token))
             if user is None:
                 return None
 
-            plaintext = decrypt(user['key'], b'', iv, ciphertext, tag)
+            # token(8) + iv(12) + tag(16) + ciphertext，AESGCM 需要 ciphertext + tag
+            aead: AESGCM = user['aead']
+            plaintext = aead.decrypt(
+                client_msg[8:20], client_msg[36:] + client_msg[20:36], None)
         except Exception as e:
             logging.error(e)
             return None
 
         # if Config.DEBUG:
         #     logging.info(
-        #         f'UDP-From-{self.client_address[0]}-{binascii.b2a_hex(plaintext)}')
+        #         f'UDP-From-{client_address[0]}-{binascii.b2a_hex(plaintext)}')
 
-        commands = CommandParser(
-            user['room'], user['player_index']).get_commands(plaintext)
+        try:
+            commands = CommandParser(
+                user['room'], user['player_index']).get_commands(plaintext)
+        except Exception as e:
+            logging.error(e)
+            return None
 
         if user['room'].players[user['player_index']].player_id == 0:
             clear_player(bi(token))
@@ -46,69 +68,141 @@ class UDP_handler(socketserver.BaseRequestHandler):
                 clear_room(user['room'])
             commands = [i for i in commands if i[2] == 0x12]
             # 处理不能正确被踢的问题
+        elif Store.room_id_dict.get(user['room'].room_id) is user['room']:
+            # 可能开始了倒计时或玩家重新上线
+            schedule_room(user['room'])
 
         for i in commands:
-            iv, ciphertext, tag = encrypt(user['key'], i, b'')
+            iv = urandom(12)
+            x = aead.encrypt(iv, i, None)
             # if Config.DEBUG:
             #     logging.info(
-            #         f'UDP-To-{self.client_address[0]}-{binascii.b2a_hex(i)}')
+            #         f'UDP-To-{client_address[0]}-{binascii.b2a_hex(i)}')
 
-            server.sendto(token + iv + tag + ciphertext, self.client_address)
+            self.transport.sendto(token + iv + x[-16:] + x[:-16], client_address)
 
 
 AUTH_LEN = len(Config.AUTHENTICATION)
 TCP_AES_KEY = Config.TCP_SECRET_KEY.encode('utf-8').ljust(16, b'\x00')[:16]
 
+# 长连接，见 core/linkplay.LinkPlayConnection
+MUX_MAGIC = b'\xff' * 8
+MUX_ACK = b'ARCMUX\x01' + bytes((msgpack is not None,))
+FRAME_HEADER = struct.Struct('<IIB')
 
-class TCP_handler(socketserver.StreamRequestHandler):
 
-    def handle(self):
+async def TCP_channel(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, client_address) -> None:
+    '''长连接，按顺序处理请求，响应带回请求的 request id'''
+    writer.write(MUX_ACK)
+    aead = AESGCM(TCP_AES_KEY)
+    while True:
         try:
-            if self.rfile.read(AUTH_LEN).decode('utf-8') != Config.AUTHENTICATION:
-                self.wfile.write(b'No authentication')
+            header = await reader.readexactly(FRAME_HEADER.size)
+        except asyncio.IncompleteReadError as e:
+            if e.partial:
+                raise
+            return None
+        length, request_id, flags = FRAME_HEADER.unpack(header)
+        if length > Config.TCP_MAX_LENGTH:
+            logging.warning(f'TCP-{client_address[0]}-Body too long')
+            return None
+        payload = await reader.readexactly(length)
+
+        # 解密失败说明密钥不对，断开
+        body = aead.decrypt(payload[:12], payload[12:], header[4:])
+        data = msgpack.unpackb(body) if flags & 1 else loads(body)
+
+        if Config.DEBUG:
+            logging.info(f'TCP-From-{client_address[0]}-{data}')
+
+        r = TCPRouter(data).handle()
+        try:
+            body = msgpack.packb(r) if flags & 1 else dumps(r).encode('utf-8')
+        except Exception as e:
+            logging.error(e)
+            r = {'code': 999}
+            body = msgpack.packb(r) if flags & 1 else dumps(r).encode('utf-8')
+        if Config.DEBUG:
+            logging.info(f'TCP-To-{client_address[0]}-{r}')
+
+        iv = urandom(12)
+        payload = iv + aead.encrypt(iv, body, header[4:])
+        writer.write(FRAME_HEADER.pack(
+            len(payload), request_id, flags) + payload)
+        await writer.drain()
+
+
+async def TCP_handler(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    client_address = writer.get_extra_info('peername')
+    try:
+        try:
+            if (await reader.readexactly(AUTH_LEN)).decode('utf-8') != Config.AUTHENTICATION:
+                writer.write(b'No authentication')
                 logging.warning(
-                    f'TCP-{self.client_address[0]}-No authentication')
+                    f'TCP-{client_address[0]}-No authentication')
                 return None
 
-            cipher_len = int.from_bytes(self.rfile.read(8), byteorder='little')
+            cipher_len = await reader.readexactly(8)
+            if cipher_len == MUX_MAGIC:
+                await TCP_channel(reader, writer, client_address)
+                return None
+            cipher_len = int.from_bytes(cipher_len, byteorder='little')
             if cipher_len > Config.TCP_MAX_LENGTH:
-                self.wfile.write(b'Body too long')
-                logging.warning(f'TCP-{self.client_address[0]}-Body too long')
+                writer.write(b'Body too long')
+                logging.warning(f'TCP-{client_address[0]}-Body too long')
                 return None
 
-            iv = self.rfile.read(12)
-            tag = self.rfile.read(16)
-            ciphertext = self.rfile.read(cipher_len)
+            iv = await reader.readexactly(12)
+            tag = await reader.readexactly(16)
+            ciphertext = await reader.readexactly(cipher_len)
 
-            self.data = decrypt(TCP_AES_KEY, b'', iv, ciphertext, tag)
-            message = self.data.decode('utf-8')
+            data = decrypt(TCP_AES_KEY, b'', iv, ciphertext, tag)
+            message = data.decode('utf-8')
             data = loads(message)
         except Exception as e:
             logging.error(e)
             return None
 
         if Config.DEBUG:
-            logging.info(f'TCP-From-{self.client_address[0]}-{message}')
+            logging.info(f'TCP-From-{client_address[0]}-{message}')
 
         r = TCPRouter(data).handle()
         try:
             r = dumps(r)
             if Config.DEBUG:
-                logging.info(f'TCP-To-{self.client_address[0]}-{r}')
+                logging.info(f'TCP-To-{client_address[0]}-{r}')
             iv, ciphertext, tag = encrypt(TCP_AES_KEY, r.encode('utf-8'), b'')
             r = len(ciphertext).to_bytes(
                 8, byteorder='little') + iv + tag + ciphertext
+            writer.write(r)
+            await writer.drain()
         except Exception as e:
             logging.error(e)
             return None
-        self.wfile.write(r)
+    finally:
+        writer.close()
 
 
-def link_play(ip: str = Config.HOST, udp_port: int = Config.UDP_PORT, tcp_port: int = Config.TCP_PORT):
-    udp_server = socketserver.ThreadingUDPServer((ip, udp_port), UDP_handler)
-    tcp_server = socketserver.ThreadingTCPServer((ip, tcp_port), TCP_handler)
+def run_timer_wheel(loop: asyncio.AbstractEventLoop) -> None:
+    Store.timer_wheel.advance()
+    loop.call_later(Store.timer_wheel.tick / 1000000,
+                    run_timer_wheel, loop)
+
 
-    threads = [threading.Thread(target=udp_server.serve_forever), threading.Thread(
-        target=tcp_server.serve_forever)]
-    [t.start() for t in threads]
-    [t.join() for t in threads]
+async def serve(ip: str, udp_port: int, tcp_port: int) -> None:
+    loop = asyncio.get_running_loop()
+    run_timer_wheel(loop)
+    transport, _ = await loop.create_datagram_endpoint(UDP_handler, local_addr=(ip, udp_port))
+    tcp_server = await asyncio.start_server(TCP_handler, ip, tcp_port)
+    try:
+        async with tcp_server:
+            await tcp_server.serve_forever()
+    finally:
+        transport.close()
+
+
+def link_play(ip: str = Config.HOST, udp_port: int = Config.UDP_PORT, tcp_port: int = Config.TCP_PORT):
+    try:
+        asyncio.run(serve(ip, udp_port, tcp_port))
+    except KeyboardInterrupt:
+        pass
@@ -2,16 +2,22 @@ import logging
 from base64 import b64decode, b64encode
 from os import urandom
 from random import randint
-from threading import RLock
 from time import time
 
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
 from .config import Config
+from .timer import TimerWheel
 from .udp_class import Player, Room, bi
+from .udp_parser import CommandParser
 from .udp_sender import CommandSender
 
 
 class Store:
-    # token: {'key': key, 'room': Room, 'player_index': player_index, 'player_id': player_id}
+    '''只在事件循环中访问，不需要加锁'''
+    # 房间倒计时、玩家离线 / 超时、房间和 token 过期，见 schedule_room
+    timer_wheel = TimerWheel()
+    # token: {'key': key, 'aead': AESGCM(key), 'room': Room, 'player_index': player_index, 'player_id': player_id}
     link_play_data = {}
     room_id_dict: "dict[int, Room]" = {}  # 'room_id': Room
     room_code_dict = {}  # 'room_code': Room
@@ -19,8 +25,6 @@ class Store:
 
     share_token_dict = {}  # 'share_token': Room
 
-    lock = RLock()
-
 
 def random_room_code():
     re = ''
@@ -56,11 +60,10 @@ def clear_player(token):
     # 清除玩家信息和token
     player_id = Store.link_play_data[token]['player_id']
     logging.info(f'Clean player `{Store.player_dict[player_id].name}`')
-    with Store.lock:
-        if player_id in Store.player_dict:
-            del Store.player_dict[player_id]
-        if token in Store.link_play_data:
-            del Store.link_play_data[token]
+    if player_id in Store.player_dict:
+        del Store.player_dict[player_id]
+    if token in Store.link_play_data:
+        del Store.link_play_data[token]
 
 
 def clear_room(room):
@@ -69,43 +72,66 @@ def clear_room(room):
     room_code = room.room_code
     share_token = room.share_token
     logging.info(f'Clean room `{room_code}`')
-    with Store.lock:
-        if room_id in Store.room_id_dict:
-            del Store.room_id_dict[room_id]
-        if room_code in Store.room_code_dict:
-            del Store.room_code_dict[room_code]
-        if share_token in Store.share_token_dict:
-            del Store.share_token_dict[share_token]
-        del room
-
-
-def memory_clean(now):
-    # 内存清理，应对玩家不正常退出
-    with Store.lock:
-        clean_room_list = []
-        clean_player_list = []
-        for token, v in Store.link_play_data.items():
-            room = v['room']
-            if now - room.timestamp >= Config.TIME_LIMIT:
-                clean_room_list.append(room.room_id)
-
-            if now - room.players[v['player_index']].last_timestamp // 1000 >= Config.TIME_LIMIT:
-                clean_player_list.append(token)
-
-        for room_id, v in Store.room_id_dict.items():
-            if now - v.timestamp >= Config.TIME_LIMIT:
-                clean_room_list.append(room_id)
-
-        for room_id in clean_room_list:
-            if room_id in Store.room_id_dict:
-                clear_room(Store.room_id_dict[room_id])
-
-        for token in clean_player_list:
-            clear_player(token)
+    if room_id in Store.room_id_dict:
+        del Store.room_id_dict[room_id]
+    if room_code in Store.room_code_dict:
+        del Store.room_code_dict[room_code]
+    if share_token in Store.share_token_dict:
+        del Store.share_token_dict[share_token]
+    if room.timer is not None:
+        room.timer.cancel()
+        room.timer = None
+    del room
+
+
+def schedule_room(room: Room, now: int = None) -> None:
+    # 房间只保留一个计时器，新的时间更早时才重新设置，到期时再按当前状态重新计算
+    now = round(time() * 1000000) if now is None else now
+    deadline = room.next_deadline(now)
+    if room.timer is not None:
+        if room.timer.deadline <= deadline:
+            return None
+        room.timer.cancel()
+    room.timer = Store.timer_wheel.schedule(deadline, room_timer, room)
+
+
+def room_timer(room: Room) -> None:
+    room.timer = None
+    if Store.room_id_dict.get(room.room_id) is not room:
+        return None
+    now = round(time() * 1000000)
+    if now - room.timestamp >= Config.TIME_LIMIT * 1000:
+        clear_room(room)
+        return None
+
+    flag, player_index_list = room.check_player_online(now)
+    if player_index_list or room.is_countdown_due(now):
+        CommandParser(room).command_timer(flag, player_index_list)
+    if room.player_num == 0:
+        clear_room(room)
+        return None
+    schedule_room(room, now)
+
+
+def schedule_token(token: int, deadline: int) -> None:
+    Store.timer_wheel.schedule(deadline, token_timer, token)
+
+
+def token_timer(token: int) -> None:
+    # 玩家最后一次发包后 TIME_LIMIT 清除 token，应对玩家不正常退出
+    v = Store.link_play_data.get(token)
+    if v is None:
+        return None
+    player = v['room'].players[v['player_index']]
+    if player.token == token and player.last_timestamp != 0:
+        deadline = player.last_timestamp + Config.TIME_LIMIT * 1000
+        if deadline > round(time() * 1000000):
+            schedule_token(token, deadline)
+            return None
+    clear_player(token)
 
 
 class TCPRouter:
-    clean_timer = 0
     router = {
         'debug',
         'create_room',
@@ -122,20 +148,20 @@ class TCPRouter:
         self.endpoint = raw_data['endpoint']
 
     def debug(self) -> dict:
-        if Config.DEBUG:
+        if Config.DEBUG and 'code' in self.data:
             return {'result': eval(self.data['code'])}
-        return {'hello_world': 'ok'}
-
-    @staticmethod
-    def clean_check():
-        now = round(time() * 1000)
-        if now - TCPRouter.clean_timer >= Config.TIME_LIMIT:
-            logging.info('Start cleaning memory...')
-            TCPRouter.clean_timer = now
-            memory_clean(now)
+        return {
+            'hello_world': 'ok',
+            'rooms': [{
+                'room_code': room.room_code,
+                'command_queue_length': room.command_queue_length,
+                'command_queue_size': room.command_queue.size,
+                'memory_usage': room.memory_usage,
+            } for room in Store.room_id_dict.values()],
+            'timers': Store.timer_wheel.size
+        }
 
     def handle(self) -> dict:
-        self.clean_check()
         if self.endpoint not in self.router:
             return {'code': 999}
         try:
@@ -192,33 +218,36 @@ class TCPRouter:
         match_times = self.data.get('match_times', None)
 
         key = urandom(16)
-        with Store.lock:
-            room = self.generate_room()
-            player = self.generate_player(name)
-
-            player.song_unlock = song_unlock
-            player.rating_ptt = rating_ptt
-            player.is_hide_rating = is_hide_rating
-            player.player_index = 0
-            room.song_unlock = song_unlock
-            room.host_id = player.player_id
-            room.players[0] = player
-
-            token = room.room_id
-            player.token = token
-
-            # 匹配模式追加
-            if match_times is not None:
-                room.is_public = 1
-                room.round_mode = 3
-                room.timed_mode = 1
-
-            Store.link_play_data[token] = {
-                'key': key,
-                'room': room,
-                'player_index': 0,
-                'player_id': player.player_id
-            }
+        room = self.generate_room()
+        player = self.generate_player(name)
+
+        player.song_unlock = song_unlock
+        player.rating_ptt = rating_ptt
+        player.is_hide_rating = is_hide_rating
+        player.player_index = 0
+        room.song_unlock = song_unlock
+        room.host_id = player.player_id
+        room.players[0] = player
+
+        token = room.room_id
+        player.token = token
+
+        # 匹配模式追加
+        if match_times is not None:
+            room.is_public = 1
+            room.round_mode = 3
+            room.timed_mode = 1
+
+        Store.link_play_data[token] = {
+            'key': key,
+            'aead': AESGCM(key),
+            'room': room,
+            'player_index': 0,
+            'player_id': player.player_id
+        }
+
+        schedule_room(room)
+        schedule_token(token, room.timestamp + Config.TIME_LIMIT * 1000)
 
         logging.info(f'TCP-Create room `{room.room_code}` by player `{name}`')
         return {
@@ -241,42 +270,45 @@ class TCPRouter:
         is_hide_rating = self.data.get('is_hide_rating', False)
         match_times = self.data.get('match_times', None)
 
-        with Store.lock:
-            if room_code not in Store.room_code_dict:
-                # 房间号错误 / 房间不存在
-                return 1202
-            room: Room = Store.room_code_dict[room_code]
-
-            player_num = room.player_num
-            if player_num == 4:
-                # 满人
-                return 1201
-            if player_num == 0:
-                # 房间不存在
-                return 1202
-            if room.state not in (0, 1, 2) or (room.is_public and match_times is None):
-                # 无法加入
-                return 1205
-
-            token = unique_random(Store.link_play_data)
-
-            player = self.generate_player(name)
-            player.token = token
-            player.song_unlock = song_unlock
-            player.rating_ptt = rating_ptt
-            player.is_hide_rating = is_hide_rating
-            room.update_song_unlock()
-            for i in range(4):
-                if room.players[i].player_id == 0:
-                    room.players[i] = player
-                    player.player_index = i
-                    break
-            Store.link_play_data[token] = {
-                'key': key,
-                'room': room,
-                'player_index': player.player_index,
-                'player_id': player.player_id
-            }
+        if room_code not in Store.room_code_dict:
+            # 房间号错误 / 房间不存在
+            return 1202
+        room: Room = Store.room_code_dict[room_code]
+
+        player_num = room.player_num
+        if player_num == 4:
+            # 满人
+            return 1201
+        if player_num == 0:
+            # 房间不存在
+            return 1202
+        if room.state not in (0, 1, 2) or (room.is_public and match_times is None):
+            # 无法加入
+            return 1205
+
+        token = unique_random(Store.link_play_data)
+
+        player = self.generate_player(name)
+        player.token = token
+        player.song_unlock = song_unlock
+        player.rating_ptt = rating_ptt
+        player.is_hide_rating = is_hide_rating
+        room.update_song_unlock()
+        for i in range(4):
+            if room.players[i].player_id == 0:
+                room.players[i] = player
+                player.player_index = i
+                break
+        Store.link_play_data[token] = {
+            'key': key,
+            'aead': AESGCM(key),
+            'room': room,
+            'player_index': player.player_index,
+            'player_id': player.player_id
+        }
+
+        schedule_token(token, round(time() * 1000000) +
+                       Config.TIME_LIMIT * 1000)
 
         logging.info(f'TCP-Player `{name}` joins room `{room_code}`')
         return {
@@ -295,29 +327,28 @@ class TCPRouter:
         rating_ptt = self.data.get('rating_ptt', 0)
         is_hide_rating = self.data.get('is_hide_rating', False)
 
-        with Store.lock:
-            if token not in Store.link_play_data:
-                return 108
-            r = Store.link_play_data[token]
-            room = r['room']
-
-            # 更新玩家信息
-            player_index = r['player_index']
-            player = room.players[player_index]
-            player.rating_ptt = rating_ptt
-            player.is_hide_rating = is_hide_rating
-            cs = CommandSender(room)
-            room.command_queue.append(cs.command_12(player_index))
-
-            logging.info(f'TCP-Room `{room.room_code}` info update')
-            return {
-                'room_code': room.room_code,
-                'room_id': room.room_id,
-                'key': b64encode(r['key']).decode('utf-8'),
-                # changed from room.players[r['player_index']].player_id,
-                'player_id': r['player_id'],
-                'song_unlock': b64encode(room.song_unlock).decode('utf-8')
-            }
+        if token not in Store.link_play_data:
+            return 108
+        r = Store.link_play_data[token]
+        room = r['room']
+
+        # 更新玩家信息
+        player_index = r['player_index']
+        player = room.players[player_index]
+        player.rating_ptt = rating_ptt
+        player.is_hide_rating = is_hide_rating
+        cs = CommandSender(room)
+        room.command_queue.append(cs.command_12(player_index))
+
+        logging.info(f'TCP-Room `{room.room_code}` info update')
+        return {
+            'room_code': room.room_code,
+            'room_id': room.room_id,
+            'key': b64encode(r['key']).decode('utf-8'),
+            # changed from room.players[r['player_index']].player_id,
+            'player_id': r['player_id'],
+            'song_unlock': b64encode(room.song_unlock).decode('utf-8')
+        }
 
     def get_rooms(self) -> dict:
         # 获取房间列表与详细信息
@@ -0,0 +1,98 @@
+import logging
+from time import time
+
+
+class Timer:
+    __slots__ = ('deadline', 'expire_tick', 'callback', 'args', 'cancelled')
+
+    def __init__(self, deadline: int, expire_tick: int, callback, args: tuple) -> None:
+        self.deadline = deadline
+        self.expire_tick = expire_tick
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self) -> None:
+        # 惰性删除，到达所在的槽时丢弃
+        self.cancelled = True
+
+
+class TimerWheel:
+    '''
+    分层时间轮，时间单位为微秒，只在事件循环中使用
+    第 0 层每槽`tick`，第 n 层每槽为第 n - 1 层一圈；超出最高层的先放在 overflow 中
+    `advance`每个 tick 只处理一个槽，开销与到期的计时器数量有关，与计时器总数无关
+    默认 100 ms * 64 * 64 * 64，约 7.3 小时
+    '''
+
+    def __init__(self, tick: int = 100000, slots: int = 64, levels: int = 3, now: int = None) -> None:
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self.wheels: 'list[list[list[Timer]]]' = [
+            [[] for _ in range(slots)] for _ in range(levels)]
+        self.overflow: 'list[Timer]' = []
+        now = round(time() * 1000000) if now is None else now
+        self.current_tick = now // tick
+        self.size = 0
+
+    def _insert(self, timer: Timer) -> None:
+        x = timer.expire_tick
+        y = self.current_tick
+        for level in range(self.levels):
+            # 与当前 tick 在同一个上层槽内，放在这一层
+            x //= self.slots
+            y //= self.slots
+            if x == y:
+                self.wheels[level][timer.expire_tick //
+                                   self.slots ** level % self.slots].append(timer)
+                return None
+        self.overflow.append(timer)
+
+    def schedule(self, deadline: int, callback, *args) -> Timer:
+        '''在`deadline`之后的第一个 tick 调用`callback(*args)`，已过期的在下一个 tick 调用'''
+        expire_tick = max(-(-deadline // self.tick), self.current_tick + 1)
+        timer = Timer(deadline, expire_tick, callback, args)
+        self._insert(timer)
+        self.size += 1
+        return timer
+
+    def _cascade(self, timers: 'list[Timer]') -> None:
+        for i in timers:
+            if i.cancelled:
+                self.size -= 1
+            else:
+                self._insert(i)
+
+    def advance(self, now: int = None) -> int:
+        '''推进到`now`，返回触发的计时器数量'''
+        now = round(time() * 1000000) if now is None else now
+        target = now // self.tick
+        n = 0
+        while self.current_tick < target:
+            self.current_tick += 1
+            t = self.current_tick
+            if t % self.slots ** self.levels == 0:
+                timers, self.overflow = self.overflow, []
+                self._cascade(timers)
+            for level in range(self.levels - 1, 0, -1):
+                # 进入上层的新槽，把槽内的计时器放到下层
+                if t % self.slots ** level == 0:
+                    index = t // self.slots ** level % self.slots
+                    timers = self.wheels[level][index]
+                    self.wheels[level][index] = []
+                    self._cascade(timers)
+
+            index = t % self.slots
+            timers = self.wheels[0][index]
+            self.wheels[0][index] = []
+            for i in timers:
+                self.size -= 1
+                if i.cancelled:
+                    continue
+                n += 1
+                try:
+                    i.callback(*i.args)
+                except Exception as e:
+                    logging.error(e)
+        return n
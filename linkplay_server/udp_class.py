@@ -1,4 +1,6 @@
 import logging
+import sys
+from collections import deque
 from time import time
 from random import randint
 
@@ -87,7 +89,7 @@ class Player:
         self.online = 0
 
         self.last_timestamp = 0
-        self.extra_command_queue = []
+        self.extra_command_queue = deque(maxlen=12)  # 只发送最近 12 条
 
         self.song_unlock: bytes = b'\x00' * Config.LINK_PLAY_UNLOCK_LENGTH
 
@@ -189,6 +191,48 @@ class Player:
         return bytes(re)
 
 
+class CommandQueue:
+    '''
+    房间命令队列，固定容量的环形缓冲区
+    序号为绝对序号（从 0 开始，与命令中的 4 bytes 序号一致），只保留最近`capacity`条
+    '''
+
+    def __init__(self, capacity: int = None) -> None:
+        self.capacity = capacity or Config.COMMAND_QUEUE_CAPACITY
+        self.buffer: 'list[bytes]' = [None] * self.capacity
+        self.length = 0  # 已加入的命令总数，即下一条命令的序号
+
+    def __len__(self) -> int:
+        return self.length
+
+    @property
+    def start(self) -> int:
+        # 最早保留的命令序号
+        return max(0, self.length - self.capacity)
+
+    @property
+    def size(self) -> int:
+        # 实际保留的命令数
+        return self.length - self.start
+
+    @property
+    def memory_usage(self) -> int:
+        return sys.getsizeof(self.buffer) + sum(sys.getsizeof(i) for i in self.buffer if i is not None)
+
+    def append(self, command: bytes) -> None:
+        self.buffer[self.length % self.capacity] = command
+        self.length += 1
+
+    def __getitem__(self, index: int) -> bytes:
+        if not self.start <= index < self.length:
+            raise IndexError('Command has been dropped from the queue')
+        return self.buffer[index % self.capacity]
+
+    def is_available(self, index: int) -> bool:
+        # `index`之后的命令是否都还在队列中
+        return index >= self.start
+
+
 class Room:
 
     def __init__(self) -> None:
@@ -216,10 +260,12 @@ class Room:
 
         self.selected_voter_player_id: int = 0  # 5.10 新增
 
-        self.command_queue = []
+        self.command_queue = CommandQueue()
 
         self.next_state_timestamp = 0  # 计时模式下一个状态时间
 
+        self.timer = None  # 时间轮中的计时器，见 store.schedule_room
+
     @property
     def state(self) -> int:
         return self._state
@@ -287,11 +333,30 @@ class Room:
 
     @property
     def player_num(self) -> int:
-        now = round(time() * 1000000)
-        if now - self.timestamp >= 1000000:
-            self.check_player_online(now)
+        # 离线和超时由时间轮处理
         return sum(i.player_id != 0 for i in self.players)
 
+    def is_countdown_due(self, now: int) -> bool:
+        return self.countdown != 0xffffffff and 0 < self.next_state_timestamp <= now
+
+    def next_deadline(self, now: int) -> int:
+        # 下一个需要处理的时间：倒计时结束、玩家离线 / 超时、房间过期
+        r = self.timestamp + Config.TIME_LIMIT * 1000
+        if self.countdown != 0xffffffff and self.next_state_timestamp > now:
+            r = min(r, self.next_state_timestamp)
+        for i in self.players:
+            if i.player_id == 0 or i.last_timestamp == 0:
+                continue
+            r = min(r, i.last_timestamp + (Config.PLAYER_PRE_TIMEOUT if i.online ==
+                    1 else Config.PLAYER_TIMEOUT))
+        return r
+
+    @property
+    def memory_usage(self) -> int:
+        # 估算，主要是命令队列和解锁信息
+        return self.command_queue.memory_usage + sys.getsizeof(self.song_unlock) + sum(
+            sys.getsizeof(i.song_unlock) + sum(sys.getsizeof(j) for j in i.extra_command_queue) for i in self.players)
+
     def check_player_online(self, now: int = None):
         # 检测玩家是否被自动踢出房间 / 离线判断
         now = round(time() * 1000000) if now is None else now
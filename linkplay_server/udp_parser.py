@@ -35,17 +35,25 @@ class CommandParser:
 
         re = []
 
-        flag_13 = False
-        for i in range(max(bi(self.command[12:16]), self.room.players[self.player_index].start_command_num), self.room.command_queue_length):
-            if self.room.command_queue[i][2] == 0x13:
-                if flag_13:
-                    break
-                flag_13 = True
-            re.append(self.room.command_queue[i])
+        start = max(bi(self.command[12:16]),
+                    self.room.players[self.player_index].start_command_num)
+        if self.room.command_queue.is_available(start):
+            flag_13 = False
+            for i in range(start, self.room.command_queue_length):
+                if self.room.command_queue[i][2] == 0x13:
+                    if flag_13:
+                        break
+                    flag_13 = True
+                re.append(self.room.command_queue[i])
+        else:
+            # 落后太多，缺失的命令已被丢弃，直接同步完整房间信息
+            logging.info(
+                f'Player `{self.room.players[self.player_index].name}` resyncs room `{self.room.room_code}`')
+            re += self.s.command_resync()
 
         if self.room.players[self.player_index].extra_command_queue:
-            re += self.room.players[self.player_index].extra_command_queue[-12:]
-            self.room.players[self.player_index].extra_command_queue = []
+            re += self.room.players[self.player_index].extra_command_queue
+            self.room.players[self.player_index].extra_command_queue.clear()
 
         if r:
             re += r
@@ -166,12 +174,8 @@ class CommandParser:
             flag_0c = True
             player.last_timestamp = self.s.timestamp
 
-        # 离线判断
-        flag_13, player_index_list = self.room.check_player_online(
-            self.s.timestamp)
-        for i in player_index_list:
-            self.room.command_queue.append(self.s.command_12(i))
-
+        # 离线判断由时间轮处理，见 command_timer
+        flag_13 = False
         flag_11 = False
         flag_12 = False
 
@@ -324,6 +328,63 @@ class CommandParser:
         if flag_0c:
             return [self.s.command_0c()]
 
+    def command_timer(self, flag_13: bool, player_index_list: list):
+        # 由时间轮调用，处理玩家离线 / 超时和倒计时结束，不依赖玩家的数据包
+        # 状态转换与 command_09 中相同
+        for i in player_index_list:
+            self.room.command_queue.append(self.s.command_12(i))
+
+        flag_11 = False
+
+        if self.room.state == 1 and self.room.is_public and self.room.player_num > 1 and self.room.should_next_state:
+            flag_13 = True
+            self.room.state = 2
+
+        if self.room.state in (2, 3) and self.room.player_num < 2:
+            flag_13 = True
+            self.room.state = 1
+
+        if self.room.state == 2 and self.room.should_next_state:
+            self.room.state = 3
+            flag_13 = True
+            if self.room.round_mode == 3:
+                self.room.make_voting()
+            else:
+                self.room.random_song()
+
+        if self.room.state == 3 and self.room.should_next_state:
+            flag_13 = True
+            self.room.state = 4
+            if self.room.round_mode == 2:
+                self.room.make_round()
+            logging.info(f'Room `{self.room.room_code}` starts playing')
+            for p in self.room.players:
+                p.finish_flag = 0
+
+        if self.room.state == 4 and self.room.should_next_state:
+            self.room.state = 5
+            flag_11 = True
+            flag_13 = True
+
+        if self.room.state in (5, 6) and self.room.should_next_state:
+            self.room.state = 7
+            flag_13 = True
+
+        if self.room.state == 8 and self.room.should_next_state:
+            flag_13 = True
+            self.room.state = 1
+            self.room.song_idx = 0xffff
+
+        if self.room.is_finish():
+            # 有人超时导致的结算
+            self.room.make_finish()
+            flag_13 = True
+
+        if flag_11:
+            self.room.command_queue.append(self.s.command_11())
+        if flag_13:
+            self.room.command_queue.append(self.s.command_13())
+
     def command_0a(self):
         # 退出房间
         self.room.delete_player(self.player_index)
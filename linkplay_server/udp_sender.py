@@ -35,9 +35,10 @@ class CommandSender:
         x = 16 - len(r) % 16
         return r + PADDING[x]
 
-    def command_prefix(self, command: bytes):
+    def command_prefix(self, command: bytes, queued: bool = True):
+        # 进入队列的 0x10 ~ 0x1f 命令序号为其在队列中的序号 + 1
         length = self.room.command_queue_length
-        if b'\x10' <= command <= b'\x1f':
+        if queued and b'\x10' <= command <= b'\x1f':
             length += 1
 
         return (self.PROTOCOL_NAME, command, self.PROTOCOL_VERSION, b(self.room.room_id, 8), b(length, 4))
@@ -87,3 +88,11 @@ class CommandSender:
     def command_21(self, player_index: int, sticker_id: int):
         player = self.room.players[player_index]
         return self.command_encode((*self.command_prefix(b'\x21'), b(player.player_id, 8), b(sticker_id, 2)))
+
+    def command_resync(self):
+        # 不进入队列的完整房间信息，序号为当前队列长度，客户端之后从队列末尾继续接收
+        return [
+            self.command_encode((*self.command_prefix(b'\x11', False), self.random_code, self.room.get_players_info())),
+            self.command_encode((*self.command_prefix(b'\x14', False), self.random_code, self.room.song_unlock)),
+            self.command_encode((*self.command_prefix(b'\x13', False), self.random_code, self.room.room_info)),
+        ]
@@ -23,24 +23,35 @@ if Config.DEPLOY_MODE == 'gevent':
     monkey.patch_all()
 
 
+import gc
+import signal
+import socket
 import sys
 from logging.config import dictConfig
 from multiprocessing import Process, set_start_method
+from threading import Lock, Thread
+from time import sleep, time
 from traceback import format_exc
 
 from flask import Flask, make_response, request, send_from_directory
+from werkzeug.wsgi import ClosingIterator
 
 import api
 import server
 import web.index
 import web.login
 # import webapi
+from core.bgtask import LogWriter
 from core.bundle import BundleDownload
+from core.character import CharacterCatalogue
 from core.constant import Constant
 from core.download import UserDownload
 from core.error import ArcError, NoAccess, RateLimit
 from core.init import FileChecker
-from core.sql import Connect
+from core.operation import (RefreshBundleCache, RefreshChangedSongFileCache,
+                            RefreshWorldMapCache)
+from core.sql import Connect, ConnectionPool
+from core.world import MapParser
 from server.func import error_return
 
 app = Flask(__name__)
@@ -83,30 +94,28 @@ def favicon():
 
 @app.route('/download/<path:file_path>', methods=['GET'])  # 下载
 def download(file_path):
-    with Connect(in_memory=True) as c:
-        try:
-            x = UserDownload(c)
-            x.token = request.args.get('t')
-            x.song_id, x.file_name = file_path.split('/', 1)
-            x.select_for_check()
-            if x.is_limited:
-                raise RateLimit(
-                    f'User `{x.user.user_id}` has reached the download limit.', 903)
-            if not x.is_valid:
-                raise NoAccess('Expired token.')
-            x.download_hit()
-            if Config.DOWNLOAD_USE_NGINX_X_ACCEL_REDIRECT:
-                # nginx X-Accel-Redirect
-                response = make_response()
-                response.headers['Content-Type'] = 'application/octet-stream'
-                response.headers['X-Accel-Redirect'] = Config.NGINX_X_ACCEL_REDIRECT_PREFIX + file_path
-                return response
-            return send_from_directory(Constant.SONG_FILE_FOLDER_PATH, file_path, as_attachment=True, conditional=True)
-        except ArcError as e:
-            if Config.ALLOW_WARNING_LOG:
-                app.logger.warning(format_exc())
-            return error_return(e)
-    return error_return()
+    try:
+        x = UserDownload()
+        x.token = request.args.get('t')
+        x.song_id, x.file_name = file_path.split('/', 1)
+        x.select_for_check()
+        if x.is_limited:
+            raise RateLimit(
+                f'User `{x.user.user_id}` has reached the download limit.', 903)
+        if not x.is_valid:
+            raise NoAccess('Expired token.')
+        x.download_hit()
+        if Config.DOWNLOAD_USE_NGINX_X_ACCEL_REDIRECT:
+            # nginx X-Accel-Redirect
+            response = make_response()
+            response.headers['Content-Type'] = 'application/octet-stream'
+            response.headers['X-Accel-Redirect'] = Config.NGINX_X_ACCEL_REDIRECT_PREFIX + file_path
+            return response
+        return send_from_directory(Constant.SONG_FILE_FOLDER_PATH, file_path, as_attachment=True, conditional=True)
+    except ArcError as e:
+        if Config.ALLOW_WARNING_LOG:
+            app.logger.warning(format_exc())
+        return error_return(e)
 
 
 @app.route('/bundle_download/<string:token>', methods=['GET'])  # 热更新下载
@@ -144,8 +153,195 @@ if Config.DEPLOY_MODE == 'waitress':
 #     print(request.data)
 
 
+class PreforkWorker:
+    '''
+        prefork 子进程，共享主进程监听的 socket
+
+        处理 PREFORK_MAX_REQUESTS 个请求后退出，由主进程重新创建
+        收到 SIGTERM 后不再接受新连接，等待处理中的请求结束后退出
+    '''
+
+    def __init__(self, sock: socket.socket) -> None:
+        self.sock = sock
+        self.max_requests = Config.PREFORK_MAX_REQUESTS
+        self.requests = 0
+        self.active = 0
+        self.lock = Lock()
+        self.server = None
+        self.stopping = False
+
+    def __call__(self, environ, start_response):
+        with self.lock:
+            self.requests += 1
+            self.active += 1
+            if self.max_requests and self.requests >= self.max_requests:
+                self.stop()
+        try:
+            # 响应体发送完毕（close）后才算请求结束
+            return ClosingIterator(app(environ, start_response), self.finish)
+        except BaseException:
+            self.finish()
+            raise
+
+    def finish(self) -> None:
+        with self.lock:
+            self.active -= 1
+
+    def stop(self, *args) -> None:
+        if self.stopping:
+            return
+        self.stopping = True
+        # shutdown 会等待 serve_forever 结束，不能在服务线程中调用
+        Thread(target=self.server.shutdown, daemon=True).start()
+
+    def run(self) -> None:
+        signal.signal(signal.SIGTERM, self.stop)
+        # 终端的 Ctrl+C 会发给整个进程组，由主进程统一处理
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+        from werkzeug.serving import make_server
+        ssl_context = (Config.SSL_CERT, Config.SSL_KEY) if Config.SSL_CERT and Config.SSL_KEY else None
+        self.server = make_server(Config.HOST, Config.PORT, self, threaded=True,
+                                  ssl_context=ssl_context, fd=self.sock.fileno())
+        self.server.serve_forever()
+
+        deadline = time() + Config.PREFORK_GRACEFUL_TIMEOUT
+        while self.active > 0 and time() < deadline:
+            sleep(0.1)
+        LogWriter.shutdown()
+        ConnectionPool.close_all()
+
+
+class PreforkMaster:
+    '''
+        prefork 主进程，只负责监听 socket 和管理子进程，不处理请求
+
+        fork 前预热只读缓存，子进程通过写时复制共享
+        SIGHUP: 重新加载文件缓存并逐个替换子进程
+        SIGTERM / SIGINT: 等待子进程处理完请求后退出
+    '''
+
+    def __init__(self) -> None:
+        self.workers_num = Config.PREFORK_WORKERS or os.cpu_count() or 1
+        self.workers: 'dict[int, int]' = {}  # {pid: generation}
+        self.generation = 0
+        self.sock: socket.socket = None
+        self.reloading = False
+        self.stopping = False
+
+    @staticmethod
+    def warm_up() -> None:
+        for map_id in MapParser.map_id_path:
+            MapParser.get_map_payload(map_id)
+        with Connect() as c:
+            CharacterCatalogue.get_all(c)
+        UserDownload.get_token_key()
+        for i, path in MapParser.map_lephon_nell_phases.items():
+            if os.path.isfile(path) and 'lephon_nell' in MapParser.map_id_path:
+                MapParser.get_map_payload('lephon_nell', i)
+        if hasattr(gc, 'freeze'):
+            # 预热的对象移出 GC 追踪，避免子进程中 GC 写入导致内存页复制
+            gc.freeze()
+
+    def reload(self) -> None:
+        CharacterCatalogue.clear()
+        RefreshChangedSongFileCache().run()
+        RefreshBundleCache().run()
+        RefreshWorldMapCache().run()
+        self.warm_up()
+
+    def spawn(self) -> None:
+        # 写线程可能持有连接池的锁或连接，fork 前写完并结束，之后按需重新启动
+        LogWriter.shutdown()
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                PreforkWorker(self.sock).run()
+            except BaseException:
+                app.logger.error(format_exc())
+                code = 1
+            finally:
+                os._exit(code)
+        self.workers[pid] = self.generation
+
+    def reap(self) -> None:
+        while self.workers:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            if self.workers.pop(pid, None) == self.generation and not self.stopping:
+                app.logger.info(f'Prefork worker {pid} exited.')
+
+    @staticmethod
+    def kill(pid: int, signum: int) -> None:
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def signal_handler(self, signum, frame) -> None:
+        if signum == signal.SIGHUP:
+            self.reloading = True
+        else:
+            self.stopping = True
+
+    def run(self) -> None:
+        family = socket.AF_INET6 if ':' in Config.HOST else socket.AF_INET
+        self.sock = socket.create_server(
+            (Config.HOST, Config.PORT), family=family, backlog=2048)
+        self.warm_up()
+
+        signal.signal(signal.SIGHUP, self.signal_handler)
+        signal.signal(signal.SIGTERM, self.signal_handler)
+        signal.signal(signal.SIGINT, self.signal_handler)
+
+        app.logger.info(
+            f'Running prefork WSGI server with {self.workers_num} workers... ({Config.HOST}:{Config.PORT})')
+        while not self.stopping:
+            self.reap()
+            if self.reloading:
+                self.reloading = False
+                app.logger.info('Reloading prefork workers...')
+                try:
+                    self.reload()
+                except Exception:
+                    app.logger.error(format_exc())
+                old = list(self.workers)
+                self.generation += 1
+                # 先创建新的子进程再结束旧的，旧的子进程会处理完已接受的请求
+                for _ in range(self.workers_num):
+                    self.spawn()
+                for pid in old:
+                    self.kill(pid, signal.SIGTERM)
+            while sum(1 for i in self.workers.values() if i == self.generation) < self.workers_num:
+                self.spawn()
+            sleep(0.5)
+
+        app.logger.info('Stopping prefork workers...')
+        for pid in self.workers:
+            self.kill(pid, signal.SIGTERM)
+        deadline = time() + Config.PREFORK_GRACEFUL_TIMEOUT + 5
+        while self.workers and time() < deadline:
+            self.reap()
+            sleep(0.1)
+        for pid in self.workers:
+            self.kill(pid, signal.SIGKILL)
+        self.sock.close()
+
+
 def tcp_server_run():
-    if Config.DEPLOY_MODE == 'gevent':
+    if Config.DEPLOY_MODE == 'prefork' and not hasattr(os, 'fork'):
+        app.logger.warning(
+            'Prefork deploy mode needs `os.fork`, use flask_multithread instead.')
+    if Config.DEPLOY_MODE == 'prefork' and hasattr(os, 'fork'):
+        # 多进程 prefork WSGI server
+        PreforkMaster().run()
+    elif Config.DEPLOY_MODE == 'gevent':
         # 异步 gevent WSGI server
         host_port = (Config.HOST, Config.PORT)
         app.logger.info('Running gevent WSGI server... (%s:%s)' % host_port)
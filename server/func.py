@@ -1,7 +1,11 @@
+import json
+import os
+import re
 from functools import wraps
+from threading import Lock
 from traceback import format_exc
 
-from flask import current_app, g, jsonify
+from flask import current_app, g
 
 from core.bundle import BundleParser
 from core.config_manager import Config
@@ -14,9 +18,151 @@ try:
 except ModuleNotFoundError:
     pass
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
 default_error = ArcError('Unknown Error', status=500)
 
 
+class RawJSON:
+    '''已编码的 JSON 片段，序列化时原样拼接'''
+    __slots__ = ('data',)
+
+    def __init__(self, data: bytes) -> None:
+        self.data = data
+
+
+def stdlib_dumps(obj, default) -> bytes:
+    # 与 flask `jsonify` 的输出相同
+    return json.dumps(obj, default=default, ensure_ascii=True, sort_keys=True, separators=(',', ':')).encode()
+
+
+def orjson_dumps(obj, default) -> bytes:
+    return orjson.dumps(obj, default=default, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS)
+
+
+def ujson_dumps(obj, default) -> bytes:
+    return ujson.dumps(obj, default=default, ensure_ascii=False, sort_keys=True, escape_forward_slashes=False).encode()
+
+
+class ResponseSerializer:
+    '''
+        游戏 API 和 API 接口的 JSON 响应序列化
+
+        `Config.RESPONSE_JSON_ENCODER`: 'auto' | 'orjson' | 'ujson' | 'json'，'auto' 按此顺序选择已安装的
+        也可以用`register`添加其它编码器，`dumps(obj, default) -> bytes`，需要按键排序
+        快速编码器失败时（如超出 64 位的整数）回退到标准库
+        `RawJSON`先编码为带随机前缀的占位字符串，最后一次替换，orjson >= 3.9 直接使用`orjson.Fragment`
+        旧版 orjson 替换的开销大于编码，此时`pre_encode`为 False
+    '''
+    encoders = {
+        'orjson': orjson_dumps if orjson is not None else None,
+        'ujson': ujson_dumps if ujson is not None else None,
+        'json': stdlib_dumps,
+    }
+
+    name: str = None
+    dumps = None
+    fragment_type = None
+    pre_encode = True
+
+    placeholder = os.urandom(8).hex()
+    placeholder_pattern = re.compile(rb'"' + placeholder.encode() + rb':(\d+)"')
+
+    @classmethod
+    def register(cls, name: str, dumps) -> None:
+        cls.encoders[name] = dumps
+        cls.name = None
+
+    @classmethod
+    def init(cls) -> None:
+        name = Config.RESPONSE_JSON_ENCODER
+        if name == 'auto':
+            name = next(k for k, v in cls.encoders.items() if v is not None)
+        dumps = cls.encoders.get(name)
+        if dumps is None:
+            raise ValueError(f'JSON encoder `{name}` is not available.')
+        cls.dumps = staticmethod(dumps)
+        cls.fragment_type = getattr(
+            orjson, 'Fragment', None) if dumps is orjson_dumps else None
+        cls.pre_encode = dumps is not orjson_dumps or cls.fragment_type is not None
+        cls.name = name
+
+    @classmethod
+    def encode(cls, obj) -> bytes:
+        if cls.name is None:
+            cls.init()
+
+        fragments = []
+        fragment_type = cls.fragment_type
+
+        def default(x):
+            if isinstance(x, RawJSON):
+                if fragment_type is not None:
+                    return fragment_type(x.data)
+                fragments.append(x.data)
+                return f'{cls.placeholder}:{len(fragments) - 1}'
+            raise TypeError(
+                f'Object of type {x.__class__.__name__} is not JSON serializable')
+
+        try:
+            r = cls.dumps(obj, default)
+        except (TypeError, ValueError, OverflowError):
+            if cls.dumps is stdlib_dumps:
+                raise
+            fragments.clear()
+            fragment_type = None
+            r = stdlib_dumps(obj, default)
+
+        if fragments:
+            r = cls.placeholder_pattern.sub(
+                lambda m: fragments[int(m[1])], r)
+        return r
+
+
+class StaticFragment:
+    '''
+        不变内容的缓存，`key`需能唯一确定内容，`ResponseSerializer.pre_encode`时保存编码结果
+        超过 MAX_SIZE 时清空
+    '''
+    MAX_SIZE = 4096
+
+    fragments: dict = {}
+    lock = Lock()
+
+    @classmethod
+    def get(cls, key: tuple, func):
+        x = cls.fragments.get(key)
+        if x is None:
+            if ResponseSerializer.name is None:
+                ResponseSerializer.init()
+            x = func()
+            if ResponseSerializer.pre_encode:
+                x = RawJSON(ResponseSerializer.encode(x))
+            with cls.lock:
+                if len(cls.fragments) >= cls.MAX_SIZE:
+                    cls.fragments.clear()
+                cls.fragments[key] = x
+        return x
+
+    @classmethod
+    def clear(cls) -> None:
+        with cls.lock:
+            cls.fragments.clear()
+
+
+def json_response(obj):
+    '''代替`jsonify`，使用`ResponseSerializer`'''
+    return current_app.response_class(ResponseSerializer.encode(obj) + b'\n', mimetype='application/json')
+
+
 def error_return(e: ArcError = default_error):  # 错误返回
     # -7 处理交易时发生了错误
     # -5 所有的曲目都已经下载完毕
@@ -74,14 +220,14 @@ def error_return(e: ArcError = default_error):  # 错误返回
     if e.extra_data:
         r['extra'] = e.extra_data
 
-    return jsonify(r), e.status
+    return json_response(r), e.status
 
 
 def success_return(value=None):
     r = {"success": True}
     if value is not None:
         r['value'] = value
-    return jsonify(r)
+    return json_response(r)
 
 
 def arc_try(view):
@@ -1,7 +1,7 @@
 import json
 from urllib.parse import parse_qs, urlparse
 
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, request
 from werkzeug.datastructures import ImmutableMultiDict
 
 from core.bundle import BundleDownload
@@ -14,7 +14,8 @@ from core.system import GameInfo
 from core.user import UserOnline
 
 from .auth import auth_required
-from .func import arc_try, error_return, success_return
+from .func import (RawJSON, StaticFragment, arc_try, error_return,
+                   json_response, success_return)
 from .present import present_info
 from .purchase import bundle_bundle, bundle_pack, get_single
 from .score import song_score_friend
@@ -26,7 +27,10 @@ bp = Blueprint('others', __name__)
 
 @bp.route('/game/info', methods=['GET'])  # 系统信息
 def game_info():
-    return success_return(GameInfo().to_dict())
+    r = GameInfo().to_dict()
+    r['level_steps'] = StaticFragment.get(
+        ('level_steps',), lambda: r['level_steps'])
+    return success_return(r)
 
 
 @bp.route('/notification/me', methods=['GET'])  # 通知
@@ -57,16 +61,15 @@ def game_content_bundle():
 @auth_required(request)
 @arc_try
 def download_song(user_id):
-    with Connect(in_memory=True) as c_m:
-        with Connect() as c:
-            x = DownloadList(c_m, UserOnline(c, user_id))
-            x.song_ids = request.args.getlist('sid')
-            x.url_flag = json.loads(request.args.get('url', 'true'))
-            if x.url_flag and x.is_limited:
-                raise RateLimit('You have reached the download limit.', 903)
+    with Connect() as c:
+        x = DownloadList(UserOnline(c, user_id))
+        x.song_ids = request.args.getlist('sid')
+        x.url_flag = json.loads(request.args.get('url', 'true'))
+        if x.url_flag and x.is_limited:
+            raise RateLimit('You have reached the download limit.', 903)
 
-            x.add_songs()
-            return success_return(x.urls)
+        x.add_songs()
+        return success_return(x.urls)
 
 
 @bp.route('/finale/progress', methods=['GET'])
@@ -143,6 +146,8 @@ map_dict = {
     '/purchase/bundle/single': get_single
 }
 
+SUCCESS_PREFIX = b'{"success":true,"value":'
+
 
 @bp.route('/compose/aggregate', methods=['GET'])  # 集成式请求
 def aggregate():
@@ -166,7 +171,13 @@ def aggregate():
                 resp_t = resp_t[0]
 
             if hasattr(resp_t, "response"):
-                resp_t = resp_t.response[0].decode().rstrip('\n')
+                resp_t = resp_t.response[0]
+                if resp_t.startswith(SUCCESS_PREFIX):
+                    # 成功的响应直接拼接，不重新解析
+                    finally_response['value'].append(
+                        {'id': i.get('id'), 'value': RawJSON(resp_t.rstrip(b'\n')[len(SUCCESS_PREFIX):-1])})
+                    continue
+                resp_t = resp_t.decode().rstrip('\n')
             resp = json.loads(resp_t)
 
             if hasattr(resp, 'get') and resp.get('success') is False:
@@ -175,12 +186,12 @@ def aggregate():
                 if "extra" in resp:
                     finally_response['extra'] = resp['extra']
                 # request = request_
-                return jsonify(finally_response)
+                return json_response(finally_response)
 
             finally_response['value'].append(
                 {'id': i.get('id'), 'value': resp['value'] if hasattr(resp, 'get') else resp})
 
         # request = request_
-        return jsonify(finally_response)
+        return json_response(finally_response)
     except KeyError:
         return error_return()
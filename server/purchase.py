@@ -11,11 +11,23 @@ from core.sql import Connect
 from core.user import UserOnline
 
 from .auth import auth_required
-from .func import arc_try, success_return
+from .func import StaticFragment, arc_try, success_return
 
 bp = Blueprint('purchase', __name__, url_prefix='/purchase')
 
 
+def purchase_list_to_dict(x: PurchaseList) -> list:
+    '''物品列表按内容预编码缓存，价格与用户和时间有关，每次计算'''
+    r = []
+    for i in x.purchases:
+        d = i.to_dict(has_items=False)
+        d['items'] = StaticFragment.get(
+            ('purchase_items', *((j.item_id, j.item_type, j.amount, j.is_available) for j in i.items)),
+            lambda: [j.to_dict(has_is_available=True) for j in i.items])
+        r.append(d)
+    return r
+
+
 @bp.route('/bundle/pack', methods=['GET'])  # 曲包信息
 @auth_required(request)
 @arc_try
@@ -23,7 +35,7 @@ def bundle_pack(user_id):
     with Connect() as c:
         x = PurchaseList(c, UserOnline(c, user_id)
                          ).select_from_type('pack')
-        return success_return(x.to_dict_list())
+        return success_return(purchase_list_to_dict(x))
 
 
 @bp.route('/bundle/single', methods=['GET'])  # 单曲购买信息获取
@@ -33,7 +45,7 @@ def get_single(user_id):
     with Connect() as c:
         x = PurchaseList(c, UserOnline(c, user_id)
                          ).select_from_type('single')
-        return success_return(x.to_dict_list())
+        return success_return(purchase_list_to_dict(x))
 
 
 @bp.route('/bundle/bundle', methods=['GET'])  # 捆绑包
@@ -6,7 +6,7 @@ from core.error import ArcError
 from core.item import ItemCore
 from core.operation import DeleteOneUser
 from core.save import SaveData
-from core.sql import Connect
+from core.sql import Connect, QueryCounter
 from core.user import User, UserLogin, UserOnline, UserRegister
 
 from .auth import auth_required
@@ -50,7 +50,9 @@ def register():
 @arc_try
 def user_me(user_id):
     with Connect() as c:
-        return success_return(UserOnline(c, user_id).to_dict())
+        with QueryCounter(c, '/user/me'):
+            r = UserOnline(c, user_id).to_dict()
+        return success_return(r)
 
 @bp.route('/me/toggle_invasion', methods=['POST'])  # insight skill
 @auth_required(request)
@@ -2,7 +2,7 @@ from flask import Blueprint, request
 
 from core.sql import Connect
 from core.user import UserOnline
-from core.world import MapParser, UserMap
+from core.world import UserMap
 
 from .auth import auth_required
 from .func import arc_try, success_return
@@ -19,16 +19,10 @@ def world_all(user_id):
         user.select_user()
         user.select_user_about_current_map()
 
-        maps = []
-        for x in MapParser.get_world_all(c, user):
-            if x.map_id == 'lephon_nell' and user.lephon_nell_state == 4:
-                continue
-            maps.append(x.to_dict(has_map_info=True, has_rewards=True))
-
         return success_return({
             "current_map": user.current_map.map_id,
             "user_id": user_id,
-            "maps": maps
+            "maps": UserMap.get_user_all_to_dict(c, user)
         })
 
 
@@ -0,0 +1,114 @@
+'''
+    歌曲下载列表 benchmark
+
+    生成临时歌曲目录，测试 `/serve/download/me/song` 全曲库和单曲请求的耗时，
+    并检查下载 token 的校验（包括含非 ASCII 字符的 token）
+    usage: python tools/bench_download.py [--songs 500] [--rounds 20]
+'''
+import os
+import sys
+from argparse import ArgumentParser
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core.config_manager import Config  # noqa: E402
+
+FILE_NAMES = ['0.aff', '1.aff', '2.aff', '3.aff', 'base.ogg', '3.ogg']
+
+
+def make_songs(folder: str, songs: int) -> None:
+    for i in range(songs):
+        song_folder = os.path.join(folder, f'song{i:05d}')
+        os.makedirs(song_folder)
+        for j in FILE_NAMES:
+            with open(os.path.join(song_folder, j), 'wb') as f:
+                f.write(os.urandom(4096))
+
+
+def timeit(func, rounds: int) -> float:
+    func()
+    t = perf_counter()
+    for _ in range(rounds):
+        func()
+    return (perf_counter() - t) / rounds * 1000
+
+
+def check_token(user) -> None:
+    from core.download import UserDownload
+    from core.error import NoAccess
+
+    x = UserDownload(user)
+    x.song_id = 'song00000'
+    x.file_name = 'base.ogg'
+    x.generate_token()
+    token = x.token
+    for i in (token, token[:-1] + '\u00e9', token[:-2] + '\u4e2d', token + '\udc80', 'a.b.c'):
+        y = UserDownload()
+        y.song_id = x.song_id
+        y.file_name = x.file_name
+        y.token = i
+        try:
+            y.select_for_check()
+            valid = True
+        except NoAccess:
+            valid = False
+        assert valid == (i == token), f'token check failed: {i!r}'
+    print('token check: ok')
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--songs', type=int, default=500)
+    parser.add_argument('--rounds', type=int, default=20)
+    args = parser.parse_args()
+
+    folder = mkdtemp()
+    try:
+        make_songs(folder, args.songs)
+        Config.SONG_FILE_FOLDER_PATH = folder
+        Config.SONGLIST_FILE_PATH = os.path.join(folder, 'songlist')
+        Config.DOWNLOAD_FORBID_WHEN_NO_ITEM = False
+        Config.SECRET_KEY = os.urandom(16).hex()
+        # 文件 md5 保存在日志数据库中
+        Config.SQLITE_LOG_DATABASE_PATH = os.path.join(folder, 'log.db')
+
+        from core.init import LogDatabaseInit
+        LogDatabaseInit(Config.SQLITE_LOG_DATABASE_PATH, os.path.join(
+            os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'database', 'init')).init()
+
+        from flask import Flask
+
+        from core.download import DownloadList
+        from core.user import User
+
+        app = Flask(__name__)
+        app.add_url_rule('/download/<path:file_path>', 'download')
+
+        t = perf_counter()
+        DownloadList.initialize_cache()
+        print(f'initialize_cache: {(perf_counter() - t) * 1000:.1f} ms '
+              f'({args.songs} songs, {args.songs * len(FILE_NAMES)} files)')
+
+        user = User()
+        user.user_id = 2000001
+
+        def request(song_ids: list):
+            with app.test_request_context('/'):
+                x = DownloadList(user)
+                x.song_ids = song_ids
+                x.url_flag = True
+                x.add_songs()
+                return x.urls
+
+        check_token(user)
+        print(f'full library: {timeit(lambda: request([]), args.rounds):.2f} ms/request')
+        print(f'single song: {timeit(lambda: request(["song00000"]), args.rounds * 50):.3f} ms/request')
+    finally:
+        rmtree(folder, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
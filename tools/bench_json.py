@@ -0,0 +1,139 @@
+'''
+    响应 JSON 编码 benchmark
+
+    比较 flask `jsonify` 和 `ResponseSerializer` 各编码器的耗时，结果解析后需相同
+    "(fragments)" 为物品列表使用 `StaticFragment` 的购买列表（缓存已建立）
+    默认载荷由仓库数据生成（/game/info、曲包和单曲购买列表、地图、下载列表），
+    也可以用 `--payload` 指定抓取的响应体文件，可多次指定
+    usage: python tools/bench_json.py [--payload user_me.json ...] [--songs 500] [--rounds 200]
+'''
+import json
+import os
+import sys
+from argparse import ArgumentParser
+from time import perf_counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from flask import Flask, jsonify  # noqa: E402
+
+from core.config_manager import Config  # noqa: E402
+from core.system import GameInfo  # noqa: E402
+from core.world import MapParser  # noqa: E402
+from server.func import ResponseSerializer, StaticFragment  # noqa: E402
+
+
+def load_purchases(file_name: str) -> list:
+    with open(os.path.join(ROOT, 'database', 'init', file_name), 'rb') as f:
+        return json.load(f)
+
+
+def with_item_fragments(purchases: list) -> list:
+    r = []
+    for i in purchases:
+        d = dict(i)
+        d['items'] = StaticFragment.get(
+            ('purchase_items', i['name'], json.dumps(i['items'])), lambda: i['items'])
+        r.append(d)
+    return r
+
+
+def make_download_list(songs: int) -> dict:
+    def url(song_id, file_name):
+        return f'https://example.com/download/{song_id}/{file_name}?t=2000001.1700000000.{os.urandom(16).hex()}'
+
+    r = {}
+    for i in range(songs):
+        song_id = f'song{i:05d}'
+        r[song_id] = {
+            'audio': {'checksum': os.urandom(16).hex(), 'url': url(song_id, 'base.ogg')},
+            'chart': {str(j): {'checksum': os.urandom(16).hex(), 'url': url(song_id, f'{j}.aff')} for j in range(4)}
+        }
+    return r
+
+
+def make_payloads(args) -> dict:
+    '''{name: func}，`func`返回载荷，"(fragments)" 的载荷与编码器有关'''
+    r = {}
+    if args.payload:
+        for path in args.payload:
+            with open(path, 'rb') as f:
+                x = json.load(f)
+            r[os.path.basename(path)] = lambda x=x: x
+        return r
+
+    packs = load_purchases('packs.json')
+    singles = load_purchases('singles.json')
+    game_info = {'success': True, 'value': GameInfo().to_dict()}
+    r['game_info'] = lambda: game_info
+    r['pack_list'] = lambda: {'success': True, 'value': packs}
+    r['pack_list (fragments)'] = lambda: {
+        'success': True, 'value': with_item_fragments(packs)}
+    r['single_list'] = lambda: {'success': True, 'value': singles}
+    r['single_list (fragments)'] = lambda: {
+        'success': True, 'value': with_item_fragments(singles)}
+
+    os.chdir(ROOT)
+    MapParser()
+    world_map = {'success': True, 'value': {'maps': [
+        dict(MapParser.get_map_payload(i), user_id=2000001) for i in MapParser.map_id_path]}}
+    r['world_map'] = lambda: world_map
+
+    download_list = {'success': True,
+                     'value': make_download_list(args.songs)}
+    r['download_list'] = lambda: download_list
+    return r
+
+
+def timeit(func, rounds: int) -> float:
+    func()
+    t = perf_counter()
+    for _ in range(rounds):
+        func()
+    return (perf_counter() - t) / rounds * 1000
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--payload', action='append',
+                        help='captured response body (JSON file)')
+    parser.add_argument('--songs', type=int, default=500)
+    parser.add_argument('--rounds', type=int, default=200)
+    args = parser.parse_args()
+
+    encoders = [k for k, v in ResponseSerializer.encoders.items()
+                if v is not None]
+    print('encoders:', ', '.join(encoders))
+
+    app = Flask(__name__)
+    with app.app_context():
+        payloads = make_payloads(args)
+        print(f'{"payload":<26}{"size":>10}{"jsonify":>12}' +
+              ''.join(f'{i:>12}' for i in encoders))
+        for name, func in payloads.items():
+            base = None
+            if not name.endswith('(fragments)'):
+                obj = func()
+                base = jsonify(obj).get_data()
+                t_base = timeit(lambda: jsonify(obj).get_data(), args.rounds)
+
+            line = ''
+            for i in encoders:
+                Config.RESPONSE_JSON_ENCODER = i
+                ResponseSerializer.init()
+                StaticFragment.clear()
+                obj = func()
+                data = ResponseSerializer.encode(obj)
+                if base is not None:
+                    assert json.loads(data) == json.loads(base), f'{i}: {name}'
+                t = timeit(lambda: ResponseSerializer.encode(obj), args.rounds)
+                line += f'{t:>9.3f} ms'
+
+            size = len(base if base is not None else data)
+            t_base_str = f'{t_base:>9.3f} ms' if base is not None else f'{"-":>12}'
+            print(f'{name:<26}{size:>10}{t_base_str}{line}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+'''
+    ArcLimiter 存储后端 benchmark
+
+    多个进程同时对随机 key 调用 hit / test，统计每次调用耗时，并检查计数是否在进程间共享
+    usage: python tools/bench_limiter.py [--workers 4] [--calls 20000] [--keys 1000]
+'''
+import os
+import sys
+from argparse import ArgumentParser
+from multiprocessing import Pool
+from random import randrange
+from tempfile import mkdtemp
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core.config_manager import Config  # noqa: E402
+
+
+def worker(args: tuple) -> tuple:
+    uri, calls, keys = args
+    Config.RATE_LIMIT_STORAGE_URI = uri
+    from core.limiter import ArcLimiter
+    limiter = ArcLimiter('1000000/day', 'bench')
+
+    t = perf_counter()
+    for _ in range(calls):
+        limiter.hit(str(randrange(keys)))
+    hit_time = perf_counter() - t
+
+    t = perf_counter()
+    for _ in range(calls):
+        limiter.test(str(randrange(keys)))
+    test_time = perf_counter() - t
+
+    limiter.hit('shared')
+    return hit_time / calls * 1e6, test_time / calls * 1e6
+
+
+def count_shared(uri: str) -> int:
+    Config.RATE_LIMIT_STORAGE_URI = uri
+    from core.limiter import ArcLimiter
+    limiter = ArcLimiter('1000000/day', 'bench')
+    limit = limiter.limits[0]
+    return limiter.storage.get(limit.key_for('bench', 'shared', 1))
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--calls', type=int, default=20000)
+    parser.add_argument('--keys', type=int, default=1000)
+    args = parser.parse_args()
+
+    folder = mkdtemp()
+    uris = ['memory://', f'sqlite:///{os.path.join(folder, "limiter.db")}']
+    for uri in uris:
+        with Pool(args.workers) as pool:
+            r = pool.map(
+                worker, [(uri, args.calls, args.keys)] * args.workers)
+        hit = sum(i[0] for i in r) / len(r)
+        test = sum(i[1] for i in r) / len(r)
+        shared = 'n/a' if uri.startswith('memory') else count_shared(uri)
+        print(f'{uri.split(":")[0]:>8}: hit {hit:7.2f} us/call, test {test:7.2f} us/call, '
+              f'{args.workers} workers, shared counter = {shared} (expected {args.workers})')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+'''
+    Link Play 服务器压力测试
+
+    每个客户端通过 TCP 建房后，用 UDP 持续发送 0x23 命令（单人房间时直接回复 0x0d，带回请求中的随机码），
+    收到回复后立即发送下一个，统计每秒处理的包数和延迟；同时每秒发送一次 0x09 心跳保持在线
+    `--start` 指定仓库目录时在子进程中启动该目录的 Link Play 服务器，用于对比不同版本
+    `--tcp-requests` 大于 0 时只测试 TCP 接口：每次新建连接和 `LinkPlayChannel` 长连接的 get_match_rooms 延迟
+    usage: python tools/bench_linkplay.py [--start .] [--clients 200] [--workers 4] [--duration 10] [--tcp-requests 0]
+'''
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+from argparse import ArgumentParser
+from base64 import b64decode, b64encode
+from multiprocessing import Pool
+from time import perf_counter, sleep
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+AUTHENTICATION = 'my_link_play_server'
+TCP_SECRET_KEY = '1145141919810'
+TCP_AES_KEY = TCP_SECRET_KEY.encode('utf-8').ljust(16, b'\x00')[:16]
+UNLOCK_LENGTH = 512
+
+
+def b(value, length=1):
+    return value.to_bytes(length=length, byteorder='little')
+
+
+def recv_exactly(sock: socket.socket, n: int) -> bytes:
+    r = bytearray()
+    while len(r) < n:
+        x = sock.recv(n - len(r))
+        if not x:
+            raise ConnectionError('Connection closed')
+        r.extend(x)
+    return bytes(r)
+
+
+def tcp_request(args, endpoint: str, data: dict) -> dict:
+    iv = os.urandom(12)
+    x = AESGCM(TCP_AES_KEY).encrypt(
+        iv, json.dumps({'endpoint': endpoint, 'data': data}).encode(), None)
+    ciphertext, tag = x[:-16], x[-16:]
+    with socket.create_connection((args.host, args.tcp_port), timeout=10) as sock:
+        sock.sendall(AUTHENTICATION.encode() +
+                     b(len(ciphertext), 8) + iv + tag + ciphertext)
+        length = int.from_bytes(recv_exactly(sock, 8), 'little')
+        iv = recv_exactly(sock, 12)
+        tag = recv_exactly(sock, 16)
+        ciphertext = recv_exactly(sock, length)
+    r = json.loads(AESGCM(TCP_AES_KEY).decrypt(iv, ciphertext + tag, None))
+    if r['code'] != 0:
+        raise RuntimeError(f'{endpoint}: {r}')
+    return r['data']
+
+
+class Client(asyncio.DatagramProtocol):
+    def __init__(self, room: dict) -> None:
+        self.token = int(room['token'])
+        self.room_id = int(room['room_id'])
+        self.aead = AESGCM(b64decode(room['key']))
+        self.seq = 0
+        self.probe = 0
+        self.waiter: asyncio.Future = None
+        self.transport = None
+
+    def connection_made(self, transport) -> None:
+        self.transport = transport
+
+    def send(self, command: bytes, body: bytes) -> None:
+        plaintext = b'\x06\x16' + command + b'\x0d' + \
+            b(self.room_id, 8) + b(self.seq, 4) + body
+        plaintext += b'\x00' * (-len(plaintext) % 16)
+        iv = os.urandom(12)
+        x = self.aead.encrypt(iv, plaintext, None)
+        self.transport.sendto(b(self.token, 8) + iv + x[-16:] + x[:-16])
+
+    def heartbeat(self) -> None:
+        # player_state 2 不会触发准备完成
+        self.send(b'\x09', b'\x00' * 8 + b'\x00' * 8 +
+                  bytes((2, 0xff, 0, 100, 0, 0)))
+
+    def datagram_received(self, data: bytes, addr) -> None:
+        x = self.aead.decrypt(data[8:20], data[36:] + data[20:36], None)
+        self.seq = max(self.seq, int.from_bytes(x[12:16], 'little'))
+        if x[2] == 0x0d and self.waiter is not None and not self.waiter.done() \
+                and int.from_bytes(x[16:24], 'little') == self.probe:
+            self.waiter.set_result(None)
+
+    async def run_probe(self, timeout: float) -> float:
+        self.probe += 1
+        self.waiter = asyncio.get_running_loop().create_future()
+        t = perf_counter()
+        self.send(b'\x23', b(self.probe, 8) + b(0, 2))
+        try:
+            await asyncio.wait_for(self.waiter, timeout)
+        except asyncio.TimeoutError:
+            return None
+        return perf_counter() - t
+
+
+async def run_clients(args, rooms: list) -> tuple:
+    loop = asyncio.get_running_loop()
+    clients = []
+    for room in rooms:
+        _, client = await loop.create_datagram_endpoint(
+            lambda room=room: Client(room), remote_addr=(args.host, args.udp_port))
+        clients.append(client)
+
+    for client in clients:
+        client.heartbeat()
+    await asyncio.sleep(0.5)
+
+    latencies = []
+    lost = 0
+    end_time = perf_counter() + args.duration
+
+    async def client_loop(client: Client) -> None:
+        nonlocal lost
+        next_heartbeat = perf_counter() + 1
+        while perf_counter() < end_time:
+            if perf_counter() >= next_heartbeat:
+                client.heartbeat()
+                next_heartbeat += 1
+            x = await client.run_probe(args.timeout)
+            if x is None:
+                lost += 1
+            else:
+                latencies.append(x)
+
+    t = perf_counter()
+    await asyncio.gather(*(client_loop(i) for i in clients))
+    t = perf_counter() - t
+    for client in clients:
+        client.transport.close()
+    return latencies, lost, t
+
+
+def worker(x: tuple) -> tuple:
+    args, n = x
+    rooms = [tcp_request(args, 'create_room', {
+        'name': f'bench{os.getpid() % 10000:04d}{i:04d}'[:16],
+        'song_unlock': b64encode(b'\xff' * UNLOCK_LENGTH).decode()
+    }) for i in range(n)]
+    return asyncio.run(run_clients(args, rooms))
+
+
+def bench_tcp(args) -> None:
+    sys.path.insert(0, os.path.dirname(
+        os.path.dirname(os.path.abspath(__file__))))
+    from core.config_manager import Config
+    Config.SET_LINKPLAY_SERVER_AS_SUB_PROCESS = False
+    Config.LINKPLAY_HOST = args.host
+    Config.LINKPLAY_TCP_PORT = args.tcp_port
+    from core.linkplay import LinkPlayChannel
+
+    def run(name: str, func) -> None:
+        func()
+        latencies = []
+        for _ in range(args.tcp_requests):
+            t = perf_counter()
+            func()
+            latencies.append(perf_counter() - t)
+        latencies.sort()
+        print(f'{name:<12} p50 {latencies[len(latencies) // 2] * 1000:.3f} ms, '
+              f'p99 {latencies[int(len(latencies) * 0.99)] * 1000:.3f} ms')
+
+    data = {'endpoint': 'get_match_rooms', 'data': {'limit': 100}}
+    run('per request', lambda: tcp_request(args, data['endpoint'], data['data']))
+    run('channel', lambda: LinkPlayChannel.request(data))
+
+
+def wait_for_port(args) -> None:
+    for _ in range(100):
+        try:
+            with socket.create_connection((args.host, args.tcp_port), timeout=1):
+                return
+        except OSError:
+            sleep(0.1)
+    raise RuntimeError('Link Play server did not start')
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--udp-port', type=int, default=10900)
+    parser.add_argument('--tcp-port', type=int, default=10901)
+    parser.add_argument('--start', metavar='REPO',
+                        help='start the Link Play server of this repository')
+    parser.add_argument('--clients', type=int, default=200)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--timeout', type=float, default=2)
+    parser.add_argument('--tcp-requests', type=int, default=0)
+    args = parser.parse_args()
+
+    server = None
+    if args.start:
+        server = subprocess.Popen([sys.executable, '-c', f'import linkplay_server; linkplay_server.link_play("{args.host}", {args.udp_port}, {args.tcp_port})'],
+                                  cwd=os.path.abspath(args.start), stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(args)
+        if args.tcp_requests > 0:
+            bench_tcp(args)
+            return
+        n = [args.clients // args.workers + (i < args.clients % args.workers)
+             for i in range(args.workers)]
+        with Pool(args.workers) as pool:
+            results = pool.map(worker, [(args, i) for i in n if i > 0])
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    latencies = sorted(i for r in results for i in r[0])
+    lost = sum(r[1] for r in results)
+    t = max(r[2] for r in results)
+    if not latencies:
+        print(f'no replies, lost: {lost}')
+        return
+
+    def p(x): return latencies[min(len(latencies) - 1, int(len(latencies) * x))] * 1000
+    print(f'clients: {args.clients}, replies: {len(latencies)}, lost: {lost}')
+    print(f'{len(latencies) / t:.0f} packets/s, p50 {p(0.5):.2f} ms, p99 {p(0.99):.2f} ms, max {latencies[-1] * 1000:.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+'''
+    Link Play UDP 数据包加解密与发送 benchmark
+
+    比较每个命令的 加密 + 组包 + 发送 耗时：旧的每包新建`Cipher`、缓存`AESGCM`后拼接 bytes（服务器当前做法）、
+    预分配 bytearray 组包后`sendto`以及 memoryview + `sendmsg`分散发送；接收端比较解密耗时
+    数据包不超过 1 KiB，拼接的开销小于 memoryview 切片和 iovec 的开销
+    命令由`CommandSender`生成（0x0e 分数广播、0x13 房间信息、0x15 完整房间信息），发送到本机一个不读取的 UDP socket
+    usage: python tools/bench_linkplay_packet.py [--rounds 20000]
+'''
+import os
+import socket
+import sys
+from argparse import ArgumentParser
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM  # noqa: E402
+
+from linkplay_server.aes import decrypt, encrypt  # noqa: E402
+from linkplay_server.udp_class import Player, Room, b, bi  # noqa: E402
+from linkplay_server.udp_sender import CommandSender  # noqa: E402
+
+
+def make_commands() -> dict:
+    room = Room()
+    room.room_id = 123456789
+    for i in range(4):
+        room.players[i] = Player(i)
+        room.players[i].player_id = i + 1
+    s = CommandSender(room)
+    return {'0e': s.command_0e(0), '13': s.command_13(), '15': s.command_15()}
+
+
+def timeit(func, rounds: int) -> float:
+    for _ in range(100):
+        func()
+    t = perf_counter()
+    for _ in range(rounds):
+        func()
+    return (perf_counter() - t) / rounds * 1000000
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--rounds', type=int, default=20000)
+    args = parser.parse_args()
+
+    key = os.urandom(16)
+    aead = AESGCM(key)
+    token = b(1145141919810, 8)
+
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(('127.0.0.1', 0))
+    addr = sink.getsockname()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    buffer = bytearray(2048)
+    view = memoryview(buffer)
+
+    def legacy(command):
+        iv, ciphertext, tag = encrypt(key, command, b'')
+        sock.sendto(token + iv + tag + ciphertext, addr)
+
+    def cached_aead(command):
+        iv = os.urandom(12)
+        x = aead.encrypt(iv, command, None)
+        sock.sendto(token + iv + x[-16:] + x[:-16], addr)
+
+    def buffer_sendto(command):
+        iv = os.urandom(12)
+        x = memoryview(aead.encrypt(iv, command, None))
+        n = 36 + len(x) - 16
+        view[:8] = token
+        view[8:20] = iv
+        view[20:36] = x[-16:]
+        view[36:n] = x[:-16]
+        sock.sendto(view[:n], addr)
+
+    def packet_sendmsg(command):
+        iv = os.urandom(12)
+        x = memoryview(aead.encrypt(iv, command, None))
+        sock.sendmsg((token, iv, x[-16:], x[:-16]), (), 0, addr)
+
+    senders = {'legacy': legacy, 'AESGCM': cached_aead,
+               'buffer+sendto': buffer_sendto}
+    if hasattr(socket.socket, 'sendmsg'):
+        senders['sendmsg'] = packet_sendmsg
+
+    def legacy_decrypt(packet):
+        return decrypt(key, b'', packet[8:20], packet[36:], packet[20:36])
+
+    def cached_decrypt(packet):
+        bi(packet[:8])
+        return aead.decrypt(packet[8:20], packet[36:] + packet[20:36], None)
+
+    def buffer_decrypt(packet):
+        packet = memoryview(packet)
+        bi(packet[:8])
+        n = len(packet) - 36
+        view[:n] = packet[36:]
+        view[n:n + 16] = packet[20:36]
+        return aead.decrypt(packet[8:20], view[:n + 16], None)
+
+    receivers = {'legacy': legacy_decrypt, 'AESGCM': cached_decrypt,
+                 'memoryview': buffer_decrypt}
+
+    try:
+        commands = make_commands()
+        print('encrypt + send, us per command')
+        print(f'{"command":<10}{"size":>6}' +
+              ''.join(f'{i:>16}' for i in senders))
+        for name, command in commands.items():
+            line = ''.join(f'{timeit(lambda: f(command), args.rounds):>16.2f}'
+                           for f in senders.values())
+            print(f'{name:<10}{len(command):>6}{line}')
+
+        print('decrypt, us per packet')
+        print(f'{"command":<10}{"size":>6}' +
+              ''.join(f'{i:>16}' for i in receivers))
+        for name, command in commands.items():
+            iv = os.urandom(12)
+            x = aead.encrypt(iv, command, None)
+            packet = token + iv + x[-16:] + x[:-16]
+            assert all(f(packet) == command for f in receivers.values())
+            line = ''.join(f'{timeit(lambda: f(packet), args.rounds):>16.2f}'
+                           for f in receivers.values())
+            print(f'{name:<10}{len(command):>6}{line}')
+    finally:
+        sock.close()
+        sink.close()
+
+
+if __name__ == '__main__':
+    main()
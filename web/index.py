@@ -6,14 +6,16 @@ from werkzeug.utils import secure_filename
 
 import web.system
 import web.webscore
+from core.character import CharacterCatalogue
 from core.init import FileChecker
 from core.operation import (DeleteUserScore, RefreshAllScoreRating,
                             RefreshBundleCache, RefreshSongFileCache,
                             SaveUpdateScore, UnlockUserItem)
 from core.rank import RankList
+from core.rank_index import RankIndex, WorldRankIndex
 from core.score import Potential
 from core.sql import Connect
-from core.user import User
+from core.user import User, UserInfo
 from web.login import login_required
 
 UPLOAD_FOLDER = 'database'
@@ -499,6 +501,7 @@ def edit_char():
                 flash('角色修改成功 Successfully edit the character.')
         else:
             error = '角色不存在 The character does not exist.'
+    CharacterCatalogue.clear()
 
     if error:
         flash(error)
@@ -1464,11 +1467,17 @@ def delete_score():
                 sql = sql[:-4]
 
             c.execute(sql, sql_dict)
+            UserInfo.refresh_world_rank_score(
+                c, user_id if flag[2] else None)
+            Potential.clear_best_cache(c, user_id if flag[2] else None)
             flash('成功删除成绩 Successfully delete the scores.')
             error = None
         else:
             error = '输入为空 Null Input.'
 
+    if error is None:
+        RankIndex.clear()
+        WorldRankIndex.clear()
     if error:
         flash(error)
 